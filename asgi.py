@@ -0,0 +1,16 @@
+"""
+a.zhai's ToolBox - ASGI 入口
+
+/api/draw、/api/result、/api/chat 使用异步上游客户端处理，其余请求
+仍由 Flask 应用处理。运行方式：
+
+    pip install -r requirements-async.txt
+    uvicorn asgi:app --port 5001
+    gunicorn -k uvicorn.workers.UvicornWorker asgi:app
+"""
+from app import app as flask_app
+from src.routes.asgi_routes import create_asgi_app
+
+
+# 创建 ASGI 应用实例
+app = create_asgi_app(flask_app)
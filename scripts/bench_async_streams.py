@@ -0,0 +1,119 @@
+"""
+ASGI 模式并发流式压测
+
+启动本地模拟上游，在进程内通过 ASGI 接口同时发起 N 个 /api/chat 流式请求，
+统计全部完成的耗时和同时在途的峰值，并与同步 worker（cpu_count*2+1）
+在相同负载下的理论耗时对比。运行方式：
+
+    pip install -r requirements-async.txt
+    python scripts/bench_async_streams.py --streams 1000
+"""
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "scripts"))
+
+from fake_upstream import FakeUpstream  # noqa: E402
+
+
+async def run_stream(app, body: bytes, state: dict) -> int:
+    """通过 ASGI 接口发起一个流式请求，返回收到的 SSE 事件数量
+
+    多个事件可能合并在同一条 http.response.body 消息中，因此拼接响应体后
+    按空行分隔统计事件，而不是统计消息条数。
+    """
+    finished = asyncio.Event()
+    request_messages = [{"type": "http.request", "body": body, "more_body": False}]
+    received = bytearray()
+
+    async def receive():
+        if request_messages:
+            return request_messages.pop(0)
+        await finished.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start" and message["status"] != 200:
+            state["errors"] += 1
+        elif message["type"] == "http.response.body":
+            received.extend(message.get("body", b""))
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "path": "/api/chat",
+        "raw_path": b"/api/chat",
+        "query_string": b"",
+        "headers": [(b"content-type", b"application/json")],
+        "client": ("127.0.0.1", 0),
+        "server": ("127.0.0.1", 80),
+    }
+
+    state["in_flight"] += 1
+    state["peak"] = max(state["peak"], state["in_flight"])
+    try:
+        await app(scope, receive, send)
+    finally:
+        state["in_flight"] -= 1
+        finished.set()
+    return received.replace(b"\r\n", b"\n").count(b"\n\n")
+
+
+async def main(args) -> None:
+    upstream = FakeUpstream(token_delay=args.token_delay, tokens=args.tokens)
+    await upstream.start()
+
+    data_dir = tempfile.mkdtemp(prefix="bench-")
+    os.environ["DATA_DIR"] = data_dir
+    os.environ["DB_PATH"] = os.path.join(data_dir, "app.db")
+    os.environ["NANO_BANANA_HOST"] = upstream.base_url
+    os.environ["NANO_BANANA_API_KEY"] = "sk-bench"
+    os.environ["ASYNC_MAX_CONNECTIONS"] = str(max(args.streams, 100))
+
+    from asgi import app
+    from src.services.async_ai_service import get_async_ai_service
+
+    body = json.dumps({
+        "model": "nano-banana-fast",
+        "stream": True,
+        "messages": [{"role": "user", "content": "hello"}],
+    }).encode("utf-8")
+
+    state = {"in_flight": 0, "peak": 0, "errors": 0}
+    started = time.monotonic()
+    results = await asyncio.gather(*(run_stream(app, body, state) for _ in range(args.streams)))
+    elapsed = time.monotonic() - started
+
+    stream_seconds = args.token_delay * args.tokens
+    workers = multiprocessing.cpu_count() * 2 + 1
+    sync_seconds = math.ceil(args.streams / workers) * stream_seconds
+
+    print(f"streams:              {args.streams}")
+    print(f"single stream:        {stream_seconds:.2f}s ({args.tokens} tokens)")
+    print(f"asgi elapsed:         {elapsed:.2f}s (1 process)")
+    print(f"peak concurrent:      {state['peak']}")
+    print(f"events received:      {sum(results)} (expected {args.streams * (args.tokens + 1)})")
+    print(f"errors:               {state['errors']}")
+    print(f"sync workers elapsed: {sync_seconds:.2f}s (theoretical, {workers} sync workers)")
+
+    await get_async_ai_service().aclose()
+    await upstream.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ASGI 模式并发流式压测")
+    parser.add_argument("--streams", type=int, default=500, help="并发流式请求数")
+    parser.add_argument("--tokens", type=int, default=20, help="每个流的 token 数")
+    parser.add_argument("--token-delay", type=float, default=0.1, help="token 间隔（秒）")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,292 @@
+"""
+本地模拟上游服务（用于离线测试和压测）
+
+模拟 /v1/draw/nano-banana、/v1/draw/result、/v1/chat/completions 接口，
+流式响应按固定间隔逐条输出；绘图请求的 webHook 为 http(s) 地址时，
+进度与结果以 POST 请求回调该地址。运行方式：
+
+    python scripts/fake_upstream.py --port 18080
+    NANO_BANANA_HOST=http://127.0.0.1:18080 python app.py
+"""
+import argparse
+import asyncio
+import base64
+import json
+import time
+import uuid
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+# 1x1 像素的 PNG，用作模拟的生成结果
+PNG_BYTES = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8/5+hHgAHggJ/PchI7wAAAABJRU5ErkJggg=="
+)
+
+
+class FakeUpstream:
+    """模拟上游服务"""
+
+    def __init__(self,
+                 host: str = "127.0.0.1",
+                 port: int = 0,
+                 token_delay: float = 0.05,
+                 tokens: int = 20,
+                 draw_seconds: float = 3.0):
+        self.host = host
+        self.port = port
+        self.token_delay = token_delay
+        self.tokens = tokens
+        self.draw_seconds = draw_seconds
+        self.requests = 0
+        self.callbacks = 0
+        # 最近一次 POST 请求的请求体（用于检查转发的参数）
+        self.last_payload: Dict = {}
+        # 返回 429 的密钥（用于测试密钥池），以及每个密钥的请求次数
+        self.rate_limited_keys: set = set()
+        self.key_requests: Dict[str, int] = {}
+        # 绘图任务ID -> 提交时间
+        self.tasks: Dict[str, float] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections: set = set()
+        self._background: set = set()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self) -> None:
+        """启动服务"""
+        self._server = await asyncio.start_server(
+            self._handle, self.host, self.port, backlog=4096
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def close(self) -> None:
+        """停止服务"""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        tasks = list(self._connections) + list(self._background)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Optional[Tuple[str, str, Dict[str, str], bytes]]:
+        """读取一个 HTTP/1.1 请求"""
+        line = await reader.readline()
+        if not line:
+            return None
+        method, target, _ = line.decode("latin-1").split(" ", 2)
+        headers = {}
+        while True:
+            header = await reader.readline()
+            if header in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = header.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", "0"))
+        body = await reader.readexactly(length) if length else b""
+        return method, target, headers, body
+
+    @staticmethod
+    def _response_head(status: int, content_type: str, length: Optional[int] = None) -> bytes:
+        lines = [f"HTTP/1.1 {status} {'OK' if status < 400 else 'Error'}",
+                 f"Content-Type: {content_type}"]
+        if length is None:
+            lines.append("Transfer-Encoding: chunked")
+        else:
+            lines.append(f"Content-Length: {length}")
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+    async def _send_json(self, writer: asyncio.StreamWriter, data, status: int = 200) -> None:
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        writer.write(self._response_head(status, "application/json", len(body)) + body)
+        await writer.drain()
+
+    async def _send_chunk(self, writer: asyncio.StreamWriter, data: bytes) -> None:
+        writer.write(f"{len(data):x}\r\n".encode("latin-1") + data + b"\r\n")
+        await writer.drain()
+
+    def draw_status(self, draw_id: str) -> Dict:
+        """根据提交后经过的时间计算任务状态"""
+        started = self.tasks.get(draw_id)
+        if started is None:
+            return {}
+        progress = min(100, int((time.monotonic() - started) / self.draw_seconds * 100))
+        done = progress >= 100
+        return {
+            "id": draw_id,
+            "results": [{"url": f"{self.base_url}/files/{draw_id}.png", "content": ""}] if done else [],
+            "progress": progress,
+            "status": "succeeded" if done else "running",
+            "failure_reason": "",
+            "error": "",
+        }
+
+    async def _chat(self, writer: asyncio.StreamWriter, payload: Dict) -> None:
+        model = payload.get("model", "fake")
+        if not payload.get("stream"):
+            await asyncio.sleep(self.token_delay * self.tokens)
+            await self._send_json(writer, {
+                "id": uuid.uuid4().hex,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "token " * self.tokens},
+                    "finish_reason": "stop",
+                }],
+            })
+            return
+
+        writer.write(self._response_head(200, "text/event-stream"))
+        completion_id = uuid.uuid4().hex
+        for index in range(self.tokens):
+            await asyncio.sleep(self.token_delay)
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "delta": {"content": f"token{index} "},
+                    "finish_reason": "stop" if index == self.tokens - 1 else None,
+                }],
+            }
+            await self._send_chunk(writer, f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        await self._send_chunk(writer, b"data: [DONE]\n\n")
+        await self._send_chunk(writer, b"")
+
+    async def _post_callback(self, url: str, data: Dict) -> int:
+        """向回调地址 POST 一次状态，返回响应状态码"""
+        parts = urlsplit(url)
+        body = json.dumps(data).encode("utf-8")
+        target = parts.path + (f"?{parts.query}" if parts.query else "")
+        secure = parts.scheme == "https"
+        reader, writer = await asyncio.open_connection(
+            parts.hostname, parts.port or (443 if secure else 80), ssl=secure or None
+        )
+        try:
+            writer.write((
+                f"POST {target} HTTP/1.1\r\n"
+                f"Host: {parts.netloc}\r\n"
+                "Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n"
+            ).encode("latin-1") + body)
+            await writer.drain()
+            status_line = await reader.readline()
+            self.callbacks += 1
+            return int(status_line.split()[1]) if status_line else 0
+        finally:
+            writer.close()
+
+    async def _deliver_callbacks(self, url: str, draw_id: str, shut_progress: bool) -> None:
+        """按进度回调，直到任务结束"""
+        while True:
+            status = self.draw_status(draw_id)
+            if not shut_progress or status["status"] != "running":
+                try:
+                    await self._post_callback(url, status)
+                except (OSError, ValueError, IndexError):
+                    pass
+            if status["status"] != "running":
+                return
+            await asyncio.sleep(min(0.5, self.draw_seconds / 10))
+
+    async def _draw(self, writer: asyncio.StreamWriter, payload: Dict) -> None:
+        draw_id = uuid.uuid4().hex
+        self.tasks[draw_id] = time.monotonic()
+        web_hook = payload.get("webHook") or ""
+        if web_hook:
+            if web_hook.startswith(("http://", "https://")):
+                task = asyncio.ensure_future(
+                    self._deliver_callbacks(web_hook, draw_id, bool(payload.get("shutProgress")))
+                )
+                self._background.add(task)
+                task.add_done_callback(self._background.discard)
+            await self._send_json(writer, {"code": 0, "msg": "success", "data": {"id": draw_id}})
+            return
+
+        # 未设置 webHook 时以流式响应返回进度
+        writer.write(self._response_head(200, "text/event-stream"))
+        while True:
+            status = self.draw_status(draw_id)
+            if not payload.get("shutProgress") or status["status"] != "running":
+                await self._send_chunk(writer, f"data: {json.dumps(status)}\n\n".encode("utf-8"))
+            if status["status"] != "running":
+                break
+            await asyncio.sleep(min(0.5, self.draw_seconds / 10))
+        await self._send_chunk(writer, b"")
+
+    async def _route(self, writer, method: str, path: str, body: bytes) -> None:
+        payload = json.loads(body or b"{}") if method == "POST" else {}
+        if method == "POST":
+            self.last_payload = payload
+        if method == "POST" and path == "/v1/chat/completions":
+            await self._chat(writer, payload)
+        elif method == "POST" and path == "/v1/draw/nano-banana":
+            await self._draw(writer, payload)
+        elif method == "POST" and path == "/v1/draw/result":
+            status = self.draw_status(payload.get("id", ""))
+            if status:
+                await self._send_json(writer, {"code": 0, "msg": "success", "data": status})
+            else:
+                await self._send_json(writer, {"code": -22, "msg": "task not found", "data": None})
+        elif method == "GET" and path.startswith("/files/"):
+            writer.write(self._response_head(200, "image/png", len(PNG_BYTES)) + PNG_BYTES)
+            await writer.drain()
+        else:
+            await self._send_json(writer, {"error": "not found"}, status=404)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                method, target, headers, body = request
+                self.requests += 1
+                api_key = headers.get("authorization", "").replace("Bearer ", "", 1)
+                self.key_requests[api_key] = self.key_requests.get(api_key, 0) + 1
+                if api_key in self.rate_limited_keys:
+                    body = json.dumps({"error": "rate limited"}).encode("utf-8")
+                    writer.write(self._response_head(429, "application/json", len(body)) + body)
+                    await writer.drain()
+                    continue
+                await self._route(writer, method, target.split("?", 1)[0], body)
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+
+async def _main(args) -> None:
+    upstream = FakeUpstream(
+        host=args.host,
+        port=args.port,
+        token_delay=args.token_delay,
+        tokens=args.tokens,
+        draw_seconds=args.draw_seconds
+    )
+    await upstream.start()
+    print(f"fake upstream listening on {upstream.base_url}")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="本地模拟上游服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--token-delay", type=float, default=0.05, help="流式输出间隔（秒）")
+    parser.add_argument("--tokens", type=int, default=20, help="每次回复的 token 数")
+    parser.add_argument("--draw-seconds", type=float, default=3.0, help="模拟绘图耗时（秒）")
+    try:
+        asyncio.run(_main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -4,6 +4,9 @@
 import os
 from typing import Optional
 
+# APP_SECRET_KEY 的默认值（仅用于本地开发）
+DEFAULT_SECRET_KEY = "change-me"
+
 
 class Config:
     """配置管理类"""
@@ -17,7 +20,7 @@ class Config:
             self.local_config = None
 
         # 从环境变量或本地配置获取值
-        self.app_secret_key = os.getenv("APP_SECRET_KEY", "change-me")
+        self.app_secret_key = os.getenv("APP_SECRET_KEY", DEFAULT_SECRET_KEY)
 
         # API配置
         self.api_host = self._get_config_value(
@@ -36,6 +39,17 @@ class Config:
         # 服务器配置
         self.port = int(os.getenv("PORT", "5001"))
 
+        # 上游连接配置
+        self.upstream_pool_size = int(os.getenv("UPSTREAM_POOL_SIZE", "32"))
+        self.upstream_connect_timeout = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "5"))
+        self.upstream_read_timeout = float(os.getenv("UPSTREAM_READ_TIMEOUT", "120"))
+        self.async_max_connections = int(os.getenv("ASYNC_MAX_CONNECTIONS", "1000"))
+        # 流式响应转发时单次读取的最大字节数（有数据即转发，不等待凑满）
+        self.stream_chunk_size = int(os.getenv("STREAM_CHUNK_SIZE", "65536"))
+        # 可续传聊天流：每个流的重放缓冲上限（字节）、断线后等待重连的时间（秒）
+        self.chat_stream_buffer_bytes = int(os.getenv("CHAT_STREAM_BUFFER_BYTES", str(1024 * 1024)))
+        self.chat_stream_resume_seconds = float(os.getenv("CHAT_STREAM_RESUME_SECONDS", "30"))
+
         # 数据库配置
         self.data_dir = os.getenv("DATA_DIR", "data")
         self.db_path = os.getenv("DB_PATH", os.path.join(self.data_dir, "app.db"))
@@ -48,6 +62,68 @@ class Config:
             "MAX_REFERENCE_IMAGE_BYTES", str(5 * 1024 * 1024)
         ))
 
+        # 参考图存储配置
+        self.image_store_dir = os.getenv("IMAGE_STORE_DIR", os.path.join(self.data_dir, "images"))
+        self.image_store_retention_days = int(os.getenv("IMAGE_STORE_RETENTION_DAYS", "7"))
+
+        # 结果图片缓存配置
+        self.media_cache_dir = os.getenv("MEDIA_CACHE_DIR", os.path.join(self.data_dir, "media"))
+        self.media_cache_max_mb = int(os.getenv("MEDIA_CACHE_MAX_MB", "1024"))
+        self.media_thumbnail_size = int(os.getenv("MEDIA_THUMBNAIL_SIZE", "384"))
+
+        # 参考图预处理配置（需要安装 Pillow，进程数为 0 时关闭）
+        self.image_preprocess_workers = int(os.getenv("IMAGE_PREPROCESS_WORKERS", "2"))
+        self.image_preprocess_quality = int(os.getenv("IMAGE_PREPROCESS_QUALITY", "90"))
+        self.image_preprocess_timeout = float(os.getenv("IMAGE_PREPROCESS_TIMEOUT", "20"))
+
+        # 密钥缓存配置
+        self.key_cache_size = int(os.getenv("KEY_CACHE_SIZE", "1024"))
+        self.key_cache_ttl = float(os.getenv("KEY_CACHE_TTL", "300"))
+        self.key_cache_check_seconds = float(os.getenv("KEY_CACHE_CHECK_SECONDS", "2"))
+
+        # 密钥池（least_in_flight 或 round_robin，留空时只使用活动密钥）
+        self.key_pool_mode = os.getenv("KEY_POOL_MODE", "").strip()
+        self.key_pool_cooldown = float(os.getenv("KEY_POOL_COOLDOWN", "30"))
+        self.key_pool_max_attempts = int(os.getenv("KEY_POOL_MAX_ATTEMPTS", "3"))
+
+        # 使用统计写缓冲配置
+        self.usage_flush_interval = float(os.getenv("USAGE_FLUSH_INTERVAL", "2"))
+        self.usage_flush_threshold = int(os.getenv("USAGE_FLUSH_THRESHOLD", "200"))
+        self.usage_event_retention_days = int(os.getenv("USAGE_EVENT_RETENTION_DAYS", "7"))
+
+        # 绘图结果轮询配置
+        self.draw_poll_min_interval = float(os.getenv("DRAW_POLL_MIN_INTERVAL", "1"))
+        self.draw_poll_max_interval = float(os.getenv("DRAW_POLL_MAX_INTERVAL", "8"))
+        self.draw_poll_timeout = float(os.getenv("DRAW_POLL_TIMEOUT", "600"))
+        self.draw_poll_workers = int(os.getenv("DRAW_POLL_WORKERS", "4"))
+        self.draw_result_ttl = float(os.getenv("DRAW_RESULT_TTL", "300"))
+
+        # 已结束绘图结果缓存配置（上游图片地址有效期为 2 小时）
+        self.draw_cache_size = int(os.getenv("DRAW_CACHE_SIZE", "2048"))
+        self.draw_cache_ttl = float(os.getenv("DRAW_CACHE_TTL", "7200"))
+        self.draw_cache_max_rows = int(os.getenv("DRAW_CACHE_MAX_ROWS", "20000"))
+
+        # 幂等请求记录保留时间
+        self.idempotency_ttl_hours = float(os.getenv("IDEMPOTENCY_TTL_HOURS", "24"))
+
+        # 聊天响应缓存（请求体带 "cache": true 时使用），上限为 0 时关闭
+        self.chat_cache_max_mb = int(os.getenv("CHAT_CACHE_MAX_MB", "64"))
+        self.chat_cache_ttl = float(os.getenv("CHAT_CACHE_TTL", "86400"))
+
+        # 服务端会话的上下文 token 预算，可按模型单独设置（如 "gpt-4o=60000,gpt-4o-mini=60000"）
+        self.chat_context_tokens = int(os.getenv("CHAT_CONTEXT_TOKENS", "8000"))
+        self.chat_model_context_tokens = self._parse_model_tokens(
+            os.getenv("CHAT_MODEL_CONTEXT_TOKENS", "")
+        )
+
+        # 上游回调配置（设置 PUBLIC_BASE_URL 后启用；签名密钥未设置且 APP_SECRET_KEY
+        # 仍为默认值时不启用，否则任何知道默认值的人都能伪造回调地址）
+        self.public_base_url = os.getenv("PUBLIC_BASE_URL", "").strip()
+        self.webhook_secret = os.getenv("WEBHOOK_SECRET", "") or (
+            self.app_secret_key if self.app_secret_key != DEFAULT_SECRET_KEY else ""
+        )
+        self.draw_webhook_fallback = float(os.getenv("DRAW_WEBHOOK_FALLBACK", "30"))
+
     def _get_config_value(self, config_attr: str, env_var: str, default: str) -> str:
         """获取配置值，优先级：环境变量 > 本地配置 > 默认值"""
         # 首先检查环境变量
@@ -64,6 +140,16 @@ class Config:
         # 最后返回默认值
         return default
 
+    @staticmethod
+    def _parse_model_tokens(value: str) -> dict:
+        """解析 "模型=token数,模型=token数" 形式的配置"""
+        result = {}
+        for item in value.split(","):
+            model, _, tokens = item.partition("=")
+            if model.strip() and tokens.strip().isdigit():
+                result[model.strip()] = int(tokens.strip())
+        return result
+
     @property
     def draw_endpoint(self) -> str:
         """图像生成端点"""
@@ -79,6 +165,16 @@ class Config:
         """聊天完成端点"""
         return f"{self.api_host.rstrip('/')}/v1/chat/completions"
 
+    @property
+    def draw_webhook_enabled(self) -> bool:
+        """是否让上游以回调方式推送绘图结果（需要设置了签名密钥）"""
+        return bool(self.public_base_url and self.webhook_secret)
+
+    @property
+    def draw_webhook_url(self) -> str:
+        """绘图结果回调地址"""
+        return f"{self.public_base_url.rstrip('/')}/api/webhook/draw"
+
     def to_dict(self) -> dict:
         """转换为字典（用于调试）"""
         return {
@@ -88,11 +184,51 @@ class Config:
             "chat_endpoint": self.chat_endpoint,
             "seed_username": self.seed_username,
             "port": self.port,
+            "upstream_pool_size": self.upstream_pool_size,
+            "upstream_connect_timeout": self.upstream_connect_timeout,
+            "upstream_read_timeout": self.upstream_read_timeout,
+            "async_max_connections": self.async_max_connections,
+            "stream_chunk_size": self.stream_chunk_size,
+            "chat_stream_buffer_bytes": self.chat_stream_buffer_bytes,
+            "chat_stream_resume_seconds": self.chat_stream_resume_seconds,
             "db_path": self.db_path,
             "max_login_attempts": self.max_login_attempts,
             "lock_minutes": self.lock_minutes,
             "max_reference_images": self.max_reference_images,
-            "max_reference_image_bytes": self.max_reference_image_bytes
+            "max_reference_image_bytes": self.max_reference_image_bytes,
+            "image_store_dir": self.image_store_dir,
+            "image_store_retention_days": self.image_store_retention_days,
+            "media_cache_dir": self.media_cache_dir,
+            "media_cache_max_mb": self.media_cache_max_mb,
+            "media_thumbnail_size": self.media_thumbnail_size,
+            "image_preprocess_workers": self.image_preprocess_workers,
+            "image_preprocess_quality": self.image_preprocess_quality,
+            "image_preprocess_timeout": self.image_preprocess_timeout,
+            "key_cache_size": self.key_cache_size,
+            "key_cache_ttl": self.key_cache_ttl,
+            "key_cache_check_seconds": self.key_cache_check_seconds,
+            "key_pool_mode": self.key_pool_mode,
+            "key_pool_cooldown": self.key_pool_cooldown,
+            "key_pool_max_attempts": self.key_pool_max_attempts,
+            "usage_flush_interval": self.usage_flush_interval,
+            "usage_flush_threshold": self.usage_flush_threshold,
+            "usage_event_retention_days": self.usage_event_retention_days,
+            "draw_poll_min_interval": self.draw_poll_min_interval,
+            "draw_poll_max_interval": self.draw_poll_max_interval,
+            "draw_poll_timeout": self.draw_poll_timeout,
+            "draw_poll_workers": self.draw_poll_workers,
+            "draw_result_ttl": self.draw_result_ttl,
+            "draw_cache_size": self.draw_cache_size,
+            "draw_cache_ttl": self.draw_cache_ttl,
+            "draw_cache_max_rows": self.draw_cache_max_rows,
+            "idempotency_ttl_hours": self.idempotency_ttl_hours,
+            "chat_cache_max_mb": self.chat_cache_max_mb,
+            "chat_cache_ttl": self.chat_cache_ttl,
+            "chat_context_tokens": self.chat_context_tokens,
+            "chat_model_context_tokens": self.chat_model_context_tokens,
+            "public_base_url": self.public_base_url,
+            "draw_webhook_enabled": self.draw_webhook_enabled,
+            "draw_webhook_fallback": self.draw_webhook_fallback
         }
 
 
@@ -17,13 +17,15 @@ class ApiKey(BaseModel):
                  value: str = "",
                  source: str = "custom",
                  is_active: bool = False,
-                 created_at: Optional[str] = None):
+                 created_at: Optional[str] = None,
+                 fingerprint: Optional[str] = None):
         self.id = id or uuid.uuid4().hex
         self.user_id = user_id
         self.value = value
         self.source = source
         self.is_active = is_active
         self.created_at = created_at or datetime.utcnow().isoformat()
+        self.fingerprint = fingerprint
 
     @classmethod
     def get_table_name(cls) -> str:
@@ -39,6 +41,7 @@ class ApiKey(BaseModel):
             source TEXT DEFAULT 'custom',
             is_active INTEGER DEFAULT 0,
             created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            fingerprint TEXT,
             FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
         );
         """
@@ -51,7 +54,8 @@ class ApiKey(BaseModel):
             value=row["value"],
             source=row["source"],
             is_active=bool(row["is_active"]),
-            created_at=row["created_at"]
+            created_at=row["created_at"],
+            fingerprint=row["fingerprint"]
         )
 
     def to_dict(self) -> Dict:
@@ -85,31 +89,45 @@ class ApiKey(BaseModel):
         )
         return cls.from_row(row) if row else None
 
+    @classmethod
+    def get_by_fingerprint(cls, user_id: int, fingerprint: str) -> Optional['ApiKey']:
+        """根据密钥指纹查找用户的API密钥"""
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+        row = db.fetch_one(
+            "SELECT * FROM api_keys WHERE user_id = ? AND fingerprint = ?",
+            (user_id, fingerprint)
+        )
+        return cls.from_row(row) if row else None
+
     def save(self) -> None:
         """保存API密钥到数据库"""
         from ..services.database import get_db_manager
         db = get_db_manager()
 
-        # 如果设置为活动密钥，先取消其他密钥的活动状态
-        if self.is_active and self.user_id:
+        with db.transaction():
+            # 如果设置为活动密钥，先取消其他密钥的活动状态
+            if self.is_active and self.user_id:
+                db.execute_query(
+                    "UPDATE api_keys SET is_active = 0 WHERE user_id = ?",
+                    (self.user_id,)
+                )
+
+            # 插入或更新密钥
             db.execute_query(
-                "UPDATE api_keys SET is_active = 0 WHERE user_id = ?",
-                (self.user_id,)
+                """
+                INSERT INTO api_keys (id, user_id, value, source, is_active, fingerprint)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET
+                    value = excluded.value,
+                    source = excluded.source,
+                    is_active = excluded.is_active,
+                    fingerprint = excluded.fingerprint
+                """,
+                (self.id, self.user_id, self.value, self.source,
+                 1 if self.is_active else 0, self.fingerprint)
             )
 
-        # 插入或更新密钥
-        db.execute_query(
-            """
-            INSERT INTO api_keys (id, user_id, value, source, is_active)
-            VALUES (?, ?, ?, ?, ?)
-            ON CONFLICT(id) DO UPDATE SET
-                value = excluded.value,
-                source = excluded.source,
-                is_active = excluded.is_active
-            """,
-            (self.id, self.user_id, self.value, self.source, 1 if self.is_active else 0)
-        )
-
     def delete(self) -> None:
         """从数据库删除API密钥"""
         from ..services.database import get_db_manager
@@ -125,19 +143,20 @@ class ApiKey(BaseModel):
         from ..services.database import get_db_manager
         db = get_db_manager()
 
-        # 检查密钥是否存在且属于该用户
-        row = db.fetch_one(
-            "SELECT * FROM api_keys WHERE id = ? AND user_id = ?",
-            (key_id, user_id)
-        )
+        with db.transaction():
+            # 检查密钥是否存在且属于该用户
+            row = db.fetch_one(
+                "SELECT * FROM api_keys WHERE id = ? AND user_id = ?",
+                (key_id, user_id)
+            )
 
-        if not row:
-            return False
+            if not row:
+                return False
 
-        db.execute_query(
-            "DELETE FROM api_keys WHERE id = ?",
-            (key_id,)
-        )
+            db.execute_query(
+                "DELETE FROM api_keys WHERE id = ?",
+                (key_id,)
+            )
         return True
 
     @classmethod
@@ -146,26 +165,27 @@ class ApiKey(BaseModel):
         from ..services.database import get_db_manager
         db = get_db_manager()
 
-        # 检查密钥是否存在且属于该用户
-        row = db.fetch_one(
-            "SELECT * FROM api_keys WHERE id = ? AND user_id = ?",
-            (key_id, user_id)
-        )
+        with db.transaction():
+            # 检查密钥是否存在且属于该用户
+            row = db.fetch_one(
+                "SELECT * FROM api_keys WHERE id = ? AND user_id = ?",
+                (key_id, user_id)
+            )
 
-        if not row:
-            return False
+            if not row:
+                return False
 
-        # 先取消所有密钥的活动状态
-        db.execute_query(
-            "UPDATE api_keys SET is_active = 0 WHERE user_id = ?",
-            (user_id,)
-        )
+            # 先取消所有密钥的活动状态
+            db.execute_query(
+                "UPDATE api_keys SET is_active = 0 WHERE user_id = ?",
+                (user_id,)
+            )
 
-        # 设置指定密钥为活动状态
-        db.execute_query(
-            "UPDATE api_keys SET is_active = 1 WHERE id = ?",
-            (key_id,)
-        )
+            # 设置指定密钥为活动状态
+            db.execute_query(
+                "UPDATE api_keys SET is_active = 1 WHERE id = ?",
+                (key_id,)
+            )
 
         return True
 
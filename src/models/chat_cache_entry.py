@@ -0,0 +1,142 @@
+"""
+聊天响应缓存模型
+"""
+import json
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from .base import BaseModel
+
+
+class ChatCacheEntry(BaseModel):
+    """聊天响应缓存模型类
+
+    按请求内容（模型、消息、采样参数）的规范化哈希保存上游的非流式响应，
+    accessed_at 用于按最近访问淘汰，created_at 用于过期。
+    """
+
+    def __init__(self,
+                 cache_key: str = "",
+                 model: str = "",
+                 response: Optional[Dict[str, Any]] = None,
+                 size: int = 0,
+                 hits: int = 0,
+                 created_at: Optional[str] = None,
+                 accessed_at: Optional[str] = None):
+        self.cache_key = cache_key
+        self.model = model
+        self.response = response or {}
+        self.size = size
+        self.hits = hits
+        self.created_at = created_at or datetime.utcnow().isoformat()
+        self.accessed_at = accessed_at or self.created_at
+
+    @classmethod
+    def get_table_name(cls) -> str:
+        return "chat_cache"
+
+    @classmethod
+    def get_create_table_sql(cls) -> str:
+        return """
+        CREATE TABLE IF NOT EXISTS chat_cache (
+            cache_key TEXT PRIMARY KEY,
+            model TEXT NOT NULL DEFAULT '',
+            response TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT NOT NULL,
+            accessed_at TEXT NOT NULL
+        );
+        """
+
+    @classmethod
+    def from_row(cls, row) -> 'ChatCacheEntry':
+        return cls(
+            cache_key=row["cache_key"],
+            model=row["model"],
+            response=json.loads(row["response"]),
+            size=row["size"],
+            hits=row["hits"],
+            created_at=row["created_at"],
+            accessed_at=row["accessed_at"]
+        )
+
+    def to_dict(self) -> Dict:
+        return {
+            "cache_key": self.cache_key,
+            "model": self.model,
+            "response": self.response,
+            "size": self.size,
+            "hits": self.hits,
+            "created_at": self.created_at,
+            "accessed_at": self.accessed_at
+        }
+
+    @classmethod
+    def get(cls, cache_key: str, created_after: str) -> Optional['ChatCacheEntry']:
+        """获取未过期的缓存条目"""
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+        row = db.fetch_one(
+            "SELECT * FROM chat_cache WHERE cache_key = ? AND created_at >= ?",
+            (cache_key, created_after)
+        )
+        return cls.from_row(row) if row else None
+
+    @classmethod
+    def touch(cls, cache_key: str, hits: int, accessed_at: str) -> None:
+        """累加命中次数并更新最近访问时间"""
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+        db.execute_query(
+            "UPDATE chat_cache SET hits = hits + ?, accessed_at = ? WHERE cache_key = ?",
+            (hits, accessed_at, cache_key)
+        )
+
+    def save(self) -> None:
+        """写入缓存条目（已存在时覆盖）"""
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+        body = json.dumps(self.response, ensure_ascii=False)
+        self.size = len(body.encode("utf-8"))
+        db.execute_query(
+            """
+            INSERT OR REPLACE INTO chat_cache
+                (cache_key, model, response, size, hits, created_at, accessed_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            (self.cache_key, self.model, body, self.size, self.hits,
+             self.created_at, self.accessed_at)
+        )
+
+    @classmethod
+    def total_size(cls) -> int:
+        """缓存条目的总字节数"""
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+        row = db.fetch_one("SELECT COALESCE(SUM(size), 0) AS total FROM chat_cache")
+        return row["total"]
+
+    @classmethod
+    def evict(cls, created_before: str, max_bytes: int) -> int:
+        """删除过期条目，再按最近访问时间保留总大小不超过 max_bytes 的条目，返回删除的条数"""
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+        with db.transaction():
+            expired = db.execute_query(
+                "DELETE FROM chat_cache WHERE created_at < ?",
+                (created_before,)
+            ).rowcount
+            evicted = db.execute_query(
+                """
+                DELETE FROM chat_cache WHERE cache_key IN (
+                    SELECT cache_key FROM (
+                        SELECT cache_key,
+                               SUM(size) OVER (ORDER BY accessed_at DESC, cache_key) AS running
+                        FROM chat_cache
+                    ) WHERE running > ?
+                )
+                """,
+                (max_bytes,)
+            ).rowcount
+        return expired + evicted
@@ -0,0 +1,152 @@
+"""
+会话模型
+"""
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from .base import BaseModel
+
+
+class Conversation(BaseModel):
+    """会话模型类
+
+    保存在服务端的聊天会话：客户端每轮只发送新消息，上下文由服务端按
+    历史消息组装。token_total 为全部消息的估算 token 数之和，追加消息时
+    增量更新。
+    """
+
+    def __init__(self,
+                 id: Optional[int] = None,
+                 user_id: Optional[int] = None,
+                 model: str = "",
+                 title: str = "",
+                 system_prompt: str = "",
+                 message_count: int = 0,
+                 token_total: int = 0,
+                 created_at: Optional[str] = None,
+                 updated_at: Optional[str] = None):
+        self.id = id
+        self.user_id = user_id
+        self.model = model
+        self.title = title
+        self.system_prompt = system_prompt
+        self.message_count = message_count
+        self.token_total = token_total
+        self.created_at = created_at or datetime.utcnow().isoformat()
+        self.updated_at = updated_at or self.created_at
+
+    @classmethod
+    def get_table_name(cls) -> str:
+        return "conversations"
+
+    @classmethod
+    def get_create_table_sql(cls) -> str:
+        return """
+        CREATE TABLE IF NOT EXISTS conversations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            model TEXT NOT NULL DEFAULT '',
+            title TEXT NOT NULL DEFAULT '',
+            system_prompt TEXT NOT NULL DEFAULT '',
+            message_count INTEGER NOT NULL DEFAULT 0,
+            token_total INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL,
+            FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
+        );
+        """
+
+    @classmethod
+    def from_row(cls, row) -> 'Conversation':
+        return cls(
+            id=row["id"],
+            user_id=row["user_id"],
+            model=row["model"],
+            title=row["title"],
+            system_prompt=row["system_prompt"],
+            message_count=row["message_count"],
+            token_total=row["token_total"],
+            created_at=row["created_at"],
+            updated_at=row["updated_at"]
+        )
+
+    def to_dict(self) -> Dict:
+        return {
+            "id": self.id,
+            "user_id": self.user_id,
+            "model": self.model,
+            "title": self.title,
+            "system_prompt": self.system_prompt,
+            "message_count": self.message_count,
+            "token_total": self.token_total,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at
+        }
+
+    def save(self) -> None:
+        """创建会话"""
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+        cursor = db.execute_query(
+            """
+            INSERT INTO conversations
+                (user_id, model, title, system_prompt, message_count, token_total, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (self.user_id, self.model, self.title, self.system_prompt,
+             self.message_count, self.token_total, self.created_at, self.updated_at)
+        )
+        self.id = cursor.lastrowid
+
+    @classmethod
+    def get(cls, user_id: int, conversation_id: int) -> Optional['Conversation']:
+        """获取用户的会话"""
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+        row = db.fetch_one(
+            "SELECT * FROM conversations WHERE id = ? AND user_id = ?",
+            (conversation_id, user_id)
+        )
+        return cls.from_row(row) if row else None
+
+    @classmethod
+    def list_page(cls, user_id: int, limit: int, before_id: Optional[int] = None) -> List['Conversation']:
+        """按 ID 倒序分页（游标为上一页最后一条的 ID）"""
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+        if before_id is None:
+            rows = db.fetch_all(
+                "SELECT * FROM conversations WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+                (user_id, limit)
+            )
+        else:
+            rows = db.fetch_all(
+                "SELECT * FROM conversations WHERE user_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                (user_id, before_id, limit)
+            )
+        return [cls.from_row(row) for row in rows]
+
+    @classmethod
+    def add_totals(cls, conversation_id: int, messages: int, tokens: int, updated_at: str) -> None:
+        """累加消息数和 token 数"""
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+        db.execute_query(
+            """
+            UPDATE conversations
+            SET message_count = message_count + ?, token_total = token_total + ?, updated_at = ?
+            WHERE id = ?
+            """,
+            (messages, tokens, updated_at, conversation_id)
+        )
+
+    @classmethod
+    def delete(cls, user_id: int, conversation_id: int) -> bool:
+        """删除会话（消息随外键级联删除）"""
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+        cursor = db.execute_query(
+            "DELETE FROM conversations WHERE id = ? AND user_id = ?",
+            (conversation_id, user_id)
+        )
+        return cursor.rowcount > 0
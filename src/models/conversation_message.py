@@ -0,0 +1,138 @@
+"""
+会话消息模型
+"""
+import json
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from .base import BaseModel
+
+
+class ConversationMessage(BaseModel):
+    """会话消息模型类
+
+    tokens 为写入时估算的 token 数，token_offset 为会话中此前所有消息的
+    token 数之和。组装上下文时按 (conversation_id, token_offset) 索引
+    直接取出预算内最近的消息，不需要读取整个历史。
+    """
+
+    def __init__(self,
+                 id: Optional[int] = None,
+                 conversation_id: Optional[int] = None,
+                 role: str = "user",
+                 content: Any = "",
+                 tokens: int = 0,
+                 token_offset: int = 0,
+                 created_at: Optional[str] = None):
+        self.id = id
+        self.conversation_id = conversation_id
+        self.role = role
+        self.content = content
+        self.tokens = tokens
+        self.token_offset = token_offset
+        self.created_at = created_at or datetime.utcnow().isoformat()
+
+    @classmethod
+    def get_table_name(cls) -> str:
+        return "conversation_messages"
+
+    @classmethod
+    def get_create_table_sql(cls) -> str:
+        return """
+        CREATE TABLE IF NOT EXISTS conversation_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            tokens INTEGER NOT NULL,
+            token_offset INTEGER NOT NULL,
+            created_at TEXT NOT NULL,
+            FOREIGN KEY(conversation_id) REFERENCES conversations(id) ON DELETE CASCADE
+        );
+        """
+
+    @classmethod
+    def from_row(cls, row) -> 'ConversationMessage':
+        return cls(
+            id=row["id"],
+            conversation_id=row["conversation_id"],
+            role=row["role"],
+            content=json.loads(row["content"]),
+            tokens=row["tokens"],
+            token_offset=row["token_offset"],
+            created_at=row["created_at"]
+        )
+
+    def to_dict(self) -> Dict:
+        return {
+            "id": self.id,
+            "conversation_id": self.conversation_id,
+            "role": self.role,
+            "content": self.content,
+            "tokens": self.tokens,
+            "token_offset": self.token_offset,
+            "created_at": self.created_at
+        }
+
+    def to_message(self) -> Dict[str, Any]:
+        """转换为上游请求中的消息格式"""
+        return {"role": self.role, "content": self.content}
+
+    def as_row(self) -> Tuple:
+        """转换为批量插入使用的参数元组"""
+        return (self.conversation_id, self.role, json.dumps(self.content, ensure_ascii=False),
+                self.tokens, self.token_offset, self.created_at)
+
+    @classmethod
+    def insert_batch(cls, messages: List['ConversationMessage']) -> None:
+        """批量写入消息"""
+        if not messages:
+            return
+
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+        db.execute_many(
+            """
+            INSERT INTO conversation_messages
+                (conversation_id, role, content, tokens, token_offset, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            [message.as_row() for message in messages]
+        )
+
+    @classmethod
+    def list_since_offset(cls, conversation_id: int, min_offset: int) -> List['ConversationMessage']:
+        """获取 token_offset 不小于 min_offset 的消息（即最近的若干条），按时间顺序"""
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+        rows = db.fetch_all(
+            """
+            SELECT * FROM conversation_messages
+            WHERE conversation_id = ? AND token_offset >= ?
+            ORDER BY token_offset
+            """,
+            (conversation_id, min_offset)
+        )
+        return [cls.from_row(row) for row in rows]
+
+    @classmethod
+    def list_page(cls,
+                  conversation_id: int,
+                  limit: int,
+                  before_id: Optional[int] = None) -> List['ConversationMessage']:
+        """按 ID 倒序分页（游标为上一页最后一条的 ID）"""
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+        if before_id is None:
+            rows = db.fetch_all(
+                "SELECT * FROM conversation_messages WHERE conversation_id = ? "
+                "ORDER BY id DESC LIMIT ?",
+                (conversation_id, limit)
+            )
+        else:
+            rows = db.fetch_all(
+                "SELECT * FROM conversation_messages WHERE conversation_id = ? AND id < ? "
+                "ORDER BY id DESC LIMIT ?",
+                (conversation_id, before_id, limit)
+            )
+        return [cls.from_row(row) for row in rows]
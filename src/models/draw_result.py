@@ -0,0 +1,224 @@
+"""
+绘图结果模型
+"""
+import json
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from .base import BaseModel
+
+# 上游返回这些状态时任务结束，结果不再变化
+TERMINAL_STATUSES = ("succeeded", "failed")
+
+
+def parse_progress(value: Any) -> Optional[int]:
+    """解析上游返回的进度（限制在 0-100），无法解析时返回 None"""
+    if value is None or value == "":
+        return 0
+    try:
+        progress = int(float(value))
+    except (TypeError, ValueError, OverflowError):
+        return None
+    return max(0, min(progress, 100))
+
+
+class DrawResult(BaseModel):
+    """绘图结果模型类（上游回调和已结束结果的缓存，按绘图ID存储）"""
+
+    def __init__(self,
+                 draw_id: str = "",
+                 user_id: Optional[int] = None,
+                 status: str = "submitted",
+                 progress: int = 0,
+                 payload: Optional[Dict[str, Any]] = None,
+                 callback_nonce: Optional[str] = None,
+                 created_at: Optional[str] = None,
+                 updated_at: Optional[str] = None):
+        self.draw_id = draw_id
+        self.user_id = user_id
+        self.status = status
+        self.progress = progress
+        self.payload = payload
+        self.callback_nonce = callback_nonce
+        self.created_at = created_at or datetime.utcnow().isoformat()
+        self.updated_at = updated_at or self.created_at
+
+    @classmethod
+    def get_table_name(cls) -> str:
+        return "draw_results"
+
+    @classmethod
+    def get_create_table_sql(cls) -> str:
+        return """
+        CREATE TABLE IF NOT EXISTS draw_results (
+            draw_id TEXT PRIMARY KEY,
+            user_id INTEGER,
+            status TEXT NOT NULL DEFAULT 'submitted',
+            progress INTEGER NOT NULL DEFAULT 0,
+            payload TEXT,
+            callback_nonce TEXT,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL,
+            FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
+        );
+        """
+
+    @classmethod
+    def from_row(cls, row) -> 'DrawResult':
+        return cls(
+            draw_id=row["draw_id"],
+            user_id=row["user_id"],
+            status=row["status"],
+            progress=row["progress"],
+            payload=json.loads(row["payload"]) if row["payload"] else None,
+            callback_nonce=row["callback_nonce"],
+            created_at=row["created_at"],
+            updated_at=row["updated_at"]
+        )
+
+    def to_dict(self) -> Dict:
+        return {
+            "draw_id": self.draw_id,
+            "user_id": self.user_id,
+            "status": self.status,
+            "progress": self.progress,
+            "payload": self.payload,
+            "callback_nonce": self.callback_nonce,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at
+        }
+
+    @property
+    def terminal(self) -> bool:
+        return self.status in TERMINAL_STATUSES
+
+    def to_result(self) -> Dict[str, Any]:
+        """转换为与 /v1/draw/result 相同格式的响应"""
+        return {"code": 0, "msg": "success", "data": self.payload}
+
+    @classmethod
+    def get_by_draw_id(cls, draw_id: str) -> Optional['DrawResult']:
+        """根据绘图ID获取结果"""
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+        row = db.fetch_one("SELECT * FROM draw_results WHERE draw_id = ?", (draw_id,))
+        return cls.from_row(row) if row else None
+
+    @classmethod
+    def register(cls, draw_id: str, user_id: Optional[int], callback_nonce: str) -> None:
+        """登记以回调模式提交的任务及其回调地址中的随机数（已存在时忽略）"""
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+        now = datetime.utcnow().isoformat()
+        db.execute_query(
+            """
+            INSERT OR IGNORE INTO draw_results (draw_id, user_id, callback_nonce, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            (draw_id, user_id, callback_nonce, now, now)
+        )
+
+    @classmethod
+    def update_from_callback(cls,
+                             draw_id: str,
+                             user_id: Optional[int],
+                             callback_nonce: str,
+                             payload: Dict[str, Any]) -> bool:
+        """写入回调结果，只更新 register 登记的、回调地址与之对应的任务，返回是否更新
+
+        已结束的结果不会被之后到达的进度回调覆盖，乱序到达的较小进度也会被忽略。
+        """
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+        status = str(payload.get("status") or "running")
+        progress = parse_progress(payload.get("progress")) or 0
+        cursor = db.execute_query(
+            """
+            UPDATE draw_results
+            SET status = ?, progress = ?, payload = ?, updated_at = ?
+            WHERE draw_id = ? AND user_id IS ? AND callback_nonce = ?
+              AND status NOT IN ('succeeded', 'failed')
+              AND (? IN ('succeeded', 'failed') OR ? >= progress)
+            """,
+            (
+                status,
+                progress,
+                json.dumps(payload, ensure_ascii=False),
+                datetime.utcnow().isoformat(),
+                draw_id,
+                user_id,
+                callback_nonce,
+                status,
+                progress,
+            )
+        )
+        return cursor.rowcount > 0
+
+    @classmethod
+    def store(cls, draw_id: str, user_id: Optional[int], payload: Dict[str, Any]) -> bool:
+        """写入上游返回的结果，返回是否更新
+
+        已结束（succeeded/failed）的结果不会被之后到达的进度回调覆盖，
+        乱序到达的较小进度也会被忽略。
+        """
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+        now = datetime.utcnow().isoformat()
+        cursor = db.execute_query(
+            """
+            INSERT INTO draw_results (draw_id, user_id, status, progress, payload, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(draw_id) DO UPDATE SET
+                status = excluded.status,
+                progress = excluded.progress,
+                payload = excluded.payload,
+                updated_at = excluded.updated_at
+            WHERE draw_results.user_id IS excluded.user_id
+              AND draw_results.status NOT IN ('succeeded', 'failed')
+              AND (excluded.status IN ('succeeded', 'failed')
+                   OR excluded.progress >= draw_results.progress)
+            """,
+            (
+                draw_id,
+                user_id,
+                str(payload.get("status") or "running"),
+                parse_progress(payload.get("progress")) or 0,
+                json.dumps(payload, ensure_ascii=False),
+                now,
+                now,
+            )
+        )
+        return cursor.rowcount > 0
+
+    @classmethod
+    def delete_expired(cls, updated_before: str, max_rows: int, stale_before: str) -> None:
+        """删除早于指定时间的已结束结果，并只保留最近更新的 max_rows 条（max_rows <= 0 时不限制）
+
+        回调模式登记的未结束任务也保存在该表中，不按结果的有效期和数量清理，
+        只删除 stale_before 之前就不再更新的（上游不会再回调的任务）。
+        """
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+        with db.transaction():
+            db.execute_query(
+                "DELETE FROM draw_results "
+                "WHERE updated_at < ? AND status IN ('succeeded', 'failed')",
+                (updated_before,)
+            )
+            db.execute_query(
+                "DELETE FROM draw_results WHERE updated_at < ?",
+                (stale_before,)
+            )
+            if max_rows <= 0:
+                return
+            db.execute_query(
+                """
+                DELETE FROM draw_results
+                WHERE status IN ('succeeded', 'failed') AND updated_at < (
+                    SELECT updated_at FROM draw_results
+                    WHERE status IN ('succeeded', 'failed')
+                    ORDER BY updated_at DESC LIMIT 1 OFFSET ?
+                )
+                """,
+                (max_rows - 1,)
+            )
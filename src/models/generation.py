@@ -0,0 +1,250 @@
+"""
+生成记录模型
+"""
+import json
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from .base import BaseModel
+
+
+class Generation(BaseModel):
+    """生成记录模型类
+
+    每次提交的绘图任务一条记录：提交时写入参数、绘图ID和提交所用的密钥ID
+    （启用密钥池时），任务结束后补充状态、结果地址和完成时间。按 (user_id, id) 索引做游标分页，提示词
+    通过 FTS5（trigram 分词）全文检索。
+    """
+
+    def __init__(self,
+                 id: Optional[int] = None,
+                 user_id: Optional[int] = None,
+                 draw_id: str = "",
+                 model: str = "",
+                 prompt: str = "",
+                 params: Optional[Dict[str, Any]] = None,
+                 status: str = "submitted",
+                 result_urls: Optional[List[str]] = None,
+                 failure_reason: str = "",
+                 submit_ms: int = 0,
+                 api_key_id: Optional[str] = None,
+                 created_at: Optional[str] = None,
+                 finished_at: Optional[str] = None):
+        self.id = id
+        self.user_id = user_id
+        self.draw_id = draw_id
+        self.model = model
+        self.prompt = prompt
+        self.params = params or {}
+        self.status = status
+        self.result_urls = result_urls or []
+        self.failure_reason = failure_reason
+        self.submit_ms = submit_ms
+        self.api_key_id = api_key_id
+        self.created_at = created_at or datetime.utcnow().isoformat()
+        self.finished_at = finished_at
+
+    @classmethod
+    def get_table_name(cls) -> str:
+        return "generations"
+
+    @classmethod
+    def get_create_table_sql(cls) -> str:
+        return """
+        CREATE TABLE IF NOT EXISTS generations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            draw_id TEXT NOT NULL,
+            model TEXT NOT NULL DEFAULT '',
+            prompt TEXT NOT NULL,
+            params TEXT NOT NULL DEFAULT '{}',
+            status TEXT NOT NULL DEFAULT 'submitted',
+            result_urls TEXT NOT NULL DEFAULT '[]',
+            failure_reason TEXT NOT NULL DEFAULT '',
+            submit_ms INTEGER NOT NULL DEFAULT 0,
+            api_key_id TEXT,
+            created_at TEXT NOT NULL,
+            finished_at TEXT,
+            FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
+        );
+        """
+
+    @classmethod
+    def from_row(cls, row) -> 'Generation':
+        return cls(
+            id=row["id"],
+            user_id=row["user_id"],
+            draw_id=row["draw_id"],
+            model=row["model"],
+            prompt=row["prompt"],
+            params=json.loads(row["params"]) if row["params"] else {},
+            status=row["status"],
+            result_urls=json.loads(row["result_urls"]) if row["result_urls"] else [],
+            failure_reason=row["failure_reason"],
+            submit_ms=row["submit_ms"],
+            api_key_id=row["api_key_id"],
+            created_at=row["created_at"],
+            finished_at=row["finished_at"]
+        )
+
+    def to_dict(self) -> Dict:
+        return {
+            "id": self.id,
+            "user_id": self.user_id,
+            "draw_id": self.draw_id,
+            "model": self.model,
+            "prompt": self.prompt,
+            "params": self.params,
+            "status": self.status,
+            "result_urls": self.result_urls,
+            "failure_reason": self.failure_reason,
+            "submit_ms": self.submit_ms,
+            "api_key_id": self.api_key_id,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at
+        }
+
+    def as_row(self) -> Tuple:
+        """转换为批量插入使用的参数元组"""
+        return (self.user_id, self.draw_id, self.model, self.prompt,
+                json.dumps(self.params, ensure_ascii=False), self.status,
+                self.submit_ms, self.api_key_id, self.created_at)
+
+    @classmethod
+    def insert_batch(cls, generations: List['Generation']) -> None:
+        """批量写入新提交的任务（绘图ID已存在时忽略）"""
+        if not generations:
+            return
+
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+        db.execute_many(
+            """
+            INSERT OR IGNORE INTO generations
+                (user_id, draw_id, model, prompt, params, status, submit_ms, api_key_id, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            [generation.as_row() for generation in generations]
+        )
+
+    @classmethod
+    def finish_batch(cls,
+                     updates: List[Tuple[str, List[str], str, str, int, str]]
+                     ) -> List[Tuple[str, List[str], str, str, int, str]]:
+        """批量写入任务结果，参数为 (状态, 结果地址, 失败原因, 完成时间, 用户ID, 绘图ID)
+
+        返回找不到对应提交记录的结果（提交记录可能还在其他 worker 的缓冲中）。
+        """
+        if not updates:
+            return []
+
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+        unmatched = []
+        for status, urls, reason, finished_at, user_id, draw_id in updates:
+            cursor = db.execute_query(
+                """
+                UPDATE generations
+                SET status = ?, result_urls = ?, failure_reason = ?, finished_at = ?
+                WHERE user_id = ? AND draw_id = ? AND finished_at IS NULL
+                """,
+                (status, json.dumps(urls, ensure_ascii=False), reason, finished_at, user_id, draw_id)
+            )
+            if cursor.rowcount == 0 and db.fetch_one(
+                "SELECT 1 FROM generations WHERE user_id = ? AND draw_id = ?",
+                (user_id, draw_id)
+            ) is None:
+                unmatched.append((status, urls, reason, finished_at, user_id, draw_id))
+        return unmatched
+
+    @classmethod
+    def get_api_key_id(cls, user_id: int, draw_id: str) -> Optional[str]:
+        """获取提交任务所用的密钥ID（未记录时返回 None）"""
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+        row = db.fetch_one(
+            "SELECT api_key_id FROM generations WHERE draw_id = ? AND user_id = ?",
+            (draw_id, user_id)
+        )
+        return row["api_key_id"] if row else None
+
+    @classmethod
+    def list_page(cls,
+                  user_id: int,
+                  limit: int,
+                  before_id: Optional[int] = None,
+                  status: Optional[str] = None,
+                  model: Optional[str] = None) -> List['Generation']:
+        """按 ID 倒序分页（游标为上一页最后一条的 ID）"""
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+
+        conditions = ["user_id = ?"]
+        params: List[Any] = [user_id]
+        if before_id is not None:
+            conditions.append("id < ?")
+            params.append(before_id)
+        if status:
+            conditions.append("status = ?")
+            params.append(status)
+        if model:
+            conditions.append("model = ?")
+            params.append(model)
+        params.append(limit)
+
+        rows = db.fetch_all(
+            f"SELECT * FROM generations WHERE {' AND '.join(conditions)} "
+            "ORDER BY id DESC LIMIT ?",
+            tuple(params)
+        )
+        return [cls.from_row(row) for row in rows]
+
+    @classmethod
+    def has_fts(cls) -> bool:
+        """是否可以使用全文索引（SQLite 未编译 FTS5 时迁移会跳过建表）"""
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+        row = db.fetch_one(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'generations_fts'"
+        )
+        return row is not None
+
+    @classmethod
+    def search_page(cls,
+                    user_id: int,
+                    query: str,
+                    limit: int,
+                    before_id: Optional[int] = None,
+                    use_fts: bool = True) -> List['Generation']:
+        """按提示词搜索并分页
+
+        trigram 分词要求关键词至少 3 个字符，更短的关键词或没有全文索引时
+        使用 LIKE 在该用户的记录中扫描。
+        """
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+
+        cursor_sql = "AND g.id < ?" if before_id is not None else ""
+        cursor_params: Tuple = (before_id,) if before_id is not None else ()
+
+        if use_fts and len(query) >= 3:
+            rows = db.fetch_all(
+                f"""
+                SELECT g.* FROM generations_fts f
+                JOIN generations g ON g.id = f.rowid
+                WHERE generations_fts MATCH ? AND g.user_id = ? {cursor_sql}
+                ORDER BY g.id DESC LIMIT ?
+                """,
+                ('"' + query.replace('"', '""') + '"', user_id) + cursor_params + (limit,)
+            )
+        else:
+            pattern = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            rows = db.fetch_all(
+                f"""
+                SELECT g.* FROM generations g
+                WHERE g.user_id = ? AND g.prompt LIKE ? ESCAPE '\\' {cursor_sql}
+                ORDER BY g.id DESC LIMIT ?
+                """,
+                (user_id, pattern) + cursor_params + (limit,)
+            )
+        return [cls.from_row(row) for row in rows]
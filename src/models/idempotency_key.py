@@ -0,0 +1,119 @@
+"""
+幂等键模型
+"""
+import json
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from .base import BaseModel
+
+
+class IdempotencyKey(BaseModel):
+    """幂等键模型类
+
+    记录客户端通过 Idempotency-Key 请求头提交的请求：先以处理中状态
+    （response 为空）占位，上游成功返回后保存响应，重试时直接返回该响应。
+    """
+
+    def __init__(self,
+                 user_id: int = 0,
+                 key: str = "",
+                 request_hash: str = "",
+                 response: Optional[Dict[str, Any]] = None,
+                 created_at: Optional[str] = None):
+        self.user_id = user_id
+        self.key = key
+        self.request_hash = request_hash
+        self.response = response
+        self.created_at = created_at or datetime.utcnow().isoformat()
+
+    @classmethod
+    def get_table_name(cls) -> str:
+        return "idempotency_keys"
+
+    @classmethod
+    def get_create_table_sql(cls) -> str:
+        return """
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            user_id INTEGER NOT NULL,
+            key TEXT NOT NULL,
+            request_hash TEXT NOT NULL,
+            response TEXT,
+            created_at TEXT NOT NULL,
+            PRIMARY KEY (user_id, key)
+        );
+        """
+
+    @classmethod
+    def from_row(cls, row) -> 'IdempotencyKey':
+        return cls(
+            user_id=row["user_id"],
+            key=row["key"],
+            request_hash=row["request_hash"],
+            response=json.loads(row["response"]) if row["response"] else None,
+            created_at=row["created_at"]
+        )
+
+    def to_dict(self) -> Dict:
+        return {
+            "user_id": self.user_id,
+            "key": self.key,
+            "request_hash": self.request_hash,
+            "response": self.response,
+            "created_at": self.created_at
+        }
+
+    @classmethod
+    def get(cls, user_id: int, key: str) -> Optional['IdempotencyKey']:
+        """获取幂等键记录"""
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+        row = db.fetch_one(
+            "SELECT * FROM idempotency_keys WHERE user_id = ? AND key = ?",
+            (user_id, key)
+        )
+        return cls.from_row(row) if row else None
+
+    @classmethod
+    def reserve(cls, user_id: int, key: str, request_hash: str) -> bool:
+        """占用幂等键，已被占用时返回 False"""
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+        cursor = db.execute_query(
+            """
+            INSERT OR IGNORE INTO idempotency_keys (user_id, key, request_hash, created_at)
+            VALUES (?, ?, ?, ?)
+            """,
+            (user_id, key, request_hash, datetime.utcnow().isoformat())
+        )
+        return cursor.rowcount > 0
+
+    @classmethod
+    def complete(cls, user_id: int, key: str, response: Dict[str, Any]) -> None:
+        """保存请求的响应"""
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+        db.execute_query(
+            "UPDATE idempotency_keys SET response = ? WHERE user_id = ? AND key = ?",
+            (json.dumps(response, ensure_ascii=False), user_id, key)
+        )
+
+    @classmethod
+    def release(cls, user_id: int, key: str) -> None:
+        """释放幂等键（请求失败后允许客户端重试）"""
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+        db.execute_query(
+            "DELETE FROM idempotency_keys WHERE user_id = ? AND key = ?",
+            (user_id, key)
+        )
+
+    @classmethod
+    def delete_before(cls, created_before: str) -> None:
+        """删除早于指定时间的记录"""
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+        db.execute_query(
+            "DELETE FROM idempotency_keys WHERE created_at < ?",
+            (created_before,)
+        )
@@ -0,0 +1,63 @@
+"""
+API密钥版本模型
+"""
+from typing import Dict, Optional
+
+from .base import BaseModel
+
+
+class KeyVersion(BaseModel):
+    """API密钥版本号模型类
+
+    用户的密钥发生变化时版本号加一，各个 worker 进程通过比较版本号
+    判断本地缓存的密钥是否已经失效。
+    """
+
+    def __init__(self, user_id: Optional[int] = None, version: int = 0):
+        self.user_id = user_id
+        self.version = version
+
+    @classmethod
+    def get_table_name(cls) -> str:
+        return "api_key_versions"
+
+    @classmethod
+    def get_create_table_sql(cls) -> str:
+        return """
+        CREATE TABLE IF NOT EXISTS api_key_versions (
+            user_id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
+        );
+        """
+
+    @classmethod
+    def from_row(cls, row) -> 'KeyVersion':
+        return cls(user_id=row["user_id"], version=row["version"])
+
+    def to_dict(self) -> Dict:
+        return {"user_id": self.user_id, "version": self.version}
+
+    @classmethod
+    def get_version(cls, user_id: int) -> int:
+        """获取用户密钥的当前版本号"""
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+        row = db.fetch_one(
+            "SELECT version FROM api_key_versions WHERE user_id = ?",
+            (user_id,)
+        )
+        return row["version"] if row else 0
+
+    @classmethod
+    def bump(cls, user_id: int) -> None:
+        """用户密钥变更后递增版本号"""
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+        db.execute_query(
+            """
+            INSERT INTO api_key_versions (user_id, version) VALUES (?, 1)
+            ON CONFLICT(user_id) DO UPDATE SET version = version + 1
+            """,
+            (user_id,)
+        )
@@ -0,0 +1,100 @@
+"""
+使用事件模型
+"""
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from .base import BaseModel
+
+
+class UsageEvent(BaseModel):
+    """上游调用事件模型类（仅追加写入）"""
+
+    def __init__(self,
+                 id: Optional[int] = None,
+                 user_id: Optional[int] = None,
+                 endpoint: str = "",
+                 model: str = "",
+                 status: int = 0,
+                 latency_ms: int = 0,
+                 created_at: Optional[str] = None):
+        self.id = id
+        self.user_id = user_id
+        self.endpoint = endpoint
+        self.model = model
+        self.status = status
+        self.latency_ms = latency_ms
+        self.created_at = created_at or datetime.utcnow().isoformat()
+
+    @classmethod
+    def get_table_name(cls) -> str:
+        return "usage_events"
+
+    @classmethod
+    def get_create_table_sql(cls) -> str:
+        return """
+        CREATE TABLE IF NOT EXISTS usage_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            endpoint TEXT NOT NULL,
+            model TEXT NOT NULL DEFAULT '',
+            status INTEGER NOT NULL,
+            latency_ms INTEGER NOT NULL,
+            created_at TEXT NOT NULL,
+            FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
+        );
+        """
+
+    @classmethod
+    def from_row(cls, row) -> 'UsageEvent':
+        return cls(
+            id=row["id"],
+            user_id=row["user_id"],
+            endpoint=row["endpoint"],
+            model=row["model"],
+            status=row["status"],
+            latency_ms=row["latency_ms"],
+            created_at=row["created_at"]
+        )
+
+    def to_dict(self) -> Dict:
+        return {
+            "id": self.id,
+            "user_id": self.user_id,
+            "endpoint": self.endpoint,
+            "model": self.model,
+            "status": self.status,
+            "latency_ms": self.latency_ms,
+            "created_at": self.created_at
+        }
+
+    def as_row(self) -> Tuple:
+        """转换为批量插入使用的参数元组"""
+        return (self.user_id, self.endpoint, self.model,
+                self.status, self.latency_ms, self.created_at)
+
+    @classmethod
+    def insert_batch(cls, events: List['UsageEvent']) -> None:
+        """批量追加事件"""
+        if not events:
+            return
+
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+        db.execute_many(
+            """
+            INSERT INTO usage_events (user_id, endpoint, model, status, latency_ms, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            [event.as_row() for event in events]
+        )
+
+    @classmethod
+    def delete_before(cls, created_before: str) -> None:
+        """删除早于指定时间的事件"""
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+        db.execute_query(
+            "DELETE FROM usage_events WHERE created_at < ?",
+            (created_before,)
+        )
@@ -0,0 +1,184 @@
+"""
+使用统计汇总模型
+"""
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from .base import BaseModel
+
+# 汇总粒度 -> 时间桶格式
+GRANULARITIES = {
+    "minute": "%Y-%m-%dT%H:%M:00",
+    "hour": "%Y-%m-%dT%H:00:00",
+    "day": "%Y-%m-%dT00:00:00",
+}
+
+# 支持的分组维度
+GROUP_FIELDS = ("endpoint", "model")
+
+
+def bucket_start(moment: datetime, granularity: str) -> str:
+    """计算时间所在的时间桶起点"""
+    return moment.strftime(GRANULARITIES[granularity])
+
+
+class UsageRollup(BaseModel):
+    """按分钟/小时/天汇总的使用统计模型类
+
+    每条记录对应 (粒度, 用户, 时间桶, 接口, 模型) 的累计值，由写缓冲
+    在写入原始事件时同步增量累加，范围查询只需读取汇总表。
+    """
+
+    def __init__(self,
+                 granularity: str = "hour",
+                 user_id: Optional[int] = None,
+                 bucket_start: str = "",
+                 endpoint: str = "",
+                 model: str = "",
+                 calls: int = 0,
+                 errors: int = 0,
+                 rate_limited: int = 0,
+                 latency_total_ms: int = 0,
+                 latency_max_ms: int = 0):
+        self.granularity = granularity
+        self.user_id = user_id
+        self.bucket_start = bucket_start
+        self.endpoint = endpoint
+        self.model = model
+        self.calls = calls
+        self.errors = errors
+        self.rate_limited = rate_limited
+        self.latency_total_ms = latency_total_ms
+        self.latency_max_ms = latency_max_ms
+
+    @classmethod
+    def get_table_name(cls) -> str:
+        return "usage_rollups"
+
+    @classmethod
+    def get_create_table_sql(cls) -> str:
+        return """
+        CREATE TABLE IF NOT EXISTS usage_rollups (
+            granularity TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            bucket_start TEXT NOT NULL,
+            endpoint TEXT NOT NULL,
+            model TEXT NOT NULL DEFAULT '',
+            calls INTEGER NOT NULL DEFAULT 0,
+            errors INTEGER NOT NULL DEFAULT 0,
+            rate_limited INTEGER NOT NULL DEFAULT 0,
+            latency_total_ms INTEGER NOT NULL DEFAULT 0,
+            latency_max_ms INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (granularity, user_id, bucket_start, endpoint, model),
+            FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
+        ) WITHOUT ROWID;
+        """
+
+    @classmethod
+    def from_row(cls, row) -> 'UsageRollup':
+        return cls(
+            granularity=row["granularity"],
+            user_id=row["user_id"],
+            bucket_start=row["bucket_start"],
+            endpoint=row["endpoint"],
+            model=row["model"],
+            calls=row["calls"],
+            errors=row["errors"],
+            rate_limited=row["rate_limited"],
+            latency_total_ms=row["latency_total_ms"],
+            latency_max_ms=row["latency_max_ms"]
+        )
+
+    def to_dict(self) -> Dict:
+        return {
+            "granularity": self.granularity,
+            "bucket_start": self.bucket_start,
+            "endpoint": self.endpoint,
+            "model": self.model,
+            "calls": self.calls,
+            "errors": self.errors,
+            "rate_limited": self.rate_limited,
+            "avg_latency_ms": round(self.latency_total_ms / self.calls) if self.calls else 0,
+            "max_latency_ms": self.latency_max_ms
+        }
+
+    @classmethod
+    def merge_batch(cls, rows: List[Tuple]) -> None:
+        """增量累加汇总值
+
+        rows 为 (粒度, 用户ID, 时间桶, 接口, 模型, 次数, 错误数, 限流数,
+        总延迟, 最大延迟) 列表。
+        """
+        if not rows:
+            return
+
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+        db.execute_many(
+            """
+            INSERT INTO usage_rollups (
+                granularity, user_id, bucket_start, endpoint, model,
+                calls, errors, rate_limited, latency_total_ms, latency_max_ms
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(granularity, user_id, bucket_start, endpoint, model) DO UPDATE SET
+                calls = calls + excluded.calls,
+                errors = errors + excluded.errors,
+                rate_limited = rate_limited + excluded.rate_limited,
+                latency_total_ms = latency_total_ms + excluded.latency_total_ms,
+                latency_max_ms = MAX(latency_max_ms, excluded.latency_max_ms)
+            """,
+            rows
+        )
+
+    @classmethod
+    def query_range(cls,
+                    user_id: int,
+                    granularity: str,
+                    start: str,
+                    end: str,
+                    group_by: Tuple[str, ...] = ()) -> List['UsageRollup']:
+        """按时间范围查询汇总数据，可按接口/模型分组"""
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+
+        group_columns = "".join(f", {field}" for field in group_by)
+        rows = db.fetch_all(
+            f"""
+            SELECT bucket_start{group_columns},
+                   SUM(calls) AS calls,
+                   SUM(errors) AS errors,
+                   SUM(rate_limited) AS rate_limited,
+                   SUM(latency_total_ms) AS latency_total_ms,
+                   MAX(latency_max_ms) AS latency_max_ms
+            FROM usage_rollups
+            WHERE granularity = ? AND user_id = ? AND bucket_start >= ? AND bucket_start < ?
+            GROUP BY bucket_start{group_columns}
+            ORDER BY bucket_start ASC
+            """,
+            (granularity, user_id, start, end)
+        )
+        return [
+            cls(
+                granularity=granularity,
+                user_id=user_id,
+                bucket_start=row["bucket_start"],
+                endpoint=row["endpoint"] if "endpoint" in group_by else "",
+                model=row["model"] if "model" in group_by else "",
+                calls=row["calls"],
+                errors=row["errors"],
+                rate_limited=row["rate_limited"],
+                latency_total_ms=row["latency_total_ms"],
+                latency_max_ms=row["latency_max_ms"]
+            )
+            for row in rows
+        ]
+
+    @classmethod
+    def delete_before(cls, granularity: str, bucket_before: str) -> None:
+        """删除指定粒度下早于某个时间桶的汇总数据"""
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+        db.execute_query(
+            "DELETE FROM usage_rollups WHERE granularity = ? AND bucket_start < ?",
+            (granularity, bucket_before)
+        )
@@ -2,7 +2,7 @@
 使用统计模型
 """
 from datetime import datetime
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Tuple
 
 from .base import BaseModel
 
@@ -79,12 +79,34 @@ class UsageStats(BaseModel):
         """记录一次使用"""
         self.total_calls += 1
         self.last_used_at = datetime.utcnow().isoformat()
-        self.save()
+        self.add_usage_batch([(self.user_id, 1, self.last_used_at)])
 
     @classmethod
     def record_usage_for_user(cls, user_id: int) -> None:
         """为用户记录一次使用"""
-        stats = cls.get_by_user_id(user_id)
-        if not stats:
-            stats = cls(user_id=user_id, total_calls=0)
-        stats.record_usage()
\ No newline at end of file
+        cls.add_usage_batch([(user_id, 1, datetime.utcnow().isoformat())])
+
+    @classmethod
+    def add_usage_batch(cls, items: List[Tuple[int, int, str]]) -> None:
+        """批量累加使用次数
+
+        items 为 (用户ID, 新增次数, 最近使用时间) 列表，在数据库内原子累加，
+        不需要先读取再写回。
+        """
+        if not items:
+            return
+
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+
+        with db.transaction():
+            db.execute_many(
+                """
+                INSERT INTO usage_stats (user_id, total_calls, last_used_at)
+                VALUES (?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    total_calls = total_calls + excluded.total_calls,
+                    last_used_at = MAX(COALESCE(last_used_at, ''), excluded.last_used_at)
+                """,
+                items
+            )
@@ -1,14 +1,23 @@
 """
 API路由
 """
-from typing import Any
+from typing import Any, Dict, Optional
 
-from flask import Blueprint, jsonify, request, Response, render_template
+from flask import Blueprint, jsonify, request, Response, render_template, send_file
 
 from .decorators import api_login_required, handle_api_errors, login_required
 from ..services.auth import get_auth_service
 from ..services.api_key_service import get_api_key_service
 from ..services.ai_service import get_ai_service
+from ..services.chat_cache import CachedChat, get_chat_cache
+from ..services.chat_stream_hub import get_chat_stream_hub
+from ..services.conversation_service import get_conversation_service
+from ..services.draw_poller import get_draw_poller
+from ..services.generation_service import get_generation_service
+from ..services.image_store import get_image_store
+from ..services.media_cache import CachedMedia, get_media_cache
+from ..services.usage_buffer import get_usage_buffer
+from ..services.usage_service import get_usage_service
 from ..models.usage_stats import UsageStats
 
 # 创建API蓝图
@@ -26,16 +35,38 @@ def profile() -> Any:
     user_id = auth_service.require_auth()
     active_value = api_key_service.get_active_api_key_value(user_id)
 
+    # 合并数据库中的统计与尚未写入的缓冲计数
+    stats = UsageStats.get_by_user_id(user_id) or UsageStats(user_id=user_id)
+    pending_calls, pending_last_used = get_usage_buffer().pending_for(user_id)
+    stats.total_calls += pending_calls
+    stats.last_used_at = pending_last_used or stats.last_used_at
+
     return jsonify({
         "hasKey": bool(active_value),
         "activeKeyMask": api_key_service.encryption.mask_key(active_value),
-        "usage": UsageStats.get_by_user_id(user_id).to_dict() if user_id else {
-            "totalCalls": 0,
-            "lastUsedAt": None
-        },
+        "usage": stats.to_dict(),
     })
 
 
+@api_bp.get("/usage")
+@api_login_required
+@handle_api_errors
+def usage() -> Any:
+    """按时间范围查询使用统计"""
+    auth_service = get_auth_service()
+    usage_service = get_usage_service()
+
+    user_id = auth_service.require_auth()
+    result = usage_service.query_usage(
+        user_id,
+        granularity=(request.args.get("granularity") or "hour").strip(),
+        start=request.args.get("start"),
+        end=request.args.get("end"),
+        group_by=request.args.get("group_by")
+    )
+    return jsonify(result)
+
+
 @api_bp.get("/keys")
 @api_login_required
 @handle_api_errors
@@ -95,18 +126,83 @@ def set_active_key() -> Any:
     return jsonify(result)
 
 
+def _multipart_draw_data() -> Dict[str, Any]:
+    """流式解析 multipart 形式的绘图请求：文本字段为绘图参数，文件部分为参考图"""
+    from ..config import get_config
+    from ..utils.errors import ApiError
+    config = get_config()
+
+    limit = config.max_reference_images * config.max_reference_image_bytes + 1024 * 1024
+    if request.content_length and request.content_length > limit:
+        raise ApiError("请求体过大", status_code=413)
+
+    fields, images = get_image_store().save_multipart(request.environ, config.max_reference_images)
+    data: Dict[str, Any] = {name: values[-1] for name, values in fields.items()}
+    data["urls"] = fields.get("urls", []) + [image.ref for image in images]
+    for name in ("stream", "shutProgress"):
+        data[name] = str(data.get(name, "")).strip().lower() in ("1", "true", "yes", "on")
+    return data
+
+
 @api_bp.post("/draw")
 @api_login_required
 @handle_api_errors
 def draw() -> Any:
-    """生成图像"""
+    """生成图像
+
+    除 JSON 外也接受 multipart/form-data：参考图作为文件部分上传，
+    按块写入磁盘，不会整张读入内存。
+    """
     auth_service = get_auth_service()
     ai_service = get_ai_service()
 
     user_id = auth_service.get_current_user_id()
-    data = request.get_json(force=True, silent=True) or {}
+    if request.mimetype == "multipart/form-data":
+        data = _multipart_draw_data()
+    else:
+        data = request.get_json(force=True, silent=True) or {}
+
+    if bool(data.get("stream", False)):
+        # 流式模式：上游进度事件到达后立即转发
+        response = ai_service.generate_image_stream(user_id, data)
+        return Response(
+            ai_service.generate_stream_response(response),
+            content_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+
+    result = ai_service.generate_image(user_id, data, request.headers.get("Idempotency-Key"))
+    return jsonify(result)
 
-    result = ai_service.generate_image(user_id, data)
+
+@api_bp.get("/generations")
+@api_login_required
+@handle_api_errors
+def list_generations() -> Any:
+    """分页列出生成记录（before 传上一页返回的 next）"""
+    user_id = get_auth_service().require_auth()
+    result = get_generation_service().list_generations(
+        user_id,
+        limit=request.args.get("limit"),
+        before=request.args.get("before"),
+        status=request.args.get("status"),
+        model=request.args.get("model")
+    )
+    return jsonify(result)
+
+
+@api_bp.get("/generations/search")
+@api_login_required
+@handle_api_errors
+def search_generations() -> Any:
+    """按提示词搜索生成记录"""
+    user_id = get_auth_service().require_auth()
+    result = get_generation_service().search_generations(
+        user_id,
+        request.args.get("q"),
+        limit=request.args.get("limit"),
+        before=request.args.get("before")
+    )
     return jsonify(result)
 
 
@@ -126,27 +222,324 @@ def result() -> Any:
     return jsonify(result)
 
 
+def _watched_draw_id() -> str:
+    """读取并校验要关注的绘图ID"""
+    from ..utils.validation import get_validation_service
+
+    draw_id = (request.args.get("id") or "").strip()
+    get_validation_service().validate_draw_id(draw_id)
+    return draw_id
+
+
+@api_bp.get("/result/stream")
+@api_login_required
+@handle_api_errors
+def result_stream() -> Any:
+    """以 SSE 推送图像生成状态（上游由服务端统一轮询）"""
+    auth_service = get_auth_service()
+    draw_poller = get_draw_poller()
+
+    user_id = auth_service.get_current_user_id()
+    draw_id = _watched_draw_id()
+    # 浏览器断线重连时会带上最后收到的事件ID
+    since = request.headers.get("Last-Event-ID") or request.args.get("since") or "0"
+
+    return Response(
+        draw_poller.iter_events(user_id, draw_id, since_version=int(since) if since.isdigit() else 0),
+        content_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@api_bp.get("/result/wait")
+@api_login_required
+@handle_api_errors
+def result_wait() -> Any:
+    """长轮询图像生成状态：状态版本超过 since 或超时后返回"""
+    auth_service = get_auth_service()
+    draw_poller = get_draw_poller()
+
+    user_id = auth_service.get_current_user_id()
+    draw_id = _watched_draw_id()
+    since = request.args.get("since", 0, type=int)
+    timeout = min(max(request.args.get("timeout", 25, type=float), 0), 60)
+
+    snapshot = draw_poller.watch(user_id, draw_id)
+    try:
+        snapshot = draw_poller.wait(user_id, draw_id, since, timeout) or snapshot
+    finally:
+        draw_poller.release(user_id, draw_id)
+    return jsonify(snapshot)
+
+
+@api_bp.post("/webhook/draw")
+@handle_api_errors
+def draw_webhook() -> Any:
+    """接收上游的绘图进度与结果回调（通过回调地址中的签名认证）"""
+    from ..services.webhook_service import get_webhook_service
+    webhook_service = get_webhook_service()
+
+    nonce = request.args.get("n", "")
+    user_id = webhook_service.verify(
+        request.args.get("uid", ""),
+        nonce,
+        request.args.get("sig", "")
+    )
+    data = request.get_json(force=True, silent=True) or {}
+
+    updated = webhook_service.handle_draw_callback(user_id, nonce, data)
+    return jsonify({"ok": True, "updated": updated})
+
+
+def _chat_stream_response(stream,
+                          after: int = 0,
+                          headers: Optional[Dict[str, str]] = None) -> Response:
+    """以 SSE 发送可续传的聊天流（事件ID为 "<流ID>-<序号>"）"""
+    response = Response(
+        get_chat_stream_hub().iter_events(stream, after),
+        content_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+            "X-Stream-Id": stream.stream_id,
+        }
+    )
+    response.headers.update(headers or {})
+    return response
+
+
+def _chat_cache_headers(data: Dict[str, Any], result: Any) -> Dict[str, str]:
+    """聊天缓存状态响应头（请求未启用缓存时为空）"""
+    if isinstance(result, CachedChat):
+        return {"X-Cache": "HIT", "Age": str(result.age)}
+    if get_chat_cache().requested(data):
+        return {"X-Cache": "MISS"}
+    return {}
+
+
 @api_bp.post("/chat")
 @api_login_required
 @handle_api_errors
 def chat() -> Any:
-    """聊天完成"""
+    """聊天完成
+
+    流式请求断线后带上 Last-Event-ID 重新发送即可从断点继续，不会再次请求上游。
+    带 conversationId 时 messages 只需包含本轮的新消息，上下文由服务端组装。
+    """
     auth_service = get_auth_service()
     ai_service = get_ai_service()
+    chat_stream_hub = get_chat_stream_hub()
+    conversation_service = get_conversation_service()
 
     user_id = auth_service.get_current_user_id()
+    last_event_id = request.headers.get("Last-Event-ID")
+    if last_event_id:
+        return _chat_stream_response(*chat_stream_hub.resume(user_id, last_event_id))
+
     data = request.get_json(force=True, silent=True) or {}
     stream = bool(data.get("stream", False))
+    turn, data = conversation_service.prepare(user_id, data)
+
+    result = ai_service.chat_completion(user_id, data)
+    headers = _chat_cache_headers(data, result)
+    if turn is not None:
+        headers["X-Context-Tokens"] = str(turn.context_tokens)
+    if isinstance(result, CachedChat):
+        if stream:
+            # 命中缓存时按流式格式重放，同样支持续传
+            chunks = conversation_service.capture(turn, result.iter_events())
+            return _chat_stream_response(chat_stream_hub.replay(user_id, chunks), headers=headers)
+        conversation_service.record_result(turn, result.result)
+        return jsonify(result.result), 200, headers
 
     if stream:
-        response = ai_service.chat_completion(user_id, data)
-        return Response(
-            ai_service.generate_stream_response(response),
-            content_type="text/event-stream"
-        )
+        relayed = ai_service.generate_stream_response(result)
+        chunks = conversation_service.capture(turn, relayed)
+        resumable = chat_stream_hub.relay(user_id, chunks, on_cancel=relayed.abort)
+        return _chat_stream_response(resumable, headers=headers)
+    else:
+        conversation_service.record_result(turn, result)
+        return jsonify(result), 200, headers
+
+
+@api_bp.get("/chat/stream")
+@api_login_required
+@handle_api_errors
+def chat_stream() -> Any:
+    """续传聊天流（EventSource 重连时会带上 Last-Event-ID）"""
+    auth_service = get_auth_service()
+
+    user_id = auth_service.get_current_user_id()
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get("lastEventId", "")
+    return _chat_stream_response(*get_chat_stream_hub().resume(user_id, last_event_id))
+
+
+@api_bp.post("/conversations")
+@api_login_required
+@handle_api_errors
+def create_conversation() -> Any:
+    """创建会话（之后的 /api/chat 请求带上 conversationId，只发送新消息）"""
+    user_id = get_auth_service().require_auth()
+    data = request.get_json(force=True, silent=True) or {}
+    return jsonify(get_conversation_service().create_conversation(user_id, data))
+
+
+@api_bp.get("/conversations")
+@api_login_required
+@handle_api_errors
+def list_conversations() -> Any:
+    """分页列出会话（before 传上一页返回的 next）"""
+    user_id = get_auth_service().require_auth()
+    result = get_conversation_service().list_conversations(
+        user_id,
+        limit=request.args.get("limit"),
+        before=request.args.get("before")
+    )
+    return jsonify(result)
+
+
+@api_bp.get("/conversations/<int:conversation_id>/messages")
+@api_login_required
+@handle_api_errors
+def list_conversation_messages(conversation_id: int) -> Any:
+    """从最新的消息开始分页列出会话消息"""
+    user_id = get_auth_service().require_auth()
+    result = get_conversation_service().list_messages(
+        user_id,
+        conversation_id,
+        limit=request.args.get("limit"),
+        before=request.args.get("before")
+    )
+    return jsonify(result)
+
+
+@api_bp.delete("/conversations/<int:conversation_id>")
+@api_login_required
+@handle_api_errors
+def delete_conversation(conversation_id: int) -> Any:
+    """删除会话"""
+    user_id = get_auth_service().require_auth()
+    get_conversation_service().delete_conversation(user_id, conversation_id)
+    return jsonify({"ok": True})
+
+
+@api_bp.post("/images")
+@api_login_required
+@handle_api_errors
+def upload_images() -> Any:
+    """上传参考图，返回 ref:<摘要> 形式的引用（相同内容只保存一份）
+
+    支持 multipart 的文件字段、image/* 请求体，或 JSON {"dataUrls": [...]}。
+    """
+    from ..config import get_config
+    from ..utils.errors import ApiError, ValidationError
+    config = get_config()
+    image_store = get_image_store()
+
+    limit = config.max_reference_images * config.max_reference_image_bytes * 2
+    if request.content_length and request.content_length > limit:
+        raise ApiError("请求体过大", status_code=413)
+
+    if request.mimetype == "multipart/form-data":
+        _, images = image_store.save_multipart(request.environ, config.max_reference_images)
+    elif request.mimetype.startswith("image/"):
+        images = [image_store.save(request.get_data())]
     else:
-        result = ai_service.chat_completion(user_id, data)
-        return jsonify(result)
+        data = request.get_json(force=True, silent=True) or {}
+        data_urls = data.get("dataUrls") or ([data["dataUrl"]] if data.get("dataUrl") else [])
+        images = [image_store.save_data_url(str(value)) for value in data_urls]
+
+    if not images:
+        raise ValidationError("请上传图片")
+    if len(images) > config.max_reference_images:
+        raise ValidationError(f"参考图数量最多 {config.max_reference_images} 张")
+
+    return jsonify({"images": [image.to_dict() for image in images]})
+
+
+@api_bp.get("/images/<filename>")
+@handle_api_errors
+def get_image(filename: str) -> Any:
+    """读取已上传的参考图（地址由内容摘要决定，供上游拉取，不需要登录）"""
+    image = get_image_store().get_by_filename(filename)
+    response = send_file(image.path, mimetype=image.content_type, conditional=True, etag=image.digest)
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+
+@api_bp.get("/media/<draw_id>/<int:index>")
+@api_login_required
+@handle_api_errors
+def get_media(draw_id: str, index: int) -> Any:
+    """读取生成结果图片（首次访问时从上游下载到本地缓存，?thumb=1 返回缩略图）
+
+    支持 ETag 条件请求和 Range 请求。
+    """
+    media_cache = get_media_cache()
+
+    user_id = get_auth_service().get_current_user_id()
+    media = media_cache.get(user_id, draw_id, index) or _fetch_media(user_id, draw_id, index)
+    try:
+        response = _send_media(media)
+    except FileNotFoundError:
+        # 文件在查找之后被淘汰，重新下载
+        response = _send_media(_fetch_media(user_id, draw_id, index))
+    response.headers["Cache-Control"] = "private, max-age=31536000, immutable"
+    return response
+
+
+def _fetch_media(user_id: Optional[int], draw_id: str, index: int) -> CachedMedia:
+    """按绘图结果中的地址下载图片到本地缓存"""
+    from ..utils.errors import NotFoundError
+
+    data = get_ai_service().get_image_result(user_id, draw_id).get("data") or {}
+    results = data.get("results") or [] if data.get("status") == "succeeded" else []
+    if index >= len(results) or not results[index].get("url"):
+        raise NotFoundError("图片不存在或尚未生成")
+    return get_media_cache().fetch(user_id, draw_id, index, results[index]["url"])
+
+
+def _send_media(media: CachedMedia) -> Response:
+    """发送缓存中的图片（?thumb=1 时发送缩略图）"""
+    if request.args.get("thumb"):
+        media = get_media_cache().thumbnail(media)
+    return send_file(media.path, mimetype=media.content_type, conditional=True, etag=media.etag)
+
+
+@api_bp.get("/metrics")
+@api_login_required
+@handle_api_errors
+def metrics() -> Any:
+    """获取运行指标"""
+    from ..services.database import get_db_manager
+    from ..services.http_client import get_http_client
+    from ..services.draw_result_cache import get_draw_result_cache
+    from ..services.idempotency_service import get_idempotency_service
+    from ..services.image_preprocessor import get_image_preprocessor
+    from ..services.generation_buffer import get_generation_buffer
+    from ..services.stream_relay import get_stream_relay
+    from ..services.key_pool import get_key_pool
+
+    db = get_db_manager()
+
+    return jsonify({
+        "database": dict(db.get_pool_stats(), schema_version=db.get_schema_version()),
+        "key_cache": get_api_key_service().key_cache.stats(),
+        "usage_buffer": get_usage_buffer().get_stats(),
+        "generation_buffer": get_generation_buffer().get_stats(),
+        "upstream": get_http_client().get_stats(),
+        "draw_poller": get_draw_poller().get_stats(),
+        "draw_result_cache": get_draw_result_cache().get_stats(),
+        "upstream_flights": get_ai_service().flights.get_stats(),
+        "key_pool": get_key_pool().get_stats(),
+        "stream_relay": get_stream_relay().get_stats(),
+        "chat_streams": get_chat_stream_hub().get_stats(),
+        "chat_cache": get_chat_cache().get_stats(),
+        "idempotency": get_idempotency_service().get_stats(),
+        "image_store": get_image_store().get_stats(),
+        "image_preprocessor": get_image_preprocessor().get_stats(),
+        "media_cache": get_media_cache().get_stats(),
+    })
 
 
 # 创建主页面蓝图
@@ -0,0 +1,381 @@
+"""
+ASGI路由
+
+/api/draw、/api/result、/api/chat、/api/result/stream、/api/chat/stream
+在事件循环中处理，等待上游时不占用 worker；其余请求原样交给 Flask 应用
+（通过 asgiref 的 WSGI 适配器）。
+"""
+import asyncio
+import json
+import traceback
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+from ..config import get_config
+from ..services.async_ai_service import get_async_ai_service
+from ..services.chat_cache import CachedChat, get_chat_cache
+from ..services.chat_stream_hub import get_chat_stream_hub
+from ..services.conversation_service import get_conversation_service
+from ..services.draw_poller import get_draw_poller
+from ..services.stream_relay import get_stream_relay
+from ..utils.errors import ApiError
+
+Scope = Dict[str, Any]
+Receive = Callable[[], Awaitable[Dict[str, Any]]]
+Send = Callable[[Dict[str, Any]], Awaitable[None]]
+
+SSE_HEADERS: List[Tuple[bytes, bytes]] = [
+    (b"content-type", b"text/event-stream"),
+    (b"cache-control", b"no-cache"),
+    (b"x-accel-buffering", b"no"),
+]
+
+
+class AsgiRequest:
+    """ASGI请求的简单封装"""
+
+    def __init__(self, flask_app, scope: Scope, receive: Receive, send: Send):
+        self.flask_app = flask_app
+        self.scope = scope
+        self.receive = receive
+        self.send = send
+
+    def header(self, name: str) -> Optional[str]:
+        """获取请求头"""
+        key = name.lower().encode("latin-1")
+        for header_name, value in self.scope.get("headers", []):
+            if header_name == key:
+                return value.decode("latin-1")
+        return None
+
+    def query(self, name: str, default: str = "") -> str:
+        """获取查询参数"""
+        params = parse_qs(self.scope.get("query_string", b"").decode("latin-1"))
+        values = params.get(name)
+        return values[0] if values else default
+
+    async def body(self, limit: int) -> bytes:
+        """读取请求体，超出限制时拒绝"""
+        chunks = []
+        size = 0
+        while True:
+            message = await self.receive()
+            if message["type"] == "http.disconnect":
+                raise ConnectionError("client disconnected")
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if size > limit:
+                raise ApiError("请求体过大", status_code=413)
+            chunks.append(chunk)
+            if not message.get("more_body"):
+                return b"".join(chunks)
+
+    async def json(self, limit: int) -> Dict[str, Any]:
+        """读取 JSON 请求体（等同 Flask 的 get_json(force=True, silent=True)）"""
+        raw = await self.body(limit)
+        try:
+            data = json.loads(raw or b"{}")
+        except ValueError:
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def user_id(self) -> Optional[int]:
+        """从 Flask 会话 Cookie 中解析用户ID，没有会话时使用默认用户"""
+        from werkzeug.http import parse_cookie
+
+        cookie_name = self.flask_app.config.get("SESSION_COOKIE_NAME", "session")
+        cookies = parse_cookie(self.header("cookie") or "")
+        token = cookies.get(cookie_name)
+        if token:
+            serializer = self.flask_app.session_interface.get_signing_serializer(self.flask_app)
+            try:
+                session = serializer.loads(token) if serializer else {}
+            except Exception:
+                session = {}
+            if session.get("authenticated") and session.get("user_id") is not None:
+                return int(session["user_id"])
+        return _default_user_id()
+
+
+_default_user: Optional[int] = None
+
+
+def _default_user_id() -> Optional[int]:
+    """默认用户ID（与 Flask 路径的默认会话一致）"""
+    global _default_user
+    if _default_user is None:
+        from ..models.user import User
+        _default_user = User.ensure_default_user().id
+    return _default_user
+
+
+def _max_body_size() -> int:
+    """请求体上限：参考图按 base64 计算并留出余量"""
+    config = get_config()
+    return config.max_reference_images * config.max_reference_image_bytes * 2 + 1024 * 1024
+
+
+async def send_json(send: Send, data: Any, status: int = 200, headers=None) -> None:
+    """发送 JSON 响应"""
+    body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode("latin-1")),
+        ] + (headers or []),
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_stream(request: AsgiRequest, chunks, on_close=None, headers=None) -> None:
+    """发送 SSE 流，客户端断开时停止读取上游"""
+    await request.send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": SSE_HEADERS + (headers or []),
+    })
+
+    async def pump() -> None:
+        async for chunk in chunks:
+            await request.send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await request.send({"type": "http.response.body", "body": b""})
+
+    async def watch_disconnect() -> None:
+        while True:
+            message = await request.receive()
+            if message["type"] == "http.disconnect":
+                return
+
+    pump_task = asyncio.ensure_future(pump())
+    watch_task = asyncio.ensure_future(watch_disconnect())
+    try:
+        done, _ = await asyncio.wait(
+            {pump_task, watch_task}, return_when=asyncio.FIRST_COMPLETED
+        )
+    finally:
+        for task in (pump_task, watch_task):
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(pump_task, watch_task, return_exceptions=True)
+        if on_close is not None:
+            await on_close()
+
+    if pump_task in done and not pump_task.cancelled() and pump_task.exception():
+        exc = pump_task.exception()
+        traceback.print_exception(type(exc), exc, exc.__traceback__)
+
+
+async def relay_stream(request: AsgiRequest, response) -> None:
+    """原样转发上游的流式响应，客户端断开时关闭上游连接"""
+    await send_stream(request, get_stream_relay().relay_async(response), on_close=response.aclose)
+
+
+async def draw(request: AsgiRequest) -> None:
+    """生成图像"""
+    service = get_async_ai_service()
+    data = await request.json(_max_body_size())
+    user_id = request.user_id()
+
+    if bool(data.get("stream", False)):
+        response = await service.generate_image_stream(user_id, data)
+        await relay_stream(request, response)
+        return
+
+    result = await service.generate_image(user_id, data, request.header("idempotency-key"))
+    await send_json(request.send, result)
+
+
+async def result(request: AsgiRequest) -> None:
+    """获取图像生成结果"""
+    service = get_async_ai_service()
+    data = await request.json(_max_body_size())
+    draw_id = (data.get("id") or "").strip()
+    result = await service.get_image_result(request.user_id(), draw_id)
+    await send_json(request.send, result)
+
+
+async def result_stream(request: AsgiRequest, heartbeat: float = 15.0) -> None:
+    """以 SSE 推送图像生成状态（上游由服务端统一轮询）"""
+    from ..utils.validation import get_validation_service
+
+    draw_poller = get_draw_poller()
+    draw_id = request.query("id").strip()
+    get_validation_service().validate_draw_id(draw_id)
+    since = request.header("last-event-id") or request.query("since", "0")
+    since_version = int(since) if since.isdigit() else 0
+    user_id = request.user_id()
+
+    # 轮询线程在状态变化时唤醒事件循环中的等待者
+    loop = asyncio.get_running_loop()
+    changed = asyncio.Event()
+
+    def notify() -> None:
+        loop.call_soon_threadsafe(changed.set)
+
+    draw_poller.watch(user_id, draw_id)
+    draw_poller.add_listener(user_id, draw_id, notify)
+
+    async def chunks():
+        nonlocal since_version
+        while True:
+            changed.clear()
+            snapshot = draw_poller.get(user_id, draw_id)
+            if snapshot is None:
+                return
+            if snapshot["version"] > since_version or snapshot["terminal"]:
+                since_version = snapshot["version"]
+                yield draw_poller.format_event(snapshot)
+                if snapshot["terminal"]:
+                    return
+                continue
+            try:
+                await asyncio.wait_for(changed.wait(), heartbeat)
+            except asyncio.TimeoutError:
+                yield b": ping\n\n"
+
+    async def on_close() -> None:
+        draw_poller.remove_listener(user_id, draw_id, notify)
+        draw_poller.release(user_id, draw_id)
+
+    await send_stream(request, chunks(), on_close=on_close)
+
+
+async def send_chat_stream(request: AsgiRequest, stream, after: int = 0, headers=None) -> None:
+    """以 SSE 发送可续传的聊天流"""
+    await send_stream(
+        request,
+        get_chat_stream_hub().aiter_events(stream, after),
+        headers=[(b"x-stream-id", stream.stream_id.encode("latin-1"))] + (headers or [])
+    )
+
+
+def chat_cache_headers(data: Dict[str, Any], result: Any) -> List[Tuple[bytes, bytes]]:
+    """聊天缓存状态响应头（请求未启用缓存时为空）"""
+    if isinstance(result, CachedChat):
+        return [(b"x-cache", b"HIT"), (b"age", str(result.age).encode("latin-1"))]
+    if get_chat_cache().requested(data):
+        return [(b"x-cache", b"MISS")]
+    return []
+
+
+def relay_chat_stream(user_id: Optional[int], response, turn=None):
+    """在事件循环中持续读取上游（不随客户端连接结束），返回登记的流"""
+    chat_stream_hub = get_chat_stream_hub()
+    stream = chat_stream_hub.open(user_id)
+    chunks = get_conversation_service().acapture(turn, get_stream_relay().relay_async(response))
+
+    async def pump() -> None:
+        try:
+            async for chunk in chunks:
+                chat_stream_hub.feed(stream, chunk)
+        finally:
+            await response.aclose()
+            chat_stream_hub.finish(stream)
+
+    loop = asyncio.get_running_loop()
+    task = asyncio.ensure_future(pump())
+    # 清理线程在长时间没有客户端时取消读取
+    stream.on_cancel = lambda: loop.call_soon_threadsafe(task.cancel)
+    return stream
+
+
+async def chat(request: AsgiRequest) -> None:
+    """聊天完成（流式请求带上 Last-Event-ID 重新发送时从断点继续）"""
+    service = get_async_ai_service()
+    user_id = request.user_id()
+    last_event_id = request.header("last-event-id")
+    if last_event_id:
+        await send_chat_stream(request, *get_chat_stream_hub().resume(user_id, last_event_id))
+        return
+
+    conversation_service = get_conversation_service()
+    data = await request.json(_max_body_size())
+    turn, data = await asyncio.to_thread(conversation_service.prepare, user_id, data)
+    result = await service.chat_completion(user_id, data)
+    headers = chat_cache_headers(data, result)
+    if turn is not None:
+        headers.append((b"x-context-tokens", str(turn.context_tokens).encode("latin-1")))
+    if not bool(data.get("stream", False)):
+        body = result.result if isinstance(result, CachedChat) else result
+        await asyncio.to_thread(conversation_service.record_result, turn, body)
+        await send_json(request.send, body, headers=headers)
+        return
+
+    if isinstance(result, CachedChat):
+        # 命中缓存时按流式格式重放，同样支持续传
+        chunks = conversation_service.capture(turn, result.iter_events())
+        stream = await asyncio.to_thread(get_chat_stream_hub().replay, user_id, chunks)
+    else:
+        stream = relay_chat_stream(user_id, result, turn)
+    await send_chat_stream(request, stream, headers=headers)
+
+
+async def chat_stream(request: AsgiRequest) -> None:
+    """续传聊天流"""
+    last_event_id = request.header("last-event-id") or request.query("lastEventId")
+    await send_chat_stream(request, *get_chat_stream_hub().resume(request.user_id(), last_event_id))
+
+
+ROUTES: Dict[Tuple[str, str], Callable[[AsgiRequest], Awaitable[None]]] = {
+    ("POST", "/api/draw"): draw,
+    ("POST", "/api/result"): result,
+    ("GET", "/api/result/stream"): result_stream,
+    ("POST", "/api/chat"): chat,
+    ("GET", "/api/chat/stream"): chat_stream,
+}
+
+
+def _is_multipart(scope: Scope) -> bool:
+    """multipart 上传交给 Flask 按流解析（参考图逐块写入磁盘）"""
+    for name, value in scope.get("headers", []):
+        if name == b"content-type":
+            return value.lower().startswith(b"multipart/form-data")
+    return False
+
+
+def create_asgi_app(flask_app):
+    """创建 ASGI 应用：异步处理上游相关接口，其余请求交给 Flask"""
+    try:
+        from asgiref.wsgi import WsgiToAsgi
+    except ImportError:
+        raise RuntimeError("ASGI 模式需要安装可选依赖：pip install -r requirements-async.txt")
+
+    wsgi_app = WsgiToAsgi(flask_app)
+
+    async def lifespan(receive: Receive, send: Send) -> None:
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                from ..services.usage_buffer import get_usage_buffer
+                await get_async_ai_service().aclose()
+                await asyncio.to_thread(get_usage_buffer().flush)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def app(scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "lifespan":
+            await lifespan(receive, send)
+            return
+
+        handler = ROUTES.get((scope.get("method", ""), scope.get("path", "")))
+        if scope["type"] != "http" or handler is None or _is_multipart(scope):
+            await wsgi_app(scope, receive, send)
+            return
+
+        request = AsgiRequest(flask_app, scope, receive, send)
+        try:
+            await handler(request)
+        except ConnectionError:
+            return
+        except ApiError as exc:
+            await send_json(send, exc.to_dict(), exc.status_code)
+        except Exception:
+            # 记录未预期的错误
+            traceback.print_exc()
+            await send_json(send, {"error": "服务器内部错误"}, 500)
+
+    return app
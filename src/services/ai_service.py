@@ -1,13 +1,35 @@
 """
 AI服务
 """
+import json
+import time
+from hashlib import sha256
+from typing import Dict, Any, Optional, Tuple
+from urllib.parse import urlparse
+
 import requests
-from typing import Dict, Any, Optional
 
-from ..utils.errors import ApiError
-from ..models.usage_stats import UsageStats
+from ..utils.errors import ApiError, UpstreamError
+from ..utils.singleflight import SingleFlight
 from ..config import get_config
 from .api_key_service import get_api_key_service
+from .chat_cache import get_chat_cache
+from .draw_result_cache import get_draw_result_cache
+from .generation_buffer import get_generation_buffer
+from .http_client import get_http_client
+from .idempotency_service import get_idempotency_service
+from .image_preprocessor import get_image_preprocessor
+from .image_store import get_image_store
+from .key_pool import get_key_pool, parse_retry_after
+from .stream_relay import get_stream_relay
+from .usage_buffer import get_usage_buffer
+from .webhook_service import get_webhook_service
+
+# 原样转发给上游的采样参数（同时是聊天缓存键的一部分）
+CHAT_SAMPLING_FIELDS = (
+    "temperature", "top_p", "max_tokens", "presence_penalty",
+    "frequency_penalty", "stop", "seed", "n",
+)
 
 
 class AIService:
@@ -16,27 +38,118 @@ class AIService:
     def __init__(self):
         self.config = get_config()
         self.api_key_service = get_api_key_service()
+        self.http = get_http_client()
+        self.flights = SingleFlight()
+
+    def record_call(self,
+                     user_id: Optional[int],
+                     endpoint: str,
+                     payload: Dict[str, Any],
+                     status: int,
+                     started: float) -> None:
+        """记录一次上游调用的接口、模型、状态码和延迟"""
+        if not user_id:
+            return
+        latency_ms = int((time.monotonic() - started) * 1000)
+        get_usage_buffer().record_event(
+            user_id,
+            urlparse(endpoint).path,
+            str(payload.get("model") or ""),
+            status,
+            latency_ms
+        )
+
+    @staticmethod
+    def flight_key(endpoint: str, payload: Dict[str, Any], headers: Dict[str, str]) -> Tuple[str, str]:
+        """请求合并键：接口 + 规范化请求体与所用密钥的摘要"""
+        digest = sha256()
+        digest.update(json.dumps(payload, sort_keys=True, separators=(",", ":")).encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(headers.get("Authorization", "").encode("utf-8"))
+        return endpoint, digest.hexdigest()
 
     def call_api(self, endpoint: str, payload: Dict[str, Any], user_id: Optional[int]) -> Dict[str, Any]:
-        """调用API"""
+        """调用API（相同的并发请求只发送一次，共享结果；启用密钥池时由密钥池分配密钥）"""
+        return self.call_api_with_key(endpoint, payload, user_id)[0]
+
+    def call_api_with_key(self,
+                          endpoint: str,
+                          payload: Dict[str, Any],
+                          user_id: Optional[int],
+                          key_id: Optional[str] = None) -> Tuple[Dict[str, Any], Optional[str]]:
+        """调用API，返回 (结果, 所用密钥ID)
+
+        启用密钥池时 key_id 指定的密钥仍存在则固定使用该密钥，否则由密钥池分配；
+        未启用密钥池时使用活动密钥，密钥ID为 None。
+        """
+        key_pool = get_key_pool()
+        if key_pool.enabled:
+            keys = self.api_key_service.get_pool_keys(user_id)
+            key_ids = {value: item_id for item_id, value in keys}
+
+            def send(api_key: str) -> Tuple[Dict[str, Any], str]:
+                result = self._post_json(
+                    endpoint, payload, self.api_key_service.headers_for(api_key), user_id
+                )
+                return result, key_ids[api_key]
+
+            result, _ = self.flights.do(
+                self.flight_key(endpoint, payload, key_pool.identity(user_id)),
+                lambda: key_pool.run(user_id, keys, send, key_id=key_id)
+            )
+            return result
+
+        headers = self.api_key_service.build_headers(user_id)
+        result, _ = self.flights.do(
+            self.flight_key(endpoint, payload, headers),
+            lambda: self._post_json(endpoint, payload, headers, user_id)
+        )
+        return result, None
+
+    def draw_key_id(self, user_id: Optional[int], draw_id: str) -> Optional[str]:
+        """提交绘图任务所用的密钥ID（仅启用密钥池时记录）
+
+        不同密钥可能属于不同的上游账号，查询结果必须使用提交任务的密钥。
+        """
+        if not get_key_pool().enabled:
+            return None
+        return get_generation_buffer().submitted_key_id(user_id, draw_id)
+
+    @staticmethod
+    def upstream_error(response: Optional[requests.Response]) -> UpstreamError:
+        """把上游的错误响应转换为 UpstreamError（对外仍返回 502）"""
+        if response is None:
+            return UpstreamError(details="")
+        return UpstreamError(
+            upstream_status=response.status_code,
+            details=response.text,
+            retry_after=parse_retry_after(response.headers.get("Retry-After"))
+        )
+
+    def _post_json(self,
+                   endpoint: str,
+                   payload: Dict[str, Any],
+                   headers: Dict[str, str],
+                   user_id: Optional[int]) -> Dict[str, Any]:
+        """发送请求并解析 JSON 响应"""
+        started = time.monotonic()
         try:
-            response = requests.post(
+            response = self.http.post(
                 endpoint,
-                headers=self.api_key_service.build_headers(user_id),
-                json=payload,
-                timeout=120
+                headers=headers,
+                data=get_image_store().encode_json(payload)
             )
             response.raise_for_status()
         except requests.HTTPError as exc:
-            text = exc.response.text if exc.response is not None else ""
-            raise ApiError(
-                "API request failed",
-                status_code=exc.response.status_code if exc.response else 502,
-                details=text
-            )
+            status_code = exc.response.status_code if exc.response is not None else 502
+            self.record_call(user_id, endpoint, payload, status_code, started)
+            raise self.upstream_error(exc.response)
         except requests.RequestException as exc:
+            self.record_call(user_id, endpoint, payload, 0, started)
             raise ApiError(f"Network error: {exc}", status_code=502)
 
+        self.record_call(user_id, endpoint, payload, response.status_code, started)
+
         try:
             return response.json()
         except ValueError as exc:
@@ -47,29 +160,43 @@ class AIService:
             )
 
     def call_streaming_api(self, endpoint: str, payload: Dict[str, Any], user_id: Optional[int]):
-        """调用流式API"""
+        """调用流式API（启用密钥池时由密钥池分配密钥，收到响应头后即归还）"""
+        key_pool = get_key_pool()
+        if key_pool.enabled:
+            keys = self.api_key_service.get_pool_keys(user_id)
+            return key_pool.run(user_id, keys, lambda api_key: self._open_stream(
+                endpoint, payload, self.api_key_service.headers_for(api_key), user_id
+            ))
+        return self._open_stream(endpoint, payload, self.api_key_service.build_headers(user_id), user_id)
+
+    def _open_stream(self,
+                     endpoint: str,
+                     payload: Dict[str, Any],
+                     headers: Dict[str, str],
+                     user_id: Optional[int]):
+        """发送流式请求，返回尚未读取响应体的响应"""
+        started = time.monotonic()
         try:
-            response = requests.post(
+            response = self.http.post(
                 endpoint,
-                headers=self.api_key_service.build_headers(user_id),
-                json=payload,
-                timeout=120,
+                headers=headers,
+                data=get_image_store().encode_json(payload),
                 stream=True
             )
             response.raise_for_status()
+            # 流式响应的延迟按收到响应头的时间计算
+            self.record_call(user_id, endpoint, payload, response.status_code, started)
             return response
         except requests.HTTPError as exc:
-            text = exc.response.text if exc.response is not None else ""
-            raise ApiError(
-                "API request failed",
-                status_code=exc.response.status_code if exc.response else 502,
-                details=text
-            )
+            status_code = exc.response.status_code if exc.response is not None else 502
+            self.record_call(user_id, endpoint, payload, status_code, started)
+            raise self.upstream_error(exc.response)
         except requests.RequestException as exc:
+            self.record_call(user_id, endpoint, payload, 0, started)
             raise ApiError(f"Network error: {exc}", status_code=502)
 
-    def generate_image(self, user_id: Optional[int], data: Dict[str, Any]) -> Dict[str, Any]:
-        """生成图像"""
+    def build_image_payload(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """校验参数并构建图像生成请求体"""
         from ..utils.validation import get_validation_service
         validation = get_validation_service()
 
@@ -83,6 +210,8 @@ class AIService:
 
         validation.validate_prompt(prompt)
         validation.validate_reference_images(urls)
+        # ref:<摘要> 形式的引用在发送上游请求时才展开，这里只确认图片存在
+        get_image_store().check_refs(urls)
 
         payload: Dict[str, Any] = {
             "model": model,
@@ -97,76 +226,153 @@ class AIService:
         if urls:
             payload["urls"] = urls
 
-        result = self.call_api(self.config.draw_endpoint, payload, user_id)
+        return payload
+
+    def preprocess_images(self, payload: Dict[str, Any]) -> None:
+        """按请求的输出分辨率缩小参考图（未安装 Pillow 或已关闭时不处理）"""
+        if payload.get("urls"):
+            payload["urls"] = get_image_preprocessor().process_urls(
+                payload["urls"], payload.get("imageSize", "")
+            )
+
+    def build_chat_payload(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """校验参数并构建聊天请求体"""
+        from ..utils.validation import get_validation_service
+        validation = get_validation_service()
+
+        model = (data.get("model") or "gpt-4o-mini").strip()
+        messages = data.get("messages") or []
+        stream = bool(data.get("stream", False))
+
+        validation.validate_messages(messages)
+
+        payload = {
+            "model": model,
+            "messages": messages,
+            "stream": stream,
+        }
+        for field in CHAT_SAMPLING_FIELDS:
+            if data.get(field) is not None:
+                payload[field] = data[field]
+        return payload
+
+    def attach_webhook(self, user_id: Optional[int], payload: Dict[str, Any]) -> Optional[str]:
+        """启用回调模式时，把未指定回调地址的任务改为回调到本服务，返回回调地址中的随机数"""
+        webhook_service = get_webhook_service()
+        if not webhook_service.enabled or payload["webHook"] != "-1":
+            return None
+        payload["webHook"], nonce = webhook_service.callback_url(user_id)
+        return nonce
+
+    def generate_image(self,
+                       user_id: Optional[int],
+                       data: Dict[str, Any],
+                       idempotency_key: Optional[str] = None) -> Dict[str, Any]:
+        """生成图像（带幂等键时，重复提交返回第一次提交的任务）"""
+        payload = self.build_image_payload(data)
+        self.preprocess_images(payload)
+        if not idempotency_key:
+            return self.submit_image(user_id, payload)
+
+        request_hash = self.flight_key(self.config.draw_endpoint, payload, {})[1]
+        result, _ = get_idempotency_service().run(
+            user_id, idempotency_key, request_hash,
+            lambda: self.submit_image(user_id, payload)
+        )
+        return result
+
+    def submit_image(self, user_id: Optional[int], payload: Dict[str, Any]) -> Dict[str, Any]:
+        """提交图像生成任务"""
+        callback_nonce = self.attach_webhook(user_id, payload)
+        started = time.monotonic()
+        result, key_id = self.call_api_with_key(self.config.draw_endpoint, payload, user_id)
+        if callback_nonce:
+            get_webhook_service().register(user_id, result, callback_nonce)
+        get_generation_buffer().record_submission(
+            user_id, payload, result, int((time.monotonic() - started) * 1000), key_id
+        )
 
         # 记录使用
         if user_id:
-            UsageStats.record_usage_for_user(user_id)
+            get_usage_buffer().record(user_id)
 
         return result
 
+    def generate_image_stream(self, user_id: Optional[int], data: Dict[str, Any]):
+        """生成图像（流式返回上游的进度与结果）"""
+        payload = self.build_image_payload(data)
+        self.preprocess_images(payload)
+        # 不设置 webHook 时上游以流式响应返回进度与结果
+        payload.pop("webHook")
+        response = self.call_streaming_api(self.config.draw_endpoint, payload, user_id)
+
+        # 记录使用
+        if user_id:
+            get_usage_buffer().record(user_id)
+
+        return response
+
     def get_image_result(self, user_id: Optional[int], draw_id: str) -> Dict[str, Any]:
         """获取图像生成结果"""
         from ..utils.validation import get_validation_service
         validation = get_validation_service()
         validation.validate_draw_id(draw_id)
 
-        result = self.call_api(
+        # 已结束的结果不再变化，命中缓存时不请求上游
+        result_cache = get_draw_result_cache()
+        cached = result_cache.get(user_id, draw_id)
+        if cached is not None:
+            return cached
+
+        result, _ = self.call_api_with_key(
             self.config.result_endpoint,
             {"id": draw_id},
-            user_id
+            user_id,
+            self.draw_key_id(user_id, draw_id)
         )
 
         # 记录使用
         if user_id:
-            UsageStats.record_usage_for_user(user_id)
+            get_usage_buffer().record(user_id)
 
+        result_cache.put(user_id, draw_id, result)
+        get_generation_buffer().record_result(user_id, draw_id, result)
         return result
 
     def chat_completion(self, user_id: Optional[int], data: Dict[str, Any]) -> Any:
-        """聊天完成"""
-        from ..utils.validation import get_validation_service
-        validation = get_validation_service()
-
-        model = (data.get("model") or "gpt-4o-mini").strip()
-        messages = data.get("messages") or []
-        stream = bool(data.get("stream", False))
-
-        validation.validate_messages(messages)
-
-        payload: Dict[str, Any] = {
-            "model": model,
-            "messages": messages,
-            "stream": stream,
-        }
-
-        if stream:
+        """聊天完成（请求启用缓存且命中时返回 CachedChat，不请求上游）"""
+        payload = self.build_chat_payload(data)
+        chat_cache = get_chat_cache()
+        cache_key = chat_cache.cache_key(user_id, payload) if chat_cache.requested(data) else None
+        if cache_key:
+            # 没有可用密钥时与未命中一样报错，不返回缓存
+            self.api_key_service.build_headers(user_id)
+            cached = chat_cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+        if payload["stream"]:
             response = self.call_streaming_api(self.config.chat_endpoint, payload, user_id)
 
             # 记录使用
             if user_id:
-                UsageStats.record_usage_for_user(user_id)
+                get_usage_buffer().record(user_id)
 
             return response
         else:
             result = self.call_api(self.config.chat_endpoint, payload, user_id)
+            if cache_key:
+                chat_cache.put(cache_key, payload["model"], result)
 
             # 记录使用
             if user_id:
-                UsageStats.record_usage_for_user(user_id)
+                get_usage_buffer().record(user_id)
 
             return result
 
     def generate_stream_response(self, response):
-        """生成流式响应"""
-        def generate():
-            for chunk in response.iter_lines():
-                if chunk:
-                    text = chunk.decode("utf-8", errors="ignore")
-                    payload = text if text.startswith("data:") else f"data: {text}"
-                    yield (payload + "\n\n").encode("utf-8")
-
-        return generate()
+        """生成流式响应（原样转发上游的 SSE 字节流，客户端断开时关闭上游连接）"""
+        return get_stream_relay().relay(response)
 
 
 # 全局AI服务实例
@@ -1,12 +1,14 @@
 """
 API密钥服务
 """
-import uuid
-from typing import Dict, List, Optional, Tuple
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
 
 from ..models.api_key import ApiKey
+from ..models.key_version import KeyVersion
 from ..models.user import User
 from ..utils.encryption import get_encryption_service
+from ..utils.cache import TTLCache
 from ..utils.errors import ValidationError, NotFoundError
 from ..config import get_config
 
@@ -17,79 +19,199 @@ class ApiKeyService:
     def __init__(self):
         self.config = get_config()
         self.encryption = get_encryption_service()
+        # 用户ID -> 已解密的活动密钥及全部密钥（附带版本号，用于跨进程失效）
+        self.key_cache = TTLCache(
+            max_size=self.config.key_cache_size,
+            ttl=self.config.key_cache_ttl
+        )
 
     def bootstrap_api_keys(self, user_id: Optional[int]) -> None:
         """引导API密钥（确保环境变量中的密钥存在）"""
         if not user_id:
             return
 
-        # 获取当前密钥
-        decrypted_keys, active_id = self.get_decrypted_keys(user_id)
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+
+        # 通过指纹判断环境变量中的密钥是否已存在，无需解密
+        env_fingerprint = self.encryption.fingerprint(self.config.api_key)
+        has_env_key = not env_fingerprint or ApiKey.get_by_fingerprint(
+            user_id, env_fingerprint
+        ) is not None
+        if has_env_key and ApiKey.get_active_key(user_id):
+            return
+
         changed = False
+        with db.transaction():
+            # 如果环境变量中有密钥且不在列表中，则添加
+            if env_fingerprint and not ApiKey.get_by_fingerprint(user_id, env_fingerprint):
+                ApiKey(
+                    user_id=user_id,
+                    value=self.encryption.encrypt(self.config.api_key),
+                    source="env",
+                    fingerprint=env_fingerprint
+                ).save()
+                changed = True
+
+            # 如果没有活动密钥但有密钥，设置第一个为活动密钥
+            if not ApiKey.get_active_key(user_id):
+                keys = ApiKey.get_by_user_id(user_id)
+                if keys:
+                    ApiKey.set_active_key(keys[0].id, user_id)
+                    changed = True
 
-        # 如果环境变量中有密钥且不在列表中，则添加
-        if self.config.api_key and not any(
-            item.get("value") == self.config.api_key for item in decrypted_keys
-        ):
-            decrypted_keys.append({
-                "id": uuid.uuid4().hex,
-                "value": self.config.api_key,
-                "source": "env"
-            })
-            changed = True
-
-        # 如果没有活动密钥但有密钥，设置第一个为活动密钥
-        if decrypted_keys and not active_id:
-            active_id = decrypted_keys[0]["id"]
-            changed = True
+            if changed:
+                self._invalidate_cache(user_id)
 
         if changed:
-            self.save_key_store(decrypted_keys, active_id, user_id)
+            self.key_cache.pop(user_id)
 
     def get_decrypted_keys(self, user_id: int) -> Tuple[List[Dict], str]:
         """获取解密后的密钥列表"""
         return ApiKey.get_decrypted_keys(user_id, self.encryption.decrypt)
 
     def save_key_store(self, keys: List[Dict], active_id: str, user_id: int) -> None:
-        """保存密钥存储"""
-        # 先删除用户的所有密钥
+        """保存密钥存储
+
+        与数据库中已有的记录做差异比较，只插入新增的密钥、更新有变化的记录、
+        删除被移除的密钥，未变化的密钥不会被重新加密和写入。
+        """
         from ..services.database import get_db_manager
         db = get_db_manager()
-        db.execute_query(
-            "DELETE FROM api_keys WHERE user_id = ?",
-            (user_id,)
-        )
 
-        # 重新插入所有密钥
-        for item in keys:
-            key = ApiKey(
-                id=item.get("id"),
-                user_id=user_id,
-                value=self.encryption.encrypt(item.get("value", "")),
-                source=item.get("source", "custom"),
-                is_active=(item.get("id") == active_id)
+        with db.transaction():
+            stored = {key.id: key for key in ApiKey.get_by_user_id(user_id)}
+            wanted_ids = {item.get("id") for item in keys}
+
+            # 删除已移除的密钥
+            for key_id, key in stored.items():
+                if key_id not in wanted_ids:
+                    key.delete()
+
+            # 插入新增的密钥，更新有变化的密钥
+            for item in keys:
+                value = item.get("value", "")
+                source = item.get("source", "custom")
+                existing = stored.get(item.get("id"))
+
+                fingerprint = self.encryption.fingerprint(value)
+
+                if existing is None:
+                    ApiKey(
+                        id=item.get("id"),
+                        user_id=user_id,
+                        value=self.encryption.encrypt(value),
+                        source=source,
+                        is_active=False,
+                        fingerprint=fingerprint
+                    ).save()
+                    continue
+
+                if existing.fingerprint:
+                    value_changed = existing.fingerprint != fingerprint
+                else:
+                    value_changed = self.encryption.decrypt(existing.value) != value
+                if value_changed or existing.source != source or not existing.fingerprint:
+                    if value_changed:
+                        existing.value = self.encryption.encrypt(value)
+                    existing.source = source
+                    existing.fingerprint = fingerprint
+                    existing.save()
+
+            # 仅在活动密钥发生变化时更新活动状态
+            current_active = next(
+                (key_id for key_id, key in stored.items() if key.is_active), ""
             )
-            key.save()
+            if active_id and active_id in wanted_ids:
+                if active_id != current_active:
+                    ApiKey.set_active_key(active_id, user_id)
+            elif current_active:
+                db.execute_query(
+                    "UPDATE api_keys SET is_active = 0 WHERE user_id = ?",
+                    (user_id,)
+                )
 
-    def get_active_api_key_value(self, user_id: Optional[int]) -> str:
-        """获取活动API密钥的值"""
-        if not user_id:
-            return self.config.api_key
+            self._invalidate_cache(user_id)
+        self.key_cache.pop(user_id)
+        self._forget_pool_state(user_id, stored.keys() - wanted_ids)
+
+    def _forget_pool_state(self, user_id: int, key_ids: Iterable[str]) -> None:
+        """丢弃已删除密钥在密钥池中的状态"""
+        from .key_pool import get_key_pool
+        get_key_pool().forget(user_id, key_ids)
 
+    def _invalidate_cache(self, user_id: int) -> None:
+        """密钥变更后使缓存失效
+
+        在写事务内递增版本号通知其他 worker；本地缓存由调用方在事务提交后
+        清除，避免提交前被其他线程用旧值重新填充。
+        """
+        KeyVersion.bump(user_id)
+
+    def _get_cached_entry(self, user_id: int) -> Optional[Dict]:
+        """从缓存中读取密钥，版本号变化时视为未命中"""
+        entry = self.key_cache.get(user_id)
+        if entry is None:
+            return None
+
+        now = time.monotonic()
+        if now - entry["checked_at"] >= self.config.key_cache_check_seconds:
+            if KeyVersion.get_version(user_id) != entry["version"]:
+                self.key_cache.pop(user_id)
+                return None
+            entry["checked_at"] = now
+
+        return entry
+
+    def _get_key_entry(self, user_id: int) -> Dict:
+        """获取用户的活动密钥和全部密钥（优先使用缓存）"""
+        cached = self._get_cached_entry(user_id)
+        if cached is not None:
+            return cached
+
+        # 先读取版本号再读取密钥，保证并发写入后的下一次检查能发现变化
+        version = KeyVersion.get_version(user_id)
+        value = self.config.api_key
         decrypted_keys, active_id = self.get_decrypted_keys(user_id)
         if active_id:
             for item in decrypted_keys:
                 if item.get("id") == active_id:
-                    return item.get("value", "")
+                    value = item.get("value", "")
+                    break
+
+        entry = {
+            "value": value,
+            "keys": [(item["id"], item["value"]) for item in decrypted_keys if item.get("value")],
+            "version": version,
+            "checked_at": time.monotonic(),
+        }
+        self.key_cache.set(user_id, entry)
+        return entry
+
+    def get_active_api_key_value(self, user_id: Optional[int]) -> str:
+        """获取活动API密钥的值"""
+        if not user_id:
+            return self.config.api_key
+        return self._get_key_entry(user_id)["value"]
 
-        return self.config.api_key
+    def get_pool_keys(self, user_id: Optional[int]) -> List[Tuple[str, str]]:
+        """获取密钥池使用的全部密钥 [(密钥ID, 密钥值)]，没有登记的密钥时使用环境变量中的密钥"""
+        keys = self._get_key_entry(user_id)["keys"] if user_id else []
+        if not keys and self.config.api_key:
+            keys = [("env", self.config.api_key)]
+        if not keys:
+            raise ValidationError("Missing API key. 请在页面 Api key 管理中添加。")
+        return keys
 
     def serialize_keys(self, user_id: int) -> Dict:
-        """序列化密钥信息"""
+        """序列化密钥信息（启用密钥池时附带各密钥在本进程中的健康状态）"""
+        from .key_pool import get_key_pool
+        key_pool = get_key_pool()
+
         decrypted_keys, active_id = self.get_decrypted_keys(user_id)
         active_value = self.get_active_api_key_value(user_id)
 
-        return {
+        result = {
             "activeId": active_id,
             "hasKey": bool(active_value),
             "keys": [
@@ -102,6 +224,19 @@ class ApiKeyService:
                 for item in decrypted_keys
             ],
         }
+        if key_pool.enabled:
+            result["poolMode"] = key_pool.mode
+            for item in result["keys"]:
+                item["health"] = key_pool.health(user_id, item["id"])
+        return result
+
+    @staticmethod
+    def headers_for(api_key: str) -> Dict[str, str]:
+        """使用指定密钥构建API请求头"""
+        return {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+        }
 
     def add_api_key(self, user_id: int, value: str) -> Dict:
         """添加API密钥"""
@@ -109,31 +244,53 @@ class ApiKeyService:
         validation = get_validation_service()
         validation.validate_api_key(value)
 
-        # 检查密钥是否已存在
-        decrypted_keys, active_id = self.get_decrypted_keys(user_id)
-        if any(item.get("value") == value for item in decrypted_keys):
-            raise ValidationError("Api key 已存在")
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+        fingerprint = self.encryption.fingerprint(value)
 
-        # 添加新密钥
-        new_item = {"id": uuid.uuid4().hex, "value": value, "source": "custom"}
-        decrypted_keys.append(new_item)
-        active_id = new_item["id"]
+        with db.transaction():
+            # 通过指纹索引检查密钥是否已存在
+            if ApiKey.get_by_fingerprint(user_id, fingerprint):
+                raise ValidationError("Api key 已存在")
+
+            # 添加新密钥并设为活动密钥
+            ApiKey(
+                user_id=user_id,
+                value=self.encryption.encrypt(value),
+                source="custom",
+                is_active=True,
+                fingerprint=fingerprint
+            ).save()
+            self._invalidate_cache(user_id)
+        self.key_cache.pop(user_id)
 
-        self.save_key_store(decrypted_keys, active_id, user_id)
         return self.serialize_keys(user_id)
 
     def delete_api_key(self, user_id: int, key_id: str) -> Dict:
         """删除API密钥"""
-        if not ApiKey.delete_by_id(key_id, user_id):
-            raise NotFoundError("未找到对应的 Api key")
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+
+        with db.transaction():
+            if not ApiKey.delete_by_id(key_id, user_id):
+                raise NotFoundError("未找到对应的 Api key")
+            self._invalidate_cache(user_id)
+        self.key_cache.pop(user_id)
+        self._forget_pool_state(user_id, [key_id])
 
         # 重新序列化密钥
         return self.serialize_keys(user_id)
 
     def set_active_key(self, user_id: int, key_id: str) -> Dict:
         """设置活动API密钥"""
-        if not ApiKey.set_active_key(key_id, user_id):
-            raise ValidationError("无效的 Api key")
+        from ..services.database import get_db_manager
+        db = get_db_manager()
+
+        with db.transaction():
+            if not ApiKey.set_active_key(key_id, user_id):
+                raise ValidationError("无效的 Api key")
+            self._invalidate_cache(user_id)
+        self.key_cache.pop(user_id)
 
         return self.serialize_keys(user_id)
 
@@ -143,10 +300,7 @@ class ApiKeyService:
         if not api_key:
             raise ValidationError("Missing API key. 请在页面 Api key 管理中添加。")
 
-        return {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json",
-        }
+        return self.headers_for(api_key)
 
 
 # 全局API密钥服务实例
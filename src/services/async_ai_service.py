@@ -0,0 +1,305 @@
+"""
+异步AI服务（ASGI 模式使用）
+"""
+import asyncio
+import time
+from http.cookiejar import DefaultCookiePolicy
+from typing import Any, Dict, Optional, Tuple
+
+try:
+    import httpx
+except ImportError:  # 可选依赖，仅 ASGI 模式需要
+    httpx = None
+
+from ..utils.errors import ApiError, ServiceError, UpstreamError
+from ..utils.singleflight import AsyncSingleFlight
+from ..config import get_config
+from .ai_service import get_ai_service
+from .chat_cache import get_chat_cache
+from .draw_result_cache import get_draw_result_cache
+from .generation_buffer import get_generation_buffer
+from .idempotency_service import get_idempotency_service
+from .image_store import get_image_store
+from .key_pool import get_key_pool, parse_retry_after
+from .usage_buffer import get_usage_buffer
+from .webhook_service import get_webhook_service
+
+
+class AsyncAIService:
+    """异步AI服务
+
+    与 AIService 使用相同的参数校验、密钥和使用统计逻辑，上游请求改由
+    httpx.AsyncClient 在事件循环中发出，等待上游时不占用线程，少量进程
+    即可同时保持大量慢速生成请求和流式响应。
+    """
+
+    def __init__(self):
+        if httpx is None:
+            raise ServiceError(
+                "ASGI 模式需要安装可选依赖",
+                details="pip install -r requirements-async.txt"
+            )
+        self.config = get_config()
+        self.ai_service = get_ai_service()
+        self.api_key_service = self.ai_service.api_key_service
+        self._client: Optional["httpx.AsyncClient"] = None
+        self.flights = AsyncSingleFlight()
+
+    @property
+    def client(self) -> "httpx.AsyncClient":
+        """共享的异步连接池（首次使用时创建，所有用户共享，因此不保存上游的 Cookie）"""
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=self.config.async_max_connections,
+                    max_keepalive_connections=self.config.upstream_pool_size
+                ),
+                timeout=httpx.Timeout(
+                    self.config.upstream_read_timeout,
+                    connect=self.config.upstream_connect_timeout
+                )
+            )
+            self._client.cookies.jar.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        return self._client
+
+    async def build_headers(self, user_id: Optional[int]) -> Dict[str, str]:
+        """构建请求头（缓存未命中时需要查询数据库，放到线程中执行）"""
+        return await asyncio.to_thread(self.api_key_service.build_headers, user_id)
+
+    @staticmethod
+    def encode_body(payload: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any]:
+        """构建 httpx 请求参数（内联参考图的请求体按块读取发送）"""
+        body = get_image_store().encode_json(payload)
+        if isinstance(body, bytes):
+            return {"headers": headers, "content": body}
+        return {
+            "headers": dict(headers, **{"Content-Length": str(len(body))}),
+            "content": body.aiter_chunks(),
+        }
+
+    @staticmethod
+    def upstream_error(response: "httpx.Response", details: str) -> UpstreamError:
+        """把上游的错误响应转换为 UpstreamError（对外仍返回 502）"""
+        return UpstreamError(
+            upstream_status=response.status_code,
+            details=details,
+            retry_after=parse_retry_after(response.headers.get("Retry-After"))
+        )
+
+    async def call_api(self, endpoint: str, payload: Dict[str, Any], user_id: Optional[int]) -> Dict[str, Any]:
+        """调用API（相同的并发请求只发送一次，共享结果；启用密钥池时由密钥池分配密钥）"""
+        return (await self.call_api_with_key(endpoint, payload, user_id))[0]
+
+    async def call_api_with_key(self,
+                                endpoint: str,
+                                payload: Dict[str, Any],
+                                user_id: Optional[int],
+                                key_id: Optional[str] = None) -> Tuple[Dict[str, Any], Optional[str]]:
+        """调用API，返回 (结果, 所用密钥ID)，参见 AIService.call_api_with_key"""
+        key_pool = get_key_pool()
+        if key_pool.enabled:
+            keys = await asyncio.to_thread(self.api_key_service.get_pool_keys, user_id)
+            key_ids = {value: item_id for item_id, value in keys}
+
+            async def send(api_key: str) -> Tuple[Dict[str, Any], str]:
+                result = await self._post_json(
+                    endpoint, payload, self.api_key_service.headers_for(api_key), user_id
+                )
+                return result, key_ids[api_key]
+
+            result, _ = await self.flights.do(
+                self.ai_service.flight_key(endpoint, payload, key_pool.identity(user_id)),
+                lambda: key_pool.arun(user_id, keys, send, key_id=key_id)
+            )
+            return result
+
+        headers = await self.build_headers(user_id)
+        result, _ = await self.flights.do(
+            self.ai_service.flight_key(endpoint, payload, headers),
+            lambda: self._post_json(endpoint, payload, headers, user_id)
+        )
+        return result, None
+
+    async def _post_json(self,
+                         endpoint: str,
+                         payload: Dict[str, Any],
+                         headers: Dict[str, str],
+                         user_id: Optional[int]) -> Dict[str, Any]:
+        """发送请求并解析 JSON 响应"""
+        started = time.monotonic()
+        try:
+            response = await self.client.post(endpoint, **self.encode_body(payload, headers))
+        except httpx.HTTPError as exc:
+            self.ai_service.record_call(user_id, endpoint, payload, 0, started)
+            raise ApiError(f"Network error: {exc}", status_code=502)
+
+        self.ai_service.record_call(user_id, endpoint, payload, response.status_code, started)
+        if response.is_error:
+            raise self.upstream_error(response, response.text)
+
+        try:
+            return response.json()
+        except ValueError as exc:
+            raise ApiError(
+                f"Invalid JSON from upstream: {exc}",
+                status_code=502,
+                details=response.text
+            )
+
+    async def open_stream(self, endpoint: str, payload: Dict[str, Any], user_id: Optional[int]) -> "httpx.Response":
+        """调用流式API，返回尚未读取响应体的 httpx.Response（调用方负责关闭）"""
+        key_pool = get_key_pool()
+        if key_pool.enabled:
+            keys = await asyncio.to_thread(self.api_key_service.get_pool_keys, user_id)
+            return await key_pool.arun(user_id, keys, lambda api_key: self._send_stream(
+                endpoint, payload, self.api_key_service.headers_for(api_key), user_id
+            ))
+        return await self._send_stream(endpoint, payload, await self.build_headers(user_id), user_id)
+
+    async def _send_stream(self,
+                           endpoint: str,
+                           payload: Dict[str, Any],
+                           headers: Dict[str, str],
+                           user_id: Optional[int]) -> "httpx.Response":
+        """发送流式请求"""
+        started = time.monotonic()
+        request = self.client.build_request("POST", endpoint, **self.encode_body(payload, headers))
+        try:
+            response = await self.client.send(request, stream=True)
+        except httpx.HTTPError as exc:
+            self.ai_service.record_call(user_id, endpoint, payload, 0, started)
+            raise ApiError(f"Network error: {exc}", status_code=502)
+
+        self.ai_service.record_call(user_id, endpoint, payload, response.status_code, started)
+        if response.is_error:
+            body = await response.aread()
+            await response.aclose()
+            raise self.upstream_error(response, body.decode("utf-8", errors="ignore"))
+        return response
+
+    async def preprocess_images(self, payload: Dict[str, Any]) -> None:
+        """缩小参考图（等待进程池的结果，放到线程中执行）"""
+        if payload.get("urls"):
+            await asyncio.to_thread(self.ai_service.preprocess_images, payload)
+
+    async def generate_image(self,
+                             user_id: Optional[int],
+                             data: Dict[str, Any],
+                             idempotency_key: Optional[str] = None) -> Dict[str, Any]:
+        """生成图像（带幂等键时，重复提交返回第一次提交的任务）"""
+        payload = self.ai_service.build_image_payload(data)
+        await self.preprocess_images(payload)
+        if not idempotency_key:
+            return await self.submit_image(user_id, payload)
+
+        # 幂等记录需要读写数据库，整个提交放到线程中执行，上游请求仍在事件循环中发出
+        loop = asyncio.get_running_loop()
+        request_hash = self.ai_service.flight_key(self.config.draw_endpoint, payload, {})[1]
+        result, _ = await asyncio.to_thread(
+            get_idempotency_service().run,
+            user_id, idempotency_key, request_hash,
+            lambda: asyncio.run_coroutine_threadsafe(self.submit_image(user_id, payload), loop).result()
+        )
+        return result
+
+    async def submit_image(self, user_id: Optional[int], payload: Dict[str, Any]) -> Dict[str, Any]:
+        """提交图像生成任务"""
+        callback_nonce = self.ai_service.attach_webhook(user_id, payload)
+        started = time.monotonic()
+        result, key_id = await self.call_api_with_key(self.config.draw_endpoint, payload, user_id)
+        if callback_nonce:
+            await asyncio.to_thread(get_webhook_service().register, user_id, result, callback_nonce)
+        get_generation_buffer().record_submission(
+            user_id, payload, result, int((time.monotonic() - started) * 1000), key_id
+        )
+
+        # 记录使用
+        if user_id:
+            get_usage_buffer().record(user_id)
+
+        return result
+
+    async def generate_image_stream(self, user_id: Optional[int], data: Dict[str, Any]) -> "httpx.Response":
+        """生成图像（流式返回上游的进度与结果）"""
+        payload = self.ai_service.build_image_payload(data)
+        await self.preprocess_images(payload)
+        payload.pop("webHook")
+        response = await self.open_stream(self.config.draw_endpoint, payload, user_id)
+
+        # 记录使用
+        if user_id:
+            get_usage_buffer().record(user_id)
+
+        return response
+
+    async def get_image_result(self, user_id: Optional[int], draw_id: str) -> Dict[str, Any]:
+        """获取图像生成结果"""
+        from ..utils.validation import get_validation_service
+        validation = get_validation_service()
+        validation.validate_draw_id(draw_id)
+
+        # 已结束的结果不再变化，命中缓存时不请求上游
+        result_cache = get_draw_result_cache()
+        cached = result_cache.get_local(user_id, draw_id)
+        if cached is None:
+            cached = await asyncio.to_thread(result_cache.get, user_id, draw_id)
+        if cached is not None:
+            return cached
+
+        key_id = None
+        if get_key_pool().enabled:
+            key_id = await asyncio.to_thread(self.ai_service.draw_key_id, user_id, draw_id)
+        result, _ = await self.call_api_with_key(
+            self.config.result_endpoint, {"id": draw_id}, user_id, key_id
+        )
+
+        # 记录使用
+        if user_id:
+            get_usage_buffer().record(user_id)
+
+        await asyncio.to_thread(result_cache.put, user_id, draw_id, result)
+        get_generation_buffer().record_result(user_id, draw_id, result)
+        return result
+
+    async def chat_completion(self, user_id: Optional[int], data: Dict[str, Any]) -> Any:
+        """聊天完成（流式请求返回 httpx.Response，命中缓存时返回 CachedChat）"""
+        payload = self.ai_service.build_chat_payload(data)
+        chat_cache = get_chat_cache()
+        cache_key = chat_cache.cache_key(user_id, payload) if chat_cache.requested(data) else None
+        if cache_key:
+            # 没有可用密钥时与未命中一样报错，不返回缓存
+            await self.build_headers(user_id)
+            cached = await asyncio.to_thread(chat_cache.get, cache_key)
+            if cached is not None:
+                return cached
+
+        if payload["stream"]:
+            result = await self.open_stream(self.config.chat_endpoint, payload, user_id)
+        else:
+            result = await self.call_api(self.config.chat_endpoint, payload, user_id)
+            if cache_key:
+                await asyncio.to_thread(chat_cache.put, cache_key, payload["model"], result)
+
+        # 记录使用
+        if user_id:
+            get_usage_buffer().record(user_id)
+
+        return result
+
+    async def aclose(self) -> None:
+        """关闭连接池"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+# 全局异步AI服务实例
+_async_ai_service: Optional[AsyncAIService] = None
+
+
+def get_async_ai_service() -> AsyncAIService:
+    """获取异步AI服务实例（单例模式）"""
+    global _async_ai_service
+    if _async_ai_service is None:
+        _async_ai_service = AsyncAIService()
+    return _async_ai_service
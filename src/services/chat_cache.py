@@ -0,0 +1,194 @@
+"""
+聊天响应缓存
+"""
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+from hashlib import sha256
+from typing import Any, Dict, Iterator, Optional
+
+from ..models.chat_cache_entry import ChatCacheEntry
+from ..config import get_config
+
+
+class CachedChat:
+    """命中缓存的聊天响应"""
+
+    def __init__(self, cache_key: str, result: Dict[str, Any], age: int):
+        self.cache_key = cache_key
+        self.result = result
+        self.age = age
+
+    def iter_events(self) -> Iterator[bytes]:
+        """按上游流式响应的格式重放（每个选项一次性输出全部内容）"""
+        base = {
+            "id": self.result.get("id", ""),
+            "object": "chat.completion.chunk",
+            "created": self.result.get("created", 0),
+            "model": self.result.get("model", ""),
+        }
+        for choice in self.result.get("choices") or []:
+            delta = dict(choice.get("message") or {})
+            index = choice.get("index", 0)
+            yield self._event(dict(base, choices=[
+                {"index": index, "delta": delta, "finish_reason": None}
+            ]))
+            yield self._event(dict(base, choices=[
+                {"index": index, "delta": {}, "finish_reason": choice.get("finish_reason")}
+            ]))
+        if self.result.get("usage"):
+            yield self._event(dict(base, choices=[], usage=self.result["usage"]))
+        yield b"data: [DONE]\n\n"
+
+    @staticmethod
+    def _event(chunk: Dict[str, Any]) -> bytes:
+        return b"data: " + json.dumps(chunk, ensure_ascii=False).encode("utf-8") + b"\n\n"
+
+
+class ChatCache:
+    """聊天响应缓存
+
+    内部工具经常重复发送相同的确定性请求（相同模型、消息，temperature 为 0）。
+    请求体带 "cache": true 时按模型、消息和采样参数的规范化哈希查询缓存，
+    命中则不再请求上游；流式请求命中时按流式格式重放。缓存保存在 SQLite
+    中，重启和多个 worker 之间共享；条目在 ttl 秒后过期，总大小超出上限时
+    按最近访问时间淘汰。缓存键包含用户ID，用户之间不共享缓存，无法通过
+    命中与否得知其他用户发送过的内容。
+    """
+
+    # 命中时更新最近访问时间的最小间隔（秒），期间的命中次数合并写入
+    TOUCH_INTERVAL = 60
+    # 清理过期条目的最小间隔（秒）
+    PRUNE_INTERVAL = 300
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, ttl: float = 86400.0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # 单条响应的上限，避免个别大响应挤掉其余条目
+        self.max_entry_bytes = max(max_bytes // 16, 1)
+        self._lock = threading.Lock()
+        self._pending_hits: Dict[str, int] = {}
+        self._last_touch = time.monotonic()
+        self._last_prune = 0.0
+        # 缓存总大小（首次写入时查询得到）
+        self._total_bytes: Optional[int] = None
+        self._stats = {"hits": 0, "misses": 0, "stored": 0, "skipped": 0, "evicted": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _count(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self._stats[name] += amount
+
+    def requested(self, data: Dict[str, Any]) -> bool:
+        """请求是否启用缓存"""
+        return self.enabled and data.get("cache") is True
+
+    @staticmethod
+    def cache_key(user_id: Optional[int], payload: Dict[str, Any]) -> str:
+        """用户ID与请求内容的规范化哈希（不含 stream，流式和非流式请求共用缓存）"""
+        canonical = {name: value for name, value in payload.items() if name != "stream"}
+        canonical["user_id"] = user_id or 0
+        body = json.dumps(canonical, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        return sha256(body.encode("utf-8")).hexdigest()
+
+    def _cutoff(self) -> str:
+        return (datetime.utcnow() - timedelta(seconds=self.ttl)).isoformat()
+
+    def get(self, cache_key: str) -> Optional[CachedChat]:
+        """查询缓存，未命中或已过期返回 None"""
+        entry = ChatCacheEntry.get(cache_key, self._cutoff())
+        if entry is None:
+            self._count("misses")
+            return None
+
+        age = (datetime.utcnow() - datetime.fromisoformat(entry.created_at)).total_seconds()
+        with self._lock:
+            self._stats["hits"] += 1
+            self._pending_hits[cache_key] = self._pending_hits.get(cache_key, 0) + 1
+        self._touch()
+        return CachedChat(cache_key, entry.response, int(age))
+
+    def put(self, cache_key: str, model: str, result: Any) -> bool:
+        """缓存上游成功返回的响应"""
+        if not isinstance(result, dict) or not result.get("choices"):
+            return False
+
+        entry = ChatCacheEntry(cache_key=cache_key, model=model, response=result)
+        if len(json.dumps(result, ensure_ascii=False).encode("utf-8")) > self.max_entry_bytes:
+            self._count("skipped")
+            return False
+        entry.save()
+        self._count("stored")
+        self._added(entry.size)
+        return True
+
+    def _touch(self, force: bool = False) -> None:
+        """合并写入命中次数和最近访问时间"""
+        now = time.monotonic()
+        with self._lock:
+            if not self._pending_hits or (not force and now - self._last_touch < self.TOUCH_INTERVAL):
+                return
+            pending, self._pending_hits = self._pending_hits, {}
+            self._last_touch = now
+
+        accessed_at = datetime.utcnow().isoformat()
+        for cache_key, hits in pending.items():
+            ChatCacheEntry.touch(cache_key, hits, accessed_at)
+
+    def _added(self, size: int) -> None:
+        """记录新增条目大小，超出上限或到达清理间隔时淘汰"""
+        now = time.monotonic()
+        with self._lock:
+            if self._total_bytes is not None:
+                self._total_bytes += size
+            total = self._total_bytes
+            due = now - self._last_prune >= self.PRUNE_INTERVAL
+            if due:
+                self._last_prune = now
+        if total is None:
+            total = ChatCacheEntry.total_size()
+            with self._lock:
+                self._total_bytes = total
+        if not due and total <= self.max_bytes:
+            return
+
+        # 先写入合并的访问时间，淘汰才按最新的访问顺序进行
+        self._touch(force=True)
+        # 超出上限时淘汰到上限的 90%，避免之后每次写入都触发淘汰
+        target = self.max_bytes if total <= self.max_bytes else int(self.max_bytes * 0.9)
+        removed = ChatCacheEntry.evict(self._cutoff(), target)
+        total = ChatCacheEntry.total_size()
+        with self._lock:
+            self._total_bytes = total
+            self._stats["evicted"] += removed
+
+    def get_stats(self) -> Dict:
+        """获取缓存统计信息"""
+        with self._lock:
+            return dict(
+                self._stats,
+                enabled=self.enabled,
+                total_bytes=self._total_bytes,
+                max_bytes=self.max_bytes,
+                ttl=self.ttl,
+            )
+
+
+# 全局聊天响应缓存实例
+_chat_cache: Optional[ChatCache] = None
+
+
+def get_chat_cache() -> ChatCache:
+    """获取聊天响应缓存实例（单例模式）"""
+    global _chat_cache
+    if _chat_cache is None:
+        config = get_config()
+        _chat_cache = ChatCache(
+            max_bytes=config.chat_cache_max_mb * 1024 * 1024,
+            ttl=config.chat_cache_ttl
+        )
+    return _chat_cache
@@ -0,0 +1,342 @@
+"""
+可续传的聊天流
+"""
+import json
+import os
+import re
+import threading
+import time
+import traceback
+import uuid
+from collections import deque
+from typing import Callable, Deque, Dict, Iterable, List, Optional, Tuple
+
+from ..utils.errors import ApiError, NotFoundError
+from ..config import get_config
+
+# SSE 事件之间的空行（兼容 \r\n 换行）
+_EVENT_BOUNDARY = re.compile(rb"\r?\n\r?\n")
+
+# 客户端落后太多、需要的事件已被丢弃时发送的错误事件
+_LOST_EVENT = (
+    "event: error\ndata: "
+    + json.dumps({"error": "续传位置已超出缓冲范围，请重新发起请求"}, ensure_ascii=False)
+    + "\n\n"
+).encode("utf-8")
+
+
+class ChatStream:
+    """一次流式聊天的上游输出及其重放缓冲"""
+
+    def __init__(self, stream_id: str, user_id: Optional[int], lock: threading.Lock):
+        self.stream_id = stream_id
+        self.user_id = user_id
+        self.cond = threading.Condition(lock)
+        # (序号, 带事件ID的 SSE 事件)
+        self.frames: Deque[Tuple[int, bytes]] = deque()
+        self.buffered = 0
+        self.last_seq = 0
+        # 还没凑成完整事件的字节
+        self.pending = b""
+        self.done = False
+        self.cancelled = False
+        # 上游读取方式提供的取消回调（同步模式中断上游读取，ASGI 模式取消读取任务）
+        self.on_cancel: Optional[Callable[[], None]] = None
+        self.readers = 0
+        self.idle_since = time.monotonic()
+        self.listeners: List[Callable[[], None]] = []
+
+    @property
+    def first_seq(self) -> int:
+        """缓冲中最早事件的序号"""
+        return self.frames[0][0] if self.frames else self.last_seq + 1
+
+    def event_id(self, seq: int) -> str:
+        return f"{self.stream_id}-{seq}"
+
+
+class ChatStreamHub:
+    """可续传的聊天流
+
+    上游输出由独立的读取方持续消费（不随客户端连接结束），每个 SSE 事件
+    加上 "<流ID>-<序号>" 形式的事件ID，并保存在按字节数限制的重放缓冲中。
+    移动网络下连接中断后，客户端带着 Last-Event-ID 重连即可从断点继续，
+    上游不需要重新生成。没有客户端连接超过 resume_seconds 时关闭上游；
+    结束的流同样保留 resume_seconds 供最后的重连使用。
+    """
+
+    def __init__(self, buffer_bytes: int = 1024 * 1024, resume_seconds: float = 30.0):
+        self.buffer_bytes = buffer_bytes
+        self.resume_seconds = resume_seconds
+        self._lock = threading.Lock()
+        self._streams: Dict[str, ChatStream] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._pid = os.getpid()
+        self._stats = {
+            "opened": 0, "resumed": 0, "completed": 0, "cancelled": 0,
+            "lost": 0, "events": 0, "bytes": 0,
+        }
+
+    def _ensure_worker(self) -> None:
+        """启动（或 fork 后重新启动）清理线程"""
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._streams = {}
+                self._thread = None
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="chat-stream-hub", daemon=True
+                )
+                self._thread.start()
+
+    def open(self, user_id: Optional[int]) -> ChatStream:
+        """登记一个新的流，上游输出通过 feed()/finish() 写入"""
+        self._ensure_worker()
+        stream = ChatStream(uuid.uuid4().hex, user_id, self._lock)
+        with self._lock:
+            self._streams[stream.stream_id] = stream
+            self._stats["opened"] += 1
+        return stream
+
+    def relay(self,
+              user_id: Optional[int],
+              chunks: Iterable[bytes],
+              on_cancel: Optional[Callable[[], None]] = None) -> ChatStream:
+        """在后台线程中读取上游输出（同步模式），返回登记的流
+
+        on_cancel 在流被取消时由清理线程调用，用于中断阻塞中的上游读取，
+        否则上游停滞时要等到读取超时才会关闭连接。
+        """
+        stream = self.open(user_id)
+        stream.on_cancel = on_cancel
+        threading.Thread(
+            target=self._pump, args=(stream, chunks), name="chat-stream", daemon=True
+        ).start()
+        return stream
+
+    def replay(self, user_id: Optional[int], chunks: Iterable[bytes]) -> ChatStream:
+        """登记一个内容已经完整的流（例如命中缓存的响应），不启动读取线程"""
+        stream = self.open(user_id)
+        for chunk in chunks:
+            self.feed(stream, chunk)
+        self.finish(stream)
+        return stream
+
+    def _pump(self, stream: ChatStream, chunks: Iterable[bytes]) -> None:
+        """读取上游直到结束或流被取消"""
+        iterator = iter(chunks)
+        try:
+            for chunk in iterator:
+                if stream.cancelled:
+                    break
+                self.feed(stream, chunk)
+        except Exception:
+            # 取消时中断读取引起的异常不需要输出
+            if not stream.cancelled:
+                traceback.print_exc()
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+            self.finish(stream)
+
+    def feed(self, stream: ChatStream, data: bytes) -> None:
+        """写入上游的一段输出，按空行切分出完整事件并加上事件ID"""
+        with self._lock:
+            stream.pending += data
+            parts = _EVENT_BOUNDARY.split(stream.pending)
+            stream.pending = parts.pop()
+            if parts:
+                self._append(stream, parts)
+            listeners = list(stream.listeners) if parts else []
+        self._notify(listeners)
+
+    def finish(self, stream: ChatStream) -> None:
+        """上游结束（或被取消）"""
+        with self._lock:
+            if stream.done:
+                return
+            if stream.pending.strip():
+                self._append(stream, [stream.pending.rstrip(b"\r\n")])
+            stream.pending = b""
+            stream.done = True
+            self._stats["cancelled" if stream.cancelled else "completed"] += 1
+            listeners = list(stream.listeners)
+        self._notify(listeners)
+
+    def _append(self, stream: ChatStream, events: List[bytes]) -> None:
+        """追加事件并唤醒等待者，超出缓冲上限时丢弃最早的事件（需持有锁）"""
+        for event in events:
+            stream.last_seq += 1
+            # 事件ID放在最后：上游自带 id 字段时以这里的为准
+            frame = b"%s\nid: %s\n\n" % (event, stream.event_id(stream.last_seq).encode("ascii"))
+            stream.frames.append((stream.last_seq, frame))
+            stream.buffered += len(frame)
+            self._stats["events"] += 1
+            self._stats["bytes"] += len(frame)
+        while len(stream.frames) > 1 and stream.buffered > self.buffer_bytes:
+            _, frame = stream.frames.popleft()
+            stream.buffered -= len(frame)
+        stream.cond.notify_all()
+
+    @staticmethod
+    def _notify(listeners: List[Callable[[], None]]) -> None:
+        for listener in listeners:
+            try:
+                listener()
+            except Exception:
+                traceback.print_exc()
+
+    def resume(self, user_id: Optional[int], last_event_id: str) -> Tuple[ChatStream, int]:
+        """按 Last-Event-ID 找到流和续传位置，返回 (流, 已收到的最后序号)"""
+        stream_id, _, seq = (last_event_id or "").strip().rpartition("-")
+        with self._lock:
+            stream = self._streams.get(stream_id)
+            if stream is None or stream.user_id != user_id or not seq.isdigit():
+                raise NotFoundError("流不存在或已过期")
+            after = int(seq)
+            if after > stream.last_seq or after + 1 < stream.first_seq:
+                raise ApiError("续传位置已超出缓冲范围，请重新发起请求", status_code=409)
+            self._stats["resumed"] += 1
+        return stream, after
+
+    def _attach(self, stream: ChatStream) -> None:
+        with self._lock:
+            stream.readers += 1
+
+    def _detach(self, stream: ChatStream) -> None:
+        with self._lock:
+            stream.readers -= 1
+            if stream.readers == 0:
+                stream.idle_since = time.monotonic()
+
+    def _take(self, stream: ChatStream, after: int) -> Tuple[Optional[List[Tuple[int, bytes]]], bool]:
+        """取出序号大于 after 的事件及流是否结束；事件已被丢弃时返回 None（需持有锁）"""
+        if after + 1 < stream.first_seq:
+            self._stats["lost"] += 1
+            return None, True
+        frames = []
+        for item in reversed(stream.frames):
+            if item[0] <= after:
+                break
+            frames.append(item)
+        frames.reverse()
+        return frames, stream.done
+
+    def iter_events(self, stream: ChatStream, after: int = 0, heartbeat: float = 15.0):
+        """生成客户端的 SSE 事件流（同步模式），空闲时定期发送心跳"""
+        self._attach(stream)
+        try:
+            while True:
+                with self._lock:
+                    frames, done = self._take(stream, after)
+                    if frames == [] and not done:
+                        stream.cond.wait(heartbeat)
+                        frames, done = self._take(stream, after)
+                if frames is None:
+                    yield _LOST_EVENT
+                    return
+                if frames:
+                    after = frames[-1][0]
+                    yield b"".join(frame for _, frame in frames)
+                elif done:
+                    return
+                else:
+                    yield b": ping\n\n"
+        finally:
+            self._detach(stream)
+
+    async def aiter_events(self, stream: ChatStream, after: int = 0, heartbeat: float = 15.0):
+        """生成客户端的 SSE 事件流（ASGI 模式）"""
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        changed = asyncio.Event()
+
+        def notify() -> None:
+            loop.call_soon_threadsafe(changed.set)
+
+        with self._lock:
+            stream.readers += 1
+            stream.listeners.append(notify)
+        try:
+            while True:
+                changed.clear()
+                with self._lock:
+                    frames, done = self._take(stream, after)
+                if frames is None:
+                    yield _LOST_EVENT
+                    return
+                if frames:
+                    after = frames[-1][0]
+                    yield b"".join(frame for _, frame in frames)
+                    continue
+                if done:
+                    return
+                try:
+                    await asyncio.wait_for(changed.wait(), heartbeat)
+                except asyncio.TimeoutError:
+                    yield b": ping\n\n"
+        finally:
+            with self._lock:
+                stream.listeners.remove(notify)
+            self._detach(stream)
+
+    def sweep(self) -> None:
+        """取消长时间没有客户端的流，移除过期的流"""
+        now = time.monotonic()
+        cancelled = []
+        with self._lock:
+            for stream_id, stream in list(self._streams.items()):
+                if stream.readers or now - stream.idle_since < self.resume_seconds:
+                    continue
+                if not stream.done and not stream.cancelled:
+                    stream.cancelled = True
+                    cancelled.append(stream)
+                    # 流结束后再保留一段时间
+                    stream.idle_since = now
+                elif stream.done:
+                    del self._streams[stream_id]
+        for stream in cancelled:
+            if stream.on_cancel is not None:
+                self._notify([stream.on_cancel])
+
+    def _run(self) -> None:
+        """后台清理循环"""
+        while True:
+            time.sleep(max(1.0, min(self.resume_seconds / 2, 5.0)))
+            try:
+                self.sweep()
+            except Exception:
+                traceback.print_exc()
+
+    def get_stats(self) -> Dict:
+        """获取流统计信息"""
+        with self._lock:
+            return dict(
+                self._stats,
+                active=sum(1 for stream in self._streams.values() if not stream.done),
+                retained=len(self._streams),
+                buffered_bytes=sum(stream.buffered for stream in self._streams.values()),
+                buffer_bytes=self.buffer_bytes,
+                resume_seconds=self.resume_seconds,
+            )
+
+
+# 全局可续传聊天流实例
+_chat_stream_hub: Optional[ChatStreamHub] = None
+
+
+def get_chat_stream_hub() -> ChatStreamHub:
+    """获取可续传聊天流实例（单例模式）"""
+    global _chat_stream_hub
+    if _chat_stream_hub is None:
+        config = get_config()
+        _chat_stream_hub = ChatStreamHub(
+            buffer_bytes=config.chat_stream_buffer_bytes,
+            resume_seconds=config.chat_stream_resume_seconds
+        )
+    return _chat_stream_hub
@@ -0,0 +1,333 @@
+"""
+会话服务
+"""
+import json
+import re
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from ..models.conversation import Conversation
+from ..models.conversation_message import ConversationMessage
+from ..utils.errors import NotFoundError, ValidationError
+from ..config import get_config
+
+# 中日韩字符（大致每个字符一个 token）
+_CJK = re.compile(r"[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+# 每条消息的格式开销
+MESSAGE_OVERHEAD = 4
+# 每张图片按 token 计的开销
+IMAGE_TOKENS = 765
+
+
+def estimate_tokens(content: Any) -> int:
+    """估算一条消息的 token 数（中日韩字符按 1 个，其余按 4 个字符 1 个）"""
+    images = 0
+    if isinstance(content, list):
+        texts = []
+        for part in content:
+            if isinstance(part, dict) and part.get("type") == "text":
+                texts.append(str(part.get("text") or ""))
+            else:
+                images += 1
+        text = "".join(texts)
+    else:
+        text = "" if content is None else str(content)
+    cjk = len(_CJK.findall(text))
+    return MESSAGE_OVERHEAD + cjk + (len(text) - cjk + 3) // 4 + images * IMAGE_TOKENS
+
+
+class ConversationTurn:
+    """一轮对话：本轮新增的消息，收到回复后与回复一起写入"""
+
+    def __init__(self,
+                 user_id: int,
+                 conversation_id: int,
+                 messages: List[Dict[str, Any]],
+                 context_tokens: int):
+        self.user_id = user_id
+        self.conversation_id = conversation_id
+        self.messages = messages
+        self.context_tokens = context_tokens
+
+
+class _ReplyCollector:
+    """从上游的 SSE 输出中拼接回复内容"""
+
+    def __init__(self):
+        self._pending = b""
+        self._parts: List[str] = []
+        self.done = False
+
+    def feed(self, chunk: bytes) -> None:
+        lines = (self._pending + chunk).split(b"\n")
+        self._pending = lines.pop()
+        for line in lines:
+            line = line.strip()
+            if not line.startswith(b"data:"):
+                continue
+            data = line[5:].strip()
+            if data == b"[DONE]":
+                self.done = True
+                continue
+            try:
+                choices = json.loads(data).get("choices") or []
+            except (ValueError, AttributeError):
+                continue
+            for choice in choices:
+                if choice.get("index", 0) == 0:
+                    content = (choice.get("delta") or {}).get("content")
+                    if content:
+                        self._parts.append(content)
+
+    @property
+    def text(self) -> str:
+        return "".join(self._parts)
+
+
+class ConversationService:
+    """会话服务
+
+    客户端只发送本轮的新消息（请求体带 conversationId），服务端从保存的
+    历史中组装上下文：系统提示词 + 预算内最近的历史消息 + 新消息。每条
+    消息写入时估算一次 token 数并记录此前的累计值，按模型的 token 预算
+    截取历史只需一次索引查询，请求大小不再随会话变长而增长。新消息在收到
+    上游回复后才与回复一起写入，请求失败时历史保持不变。
+    """
+
+    DEFAULT_LIMIT = 20
+    MAX_LIMIT = 100
+    MAX_TITLE_LENGTH = 200
+
+    def __init__(self, context_tokens: int = 8000, model_context_tokens: Optional[Dict[str, int]] = None):
+        self.context_tokens = context_tokens
+        self.model_context_tokens = model_context_tokens or {}
+
+    def budget_for(self, model: str) -> int:
+        """模型的上下文 token 预算"""
+        return self.model_context_tokens.get(model, self.context_tokens)
+
+    def _parse_limit(self, value: Optional[str]) -> int:
+        if not value:
+            return self.DEFAULT_LIMIT
+        try:
+            limit = int(value)
+        except ValueError:
+            raise ValidationError("limit 必须是整数")
+        return max(1, min(limit, self.MAX_LIMIT))
+
+    @staticmethod
+    def _parse_id(value: Any, name: str) -> Optional[int]:
+        if value is None or value == "":
+            return None
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            raise ValidationError(f"{name} 无效")
+
+    @staticmethod
+    def serialize(conversation: Conversation) -> Dict[str, Any]:
+        """转换为接口返回格式"""
+        return {
+            "id": conversation.id,
+            "model": conversation.model,
+            "title": conversation.title,
+            "systemPrompt": conversation.system_prompt,
+            "messageCount": conversation.message_count,
+            "tokenTotal": conversation.token_total,
+            "createdAt": conversation.created_at,
+            "updatedAt": conversation.updated_at,
+        }
+
+    @staticmethod
+    def serialize_message(message: ConversationMessage) -> Dict[str, Any]:
+        """转换为接口返回格式"""
+        return {
+            "id": message.id,
+            "role": message.role,
+            "content": message.content,
+            "tokens": message.tokens,
+            "createdAt": message.created_at,
+        }
+
+    def get_conversation(self, user_id: int, conversation_id: Any) -> Conversation:
+        """获取用户的会话，不存在时抛出 NotFoundError"""
+        conversation = Conversation.get(user_id, self._parse_id(conversation_id, "conversationId") or 0)
+        if conversation is None:
+            raise NotFoundError("会话不存在")
+        return conversation
+
+    def create_conversation(self, user_id: int, data: Dict[str, Any]) -> Dict[str, Any]:
+        """创建会话"""
+        title = str(data.get("title") or "").strip()
+        if len(title) > self.MAX_TITLE_LENGTH:
+            raise ValidationError(f"title 最多 {self.MAX_TITLE_LENGTH} 个字符")
+        conversation = Conversation(
+            user_id=user_id,
+            model=str(data.get("model") or "").strip(),
+            title=title,
+            system_prompt=str(data.get("systemPrompt") or "")
+        )
+        conversation.save()
+        return self.serialize(conversation)
+
+    def list_conversations(self,
+                           user_id: int,
+                           limit: Optional[str] = None,
+                           before: Optional[str] = None) -> Dict[str, Any]:
+        """分页列出会话（before 为上一页返回的 next）"""
+        page_size = self._parse_limit(limit)
+        items = Conversation.list_page(user_id, page_size, self._parse_id(before, "before 游标"))
+        return {
+            "items": [self.serialize(item) for item in items],
+            "next": items[-1].id if len(items) == page_size else None,
+        }
+
+    def list_messages(self,
+                      user_id: int,
+                      conversation_id: int,
+                      limit: Optional[str] = None,
+                      before: Optional[str] = None) -> Dict[str, Any]:
+        """从最新的消息开始分页列出会话消息"""
+        conversation = self.get_conversation(user_id, conversation_id)
+        page_size = self._parse_limit(limit)
+        items = ConversationMessage.list_page(
+            conversation.id, page_size, self._parse_id(before, "before 游标")
+        )
+        return {
+            "items": [self.serialize_message(item) for item in items],
+            "next": items[-1].id if len(items) == page_size else None,
+        }
+
+    def delete_conversation(self, user_id: int, conversation_id: int) -> None:
+        """删除会话及其消息"""
+        if not Conversation.delete(user_id, conversation_id):
+            raise NotFoundError("会话不存在")
+
+    def prepare(self,
+                user_id: Optional[int],
+                data: Dict[str, Any]) -> Tuple[Optional[ConversationTurn], Dict[str, Any]]:
+        """组装会话上下文，返回 (本轮对话, 替换了 messages 的请求)；未指定会话时原样返回"""
+        if data.get("conversationId") is None:
+            return None, data
+        if not user_id:
+            raise ValidationError("会话需要登录后使用")
+
+        conversation = self.get_conversation(user_id, data["conversationId"])
+        messages = data.get("messages") or []
+        if not isinstance(messages, list) or not all(
+            isinstance(message, dict) and message.get("role") for message in messages
+        ):
+            raise ValidationError("messages 格式无效")
+
+        model = str(data.get("model") or conversation.model or "").strip()
+        system = [{"role": "system", "content": conversation.system_prompt}] \
+            if conversation.system_prompt else []
+        fixed_tokens = sum(
+            estimate_tokens(message.get("content")) for message in system + messages
+        )
+        max_tokens = data.get("max_tokens")
+        reserved = max_tokens if isinstance(max_tokens, int) and max_tokens > 0 else 0
+        available = self.budget_for(model) - reserved - fixed_tokens
+
+        history: List[ConversationMessage] = []
+        if available > 0 and conversation.token_total:
+            history = ConversationMessage.list_since_offset(
+                conversation.id, conversation.token_total - available
+            )
+
+        prepared = dict(data, messages=system + [item.to_message() for item in history] + messages)
+        if model:
+            prepared["model"] = model
+        turn = ConversationTurn(
+            user_id, conversation.id, messages, fixed_tokens + sum(item.tokens for item in history)
+        )
+        return turn, prepared
+
+    def record(self, turn: Optional[ConversationTurn], reply: Optional[Dict[str, Any]]) -> None:
+        """写入本轮的新消息和上游回复"""
+        from .database import get_db_manager
+
+        if turn is None or not reply:
+            return
+
+        now = datetime.utcnow().isoformat()
+        with get_db_manager().transaction():
+            # 在写事务中重新读取累计值，同一会话并发的请求依次追加
+            conversation = Conversation.get(turn.user_id, turn.conversation_id)
+            if conversation is None:
+                # 会话在请求期间被删除
+                return
+            offset = conversation.token_total
+            records = []
+            for message in turn.messages + [reply]:
+                tokens = estimate_tokens(message.get("content"))
+                records.append(ConversationMessage(
+                    conversation_id=turn.conversation_id,
+                    role=str(message["role"]),
+                    content=message.get("content"),
+                    tokens=tokens,
+                    token_offset=offset,
+                    created_at=now
+                ))
+                offset += tokens
+            ConversationMessage.insert_batch(records)
+            Conversation.add_totals(
+                turn.conversation_id, len(records), offset - conversation.token_total, now
+            )
+
+    def record_result(self, turn: Optional[ConversationTurn], result: Any) -> None:
+        """从非流式响应中取出回复并写入"""
+        if turn is None or not isinstance(result, dict):
+            return
+        choices = result.get("choices") or []
+        message = choices[0].get("message") if choices else None
+        if isinstance(message, dict):
+            self.record(turn, {"role": message.get("role") or "assistant",
+                               "content": message.get("content") or ""})
+
+    def capture(self, turn: Optional[ConversationTurn], chunks: Iterable[bytes]) -> Iterable[bytes]:
+        """转发流式输出的同时拼接回复，流完整结束后写入（中途取消不写入）"""
+        if turn is None:
+            return chunks
+        return self._capture(turn, chunks)
+
+    def _capture(self, turn: ConversationTurn, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        collector = _ReplyCollector()
+        try:
+            for chunk in chunks:
+                collector.feed(chunk)
+                yield chunk
+        finally:
+            close = getattr(chunks, "close", None)
+            if close is not None:
+                close()
+        if collector.done:
+            self.record(turn, {"role": "assistant", "content": collector.text})
+
+    async def acapture(self, turn: Optional[ConversationTurn], chunks: AsyncIterator[bytes]):
+        """capture 的 ASGI 版本"""
+        import asyncio
+
+        collector = _ReplyCollector()
+        async for chunk in chunks:
+            if turn is not None:
+                collector.feed(chunk)
+            yield chunk
+        if turn is not None and collector.done:
+            await asyncio.to_thread(self.record, turn, {"role": "assistant", "content": collector.text})
+
+
+# 全局会话服务实例
+_conversation_service: Optional[ConversationService] = None
+
+
+def get_conversation_service() -> ConversationService:
+    """获取会话服务实例（单例模式）"""
+    global _conversation_service
+    if _conversation_service is None:
+        config = get_config()
+        _conversation_service = ConversationService(
+            context_tokens=config.chat_context_tokens,
+            model_context_tokens=config.chat_model_context_tokens
+        )
+    return _conversation_service
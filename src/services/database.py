@@ -1,62 +1,239 @@
 """
 数据库连接管理
 """
+import atexit
 import os
 import sqlite3
-from typing import Optional
+import threading
+from typing import Dict, Optional
 from contextlib import contextmanager
 
 from ..models.base import BaseModel
 from ..models.user import User
 from ..models.api_key import ApiKey
 from ..models.usage_stats import UsageStats
+from ..models.key_version import KeyVersion
+from ..models.usage_event import UsageEvent
+from ..models.usage_rollup import UsageRollup
+from ..models.draw_result import DrawResult
+from ..models.idempotency_key import IdempotencyKey
+from ..models.generation import Generation
+from ..models.chat_cache_entry import ChatCacheEntry
+from ..models.conversation import Conversation
+from ..models.conversation_message import ConversationMessage
 
 
 class DatabaseManager:
-    """数据库管理器"""
+    """数据库管理器
+
+    每个线程持有一条长连接（线程本地连接池），连接在首次使用时创建并启用
+    WAL 日志模式，之后在该线程内复用，避免每次查询都重新建立连接。
+    连接按进程 ID 区分，gunicorn fork 出的 worker 不会复用父进程的连接。
+    """
 
     def __init__(self, db_path: Optional[str] = None):
         self.db_path = db_path or os.getenv("DB_PATH", "data/app.db")
         self.data_dir = os.getenv("DATA_DIR", "data")
+        self.busy_timeout_ms = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+        self.synchronous = os.getenv("DB_SYNCHRONOUS", "NORMAL").upper()
         self._ensure_data_dir()
 
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._pid = os.getpid()
+        # 线程ID -> (线程对象, 连接)，用于统计和回收已退出线程的连接
+        self._connections: Dict[int, tuple] = {}
+        self._stats = {"created": 0, "reused": 0, "closed": 0}
+
     def _ensure_data_dir(self) -> None:
         """确保数据目录存在"""
         os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
 
-    @contextmanager
-    def get_connection(self) -> sqlite3.Connection:
-        """获取数据库连接（上下文管理器）"""
+    def _reset_after_fork(self) -> None:
+        """fork 之后丢弃从父进程继承的连接（不能跨进程使用）"""
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._pid = os.getpid()
+        self._connections = {}
+        self._stats = {"created": 0, "reused": 0, "closed": 0}
+
+    def _open_connection(self) -> sqlite3.Connection:
+        """创建新连接并设置 PRAGMA"""
         self._ensure_data_dir()
-        conn = sqlite3.connect(self.db_path)
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout_ms / 1000,
+            check_same_thread=False
+        )
         conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA busy_timeout = {self.busy_timeout_ms}")
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute(f"PRAGMA synchronous = {self.synchronous}")
         conn.execute("PRAGMA foreign_keys = ON")
+        return conn
+
+    def _prune_dead_threads(self) -> None:
+        """关闭已退出线程遗留的连接（调用方需持有锁）"""
+        for ident, (thread, conn) in list(self._connections.items()):
+            if not thread.is_alive():
+                conn.close()
+                del self._connections[ident]
+                self._stats["closed"] += 1
+
+    def _acquire(self) -> sqlite3.Connection:
+        """获取当前线程的连接，不存在时创建"""
+        if self._pid != os.getpid():
+            self._reset_after_fork()
+
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            with self._lock:
+                self._stats["reused"] += 1
+            return conn
+
+        conn = self._open_connection()
+        with self._lock:
+            self._prune_dead_threads()
+            current = threading.current_thread()
+            self._connections[current.ident] = (current, conn)
+            self._stats["created"] += 1
+        self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def get_connection(self) -> sqlite3.Connection:
+        """获取数据库连接（上下文管理器，连接由连接池复用）"""
+        conn = self._acquire()
         try:
             yield conn
-        finally:
-            conn.close()
+        except sqlite3.Error:
+            # 连接出错时回滚未提交的事务，保证连接可以继续复用；
+            # 处于显式事务中时交由 transaction() 处理
+            if conn.in_transaction and not self.in_transaction():
+                conn.rollback()
+            raise
+
+    def in_transaction(self) -> bool:
+        """当前线程是否处于 transaction() 开启的事务中"""
+        return getattr(self._local, "tx_depth", 0) > 0
+
+    @contextmanager
+    def transaction(self) -> sqlite3.Connection:
+        """开启事务（工作单元）
+
+        事务内的 execute_query / execute_many 不再逐条提交，退出时统一提交，
+        出现异常则整体回滚。外层事务使用 BEGIN IMMEDIATE 提前获取写锁，
+        嵌套调用会以 SAVEPOINT 的方式加入外层事务。
+        """
+        with self.get_connection() as conn:
+            depth = getattr(self._local, "tx_depth", 0)
+            savepoint = f"sp_{depth}"
+            if depth == 0:
+                if conn.in_transaction:
+                    conn.commit()
+                conn.execute("BEGIN IMMEDIATE")
+            else:
+                conn.execute(f"SAVEPOINT {savepoint}")
+
+            self._local.tx_depth = depth + 1
+            try:
+                yield conn
+            except BaseException:
+                self._local.tx_depth = depth
+                if depth == 0:
+                    conn.rollback()
+                else:
+                    conn.execute(f"ROLLBACK TO {savepoint}")
+                    conn.execute(f"RELEASE {savepoint}")
+                raise
+            else:
+                self._local.tx_depth = depth
+                if depth == 0:
+                    conn.commit()
+                else:
+                    conn.execute(f"RELEASE {savepoint}")
+
+    def _commit(self, conn: sqlite3.Connection) -> None:
+        """不在事务中时立即提交"""
+        if not self.in_transaction():
+            conn.commit()
+
+    def close_connection(self) -> None:
+        """关闭当前线程的连接"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            return
+        self._local.conn = None
+        with self._lock:
+            self._connections.pop(threading.get_ident(), None)
+            self._stats["closed"] += 1
+        conn.close()
+
+    def close_all(self) -> None:
+        """关闭连接池中的全部连接（进程退出时调用）"""
+        with self._lock:
+            for _, conn in self._connections.values():
+                conn.close()
+                self._stats["closed"] += 1
+            self._connections = {}
+        self._local = threading.local()
+
+    def get_pool_stats(self) -> Dict:
+        """获取连接池统计信息"""
+        with self._lock:
+            self._prune_dead_threads()
+            return {
+                "pid": self._pid,
+                "open_connections": len(self._connections),
+                "created": self._stats["created"],
+                "reused": self._stats["reused"],
+                "closed": self._stats["closed"],
+                "journal_mode": "wal",
+                "synchronous": self.synchronous,
+                "busy_timeout_ms": self.busy_timeout_ms,
+            }
 
     def init_database(self) -> None:
-        """初始化数据库表"""
+        """初始化数据库表并应用结构迁移"""
+        from .migrations import apply_migrations
+
         with self.get_connection() as conn:
             # 创建所有表
             User.init_table(conn)
             ApiKey.init_table(conn)
             UsageStats.init_table(conn)
+            KeyVersion.init_table(conn)
+            UsageEvent.init_table(conn)
+            UsageRollup.init_table(conn)
+            DrawResult.init_table(conn)
+            IdempotencyKey.init_table(conn)
+            Generation.init_table(conn)
+            ChatCacheEntry.init_table(conn)
+            Conversation.init_table(conn)
+            ConversationMessage.init_table(conn)
             conn.commit()
 
+        apply_migrations(self)
+
+    def get_schema_version(self) -> int:
+        """获取当前数据库的结构版本号"""
+        from .migrations import get_schema_version
+
+        with self.get_connection() as conn:
+            return get_schema_version(conn)
+
     def execute_query(self, query: str, params: tuple = ()) -> sqlite3.Cursor:
         """执行查询"""
         with self.get_connection() as conn:
             cursor = conn.execute(query, params)
-            conn.commit()
+            self._commit(conn)
             return cursor
 
     def execute_many(self, query: str, params_list: list) -> None:
         """执行多个参数相同的查询"""
         with self.get_connection() as conn:
             conn.executemany(query, params_list)
-            conn.commit()
+            self._commit(conn)
 
     def fetch_one(self, query: str, params: tuple = ()) -> Optional[sqlite3.Row]:
         """获取单条记录"""
@@ -73,12 +250,17 @@ class DatabaseManager:
 
 # 全局数据库管理器实例
 db_manager: Optional[DatabaseManager] = None
+_db_manager_lock = threading.Lock()
 
 
 def get_db_manager() -> DatabaseManager:
     """获取数据库管理器实例（单例模式）"""
     global db_manager
     if db_manager is None:
-        db_manager = DatabaseManager()
-        db_manager.init_database()
-    return db_manager
\ No newline at end of file
+        with _db_manager_lock:
+            if db_manager is None:
+                manager = DatabaseManager()
+                manager.init_database()
+                atexit.register(manager.close_all)
+                db_manager = manager
+    return db_manager
@@ -0,0 +1,425 @@
+"""
+绘图结果轮询服务
+"""
+import atexit
+import json
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+from ..models.draw_result import TERMINAL_STATUSES
+from ..utils.errors import ApiError
+from ..config import get_config
+
+DrawKey = Tuple[Optional[int], str]
+
+
+class DrawTask:
+    """一个被跟踪的绘图任务"""
+
+    def __init__(self, user_id: Optional[int], draw_id: str, interval: float):
+        now = time.monotonic()
+        self.user_id = user_id
+        self.draw_id = draw_id
+        self.created_at = now
+        self.last_seen = now
+        self.changed_at = now
+        self.next_poll = now
+        self.interval = interval
+        # 最近一次上游返回（与 /api/result 的响应格式相同）
+        self.result: Optional[Dict] = None
+        # 最近一次读取到的回调结果的更新时间
+        self.stored_at: Optional[str] = None
+        self.version = 0
+        self.terminal = False
+        self.finished_at: Optional[float] = None
+        self.polling = False
+        self.polls = 0
+        self.failures = 0
+        self.watchers = 0
+        self.listeners: List[Callable[[], None]] = []
+
+    @property
+    def key(self) -> DrawKey:
+        return (self.user_id, self.draw_id)
+
+    def snapshot(self) -> Dict:
+        """当前状态（推送给等待的客户端）"""
+        return {
+            "id": self.draw_id,
+            "version": self.version,
+            "terminal": self.terminal,
+            "result": self.result,
+        }
+
+
+class DrawPoller:
+    """绘图结果轮询器
+
+    每个 (用户, 绘图ID) 只由后台线程轮询一次上游，任意数量的客户端
+    （多个标签页、SSE、长轮询）共享同一份状态并在状态变化时被唤醒。
+    进度有变化时按最小间隔轮询，没有变化时间隔按倍数退避到最大间隔；
+    没有客户端关注的任务会在空闲一段时间后停止轮询，已结束的任务保留一段
+    时间供稍后连接的客户端直接读取。
+
+    启用上游回调时，以回调模式提交的任务不再查询上游：本进程收到的回调
+    通过 publish() 立即推送，其他进程收到的回调从 draw_results 表中读取，
+    只有超过 webhook_fallback 秒没有任何回调时才回退到查询上游。
+    """
+
+    # 连续失败多少次后放弃
+    MAX_FAILURES = 5
+
+    def __init__(self,
+                 min_interval: float = 1.0,
+                 max_interval: float = 8.0,
+                 backoff: float = 1.5,
+                 timeout: float = 600.0,
+                 idle_timeout: float = 60.0,
+                 result_ttl: float = 300.0,
+                 workers: int = 4,
+                 webhook_enabled: bool = False,
+                 webhook_fallback: float = 30.0,
+                 store_interval: float = 0.5):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.result_ttl = result_ttl
+        self.workers = workers
+        self.webhook_enabled = webhook_enabled
+        self.webhook_fallback = webhook_fallback
+        self.store_interval = store_interval
+        self._lock = threading.Lock()
+        # 状态变化时通知所有同步等待者
+        self._changed = threading.Condition(self._lock)
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pid = os.getpid()
+        self._tasks: Dict[DrawKey, DrawTask] = {}
+        self._stats = {"tracked": 0, "polls": 0, "errors": 0, "completed": 0, "expired": 0}
+
+    def _ensure_worker(self) -> None:
+        """启动（或 fork 后重新启动）后台轮询线程"""
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                # fork 出的子进程不继承父进程的任务和线程
+                self._pid = os.getpid()
+                self._tasks = {}
+                self._thread = None
+                self._executor = None
+            if self._thread is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="draw-poll"
+                )
+                self._thread = threading.Thread(
+                    target=self._run, name="draw-poller", daemon=True
+                )
+                self._thread.start()
+
+    def watch(self, user_id: Optional[int], draw_id: str) -> Dict:
+        """开始关注一个绘图任务，返回当前状态；结束关注时需调用 release()"""
+        self._ensure_worker()
+        key = (user_id, draw_id)
+        with self._lock:
+            task = self._tasks.get(key)
+            if task is None:
+                task = DrawTask(user_id, draw_id, self.min_interval)
+                self._tasks[key] = task
+                self._stats["tracked"] += 1
+            task.watchers += 1
+            task.last_seen = time.monotonic()
+            snapshot = task.snapshot()
+        self._wake.set()
+        return snapshot
+
+    def release(self, user_id: Optional[int], draw_id: str) -> None:
+        """结束关注"""
+        with self._lock:
+            task = self._tasks.get((user_id, draw_id))
+            if task is not None:
+                task.watchers = max(0, task.watchers - 1)
+                task.last_seen = time.monotonic()
+
+    def wait(self,
+             user_id: Optional[int],
+             draw_id: str,
+             since_version: int,
+             timeout: float) -> Optional[Dict]:
+        """等待任务状态版本超过 since_version（任务已结束时立即返回），超时返回 None"""
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while True:
+                task = self._tasks.get((user_id, draw_id))
+                if task is None:
+                    return None
+                if task.version > since_version or task.terminal:
+                    return task.snapshot()
+                task.last_seen = time.monotonic()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._changed.wait(remaining)
+
+    def get(self, user_id: Optional[int], draw_id: str) -> Optional[Dict]:
+        """获取任务当前状态（不等待）"""
+        with self._lock:
+            task = self._tasks.get((user_id, draw_id))
+            return task.snapshot() if task else None
+
+    def add_listener(self, user_id: Optional[int], draw_id: str, callback: Callable[[], None]) -> None:
+        """注册状态变化回调（在轮询线程中调用，供事件循环唤醒等待者）"""
+        with self._lock:
+            task = self._tasks.get((user_id, draw_id))
+            if task is not None:
+                task.listeners.append(callback)
+
+    def remove_listener(self, user_id: Optional[int], draw_id: str, callback: Callable[[], None]) -> None:
+        """移除状态变化回调"""
+        with self._lock:
+            task = self._tasks.get((user_id, draw_id))
+            if task is not None and callback in task.listeners:
+                task.listeners.remove(callback)
+
+    @staticmethod
+    def format_event(snapshot: Dict) -> bytes:
+        """把任务状态转换为 SSE 事件（事件ID为状态版本，便于断线续传）"""
+        return (
+            f"id: {snapshot['version']}\n"
+            f"data: {json.dumps(snapshot, ensure_ascii=False)}\n\n"
+        ).encode("utf-8")
+
+    def iter_events(self,
+                    user_id: Optional[int],
+                    draw_id: str,
+                    since_version: int = 0,
+                    heartbeat: float = 15.0):
+        """生成 SSE 事件流，任务结束后关闭；空闲时定期发送心跳"""
+        self.watch(user_id, draw_id)
+        try:
+            while True:
+                snapshot = self.wait(user_id, draw_id, since_version, heartbeat)
+                if snapshot is None:
+                    if self.get(user_id, draw_id) is None:
+                        return
+                    yield b": ping\n\n"
+                    continue
+                since_version = snapshot["version"]
+                yield self.format_event(snapshot)
+                if snapshot["terminal"]:
+                    return
+        finally:
+            self.release(user_id, draw_id)
+
+    def publish(self, user_id: Optional[int], draw_id: str, result: Dict) -> None:
+        """推送一次外部收到的状态（上游回调），立即唤醒等待该任务的客户端"""
+        with self._lock:
+            task = self._tasks.get((user_id, draw_id))
+            if task is None or task.terminal:
+                return
+            changed = self._update(task, result, time.monotonic())
+            listeners = self._mark_changed(task) if changed else []
+        self._notify(listeners)
+
+    def _load_stored(self, task: DrawTask) -> Tuple[bool, Optional[Dict]]:
+        """读取回调写入的结果，返回 (是否以回调模式提交, 新的结果)"""
+        from ..models.draw_result import DrawResult
+
+        stored = DrawResult.get_by_draw_id(task.draw_id)
+        if stored is None or stored.user_id != task.user_id:
+            return False, None
+        if stored.payload is None or stored.updated_at == task.stored_at:
+            return True, None
+        task.stored_at = stored.updated_at
+        return True, stored.to_result()
+
+    def _poll(self, task: DrawTask) -> None:
+        """查询一次任务状态并更新"""
+        from .ai_service import get_ai_service
+
+        error: Optional[ApiError] = None
+        result: Optional[Dict] = None
+        from_upstream = True
+        if self.webhook_enabled:
+            # 回调模式提交的任务只检查本地存储（回调可能落在其他进程），
+            # 长时间没有收到回调时才回退到查询上游
+            registered, result = self._load_stored(task)
+            waiting = registered and time.monotonic() - task.changed_at < self.webhook_fallback
+            from_upstream = result is None and not waiting
+
+        if from_upstream:
+            try:
+                result = get_ai_service().get_image_result(task.user_id, task.draw_id)
+            except ApiError as exc:
+                error = exc
+            except Exception as exc:
+                traceback.print_exc()
+                error = ApiError(f"Poll failed: {exc}", status_code=502)
+
+        now = time.monotonic()
+        with self._lock:
+            task.polling = False
+            changed = False
+            if from_upstream:
+                task.polls += 1
+                self._stats["polls"] += 1
+
+            if error is not None:
+                task.failures += 1
+                self._stats["errors"] += 1
+                if task.failures >= self.MAX_FAILURES:
+                    task.result = self._failed_result(
+                        task.draw_id, error.message, "poll_error", error.details or error.message
+                    )
+                    task.terminal = True
+                    changed = True
+            elif result is not None:
+                task.failures = 0
+                changed = self._update(task, result, now)
+
+            if not task.terminal and now - task.created_at >= self.timeout:
+                task.result = self._failed_result(task.draw_id, "timeout", "timeout", "等待生成结果超时")
+                task.terminal = True
+                changed = True
+
+            if from_upstream:
+                if not changed:
+                    task.interval = min(self.max_interval, task.interval * self.backoff)
+                task.next_poll = now + task.interval
+            else:
+                task.next_poll = now + self.store_interval
+
+            changed = changed or (task.terminal and task.finished_at is None)
+            listeners = self._mark_changed(task) if changed else []
+
+        self._notify(listeners)
+        self._wake.set()
+
+    @staticmethod
+    def _failed_result(draw_id: str, message: str, reason: str, detail: str) -> Dict:
+        """构造失败状态（与上游结果格式相同）"""
+        return {"code": -1, "msg": message, "data": {
+            "id": draw_id,
+            "status": "failed",
+            "progress": 0,
+            "results": [],
+            "failure_reason": reason,
+            "error": detail,
+        }}
+
+    def _update(self, task: DrawTask, result: Dict, now: float) -> bool:
+        """用新结果更新任务，返回状态是否变化（调用方需持有锁）"""
+        data = result.get("data") if isinstance(result, dict) else None
+        changed = result != task.result
+        if changed:
+            # 只有上游找到任务时才重置轮询间隔
+            if isinstance(data, dict):
+                task.interval = self.min_interval
+            task.result = result
+            task.changed_at = now
+        if isinstance(data, dict) and data.get("status") in TERMINAL_STATUSES:
+            task.terminal = True
+        return changed
+
+    def _mark_changed(self, task: DrawTask) -> List[Callable[[], None]]:
+        """递增状态版本并唤醒同步等待者，返回需要通知的回调（调用方需持有锁）"""
+        if task.terminal and task.finished_at is None:
+            task.finished_at = time.monotonic()
+            self._stats["completed"] += 1
+        task.version += 1
+        self._changed.notify_all()
+        return list(task.listeners)
+
+    @staticmethod
+    def _notify(listeners: List[Callable[[], None]]) -> None:
+        """在锁外调用状态变化回调"""
+        for callback in listeners:
+            try:
+                callback()
+            except Exception:
+                traceback.print_exc()
+
+    def _expire(self, now: float) -> None:
+        """清理已结束或无人关注的任务（调用方需持有锁）"""
+        for key, task in list(self._tasks.items()):
+            if task.polling:
+                continue
+            if task.terminal:
+                expired = now - task.finished_at >= self.result_ttl
+            else:
+                expired = task.watchers == 0 and now - task.last_seen >= self.idle_timeout
+            if expired:
+                del self._tasks[key]
+                self._stats["expired"] += 1
+
+    def _run(self) -> None:
+        """后台调度循环：把到期的任务交给线程池轮询"""
+        while not self._stop.is_set():
+            now = time.monotonic()
+            due: List[DrawTask] = []
+            next_wake = now + self.max_interval
+            with self._lock:
+                self._expire(now)
+                for task in self._tasks.values():
+                    if task.terminal or task.polling:
+                        continue
+                    if task.next_poll <= now:
+                        task.polling = True
+                        due.append(task)
+                    else:
+                        next_wake = min(next_wake, task.next_poll)
+            for task in due:
+                self._executor.submit(self._poll, task)
+            self._wake.wait(max(0.0, next_wake - time.monotonic()))
+            self._wake.clear()
+
+    def shutdown(self) -> None:
+        """停止后台线程"""
+        self._stop.set()
+        self._wake.set()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def get_stats(self) -> Dict:
+        """获取轮询统计信息"""
+        with self._lock:
+            return dict(
+                self._stats,
+                active=sum(1 for task in self._tasks.values() if not task.terminal),
+                finished=sum(1 for task in self._tasks.values() if task.terminal),
+                watchers=sum(task.watchers for task in self._tasks.values()),
+            )
+
+
+# 全局绘图结果轮询器实例
+_draw_poller: Optional[DrawPoller] = None
+_draw_poller_lock = threading.Lock()
+
+
+def get_draw_poller() -> DrawPoller:
+    """获取绘图结果轮询器实例（单例模式）"""
+    global _draw_poller
+    if _draw_poller is None:
+        with _draw_poller_lock:
+            if _draw_poller is None:
+                config = get_config()
+                poller = DrawPoller(
+                    min_interval=config.draw_poll_min_interval,
+                    max_interval=config.draw_poll_max_interval,
+                    timeout=config.draw_poll_timeout,
+                    result_ttl=config.draw_result_ttl,
+                    workers=config.draw_poll_workers,
+                    webhook_enabled=config.draw_webhook_enabled,
+                    webhook_fallback=config.draw_webhook_fallback
+                )
+                atexit.register(poller.shutdown)
+                _draw_poller = poller
+    return _draw_poller
@@ -0,0 +1,116 @@
+"""
+绘图结果缓存
+"""
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+from ..models.draw_result import DrawResult, TERMINAL_STATUSES
+from ..utils.cache import TTLCache
+from ..config import get_config
+
+
+class DrawResultCache:
+    """已结束绘图结果的缓存
+
+    succeeded/failed 之后结果不再变化，查询结果时先查本进程的 LRU 缓存，
+    再查各 worker 共享的 draw_results 表，都未命中才请求上游。只缓存已结束
+    的状态；条目按数量淘汰，并在 ttl 秒后过期（上游图片地址的有效期有限）。
+    """
+
+    # 清理过期结果的最小间隔（秒）
+    PRUNE_INTERVAL = 300
+    # 回调模式登记后超过该时间（秒）仍未更新的任务视为已放弃
+    STALE_SECONDS = 86400
+
+    def __init__(self, max_size: int = 2048, ttl: float = 7200.0, max_rows: int = 20000):
+        self.ttl = ttl
+        self.max_rows = max_rows
+        # 绘图ID -> (用户ID, 结果)
+        self.memory = TTLCache(max_size=max_size, ttl=ttl)
+        self._lock = threading.Lock()
+        self._last_prune = 0.0
+        self._stats = {"memory_hits": 0, "db_hits": 0, "misses": 0, "stored": 0}
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._stats[name] += 1
+
+    def get_local(self, user_id: Optional[int], draw_id: str) -> Optional[Dict[str, Any]]:
+        """只查本进程缓存"""
+        entry = self.memory.get(draw_id)
+        if entry is None or entry[0] != user_id:
+            return None
+        self._count("memory_hits")
+        return entry[1]
+
+    def get(self, user_id: Optional[int], draw_id: str) -> Optional[Dict[str, Any]]:
+        """查询已结束的结果，未命中返回 None"""
+        result = self.get_local(user_id, draw_id)
+        if result is not None:
+            return result
+
+        stored = DrawResult.get_by_draw_id(draw_id)
+        if stored is None or stored.user_id != user_id or not stored.terminal or not stored.payload:
+            self._count("misses")
+            return None
+
+        age = (datetime.utcnow() - datetime.fromisoformat(stored.updated_at)).total_seconds()
+        if age >= self.ttl:
+            self._count("misses")
+            return None
+
+        result = stored.to_result()
+        self.memory.set(draw_id, (user_id, result), ttl=self.ttl - age)
+        self._count("db_hits")
+        return result
+
+    def put(self, user_id: Optional[int], draw_id: str, result: Dict[str, Any]) -> bool:
+        """缓存上游返回的结果，只有已结束的状态会被写入"""
+        data = result.get("data") if isinstance(result, dict) else None
+        if not isinstance(data, dict) or data.get("status") not in TERMINAL_STATUSES:
+            return False
+
+        DrawResult.store(draw_id, user_id, data)
+        self.memory.set(draw_id, (user_id, result))
+        self._count("stored")
+        self._prune_expired()
+        return True
+
+    def _prune_expired(self) -> None:
+        """定期清理过期或超出数量的结果"""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_prune < self.PRUNE_INTERVAL:
+                return
+            self._last_prune = now
+
+        now = datetime.utcnow()
+        DrawResult.delete_expired(
+            (now - timedelta(seconds=self.ttl)).isoformat(),
+            self.max_rows,
+            (now - timedelta(seconds=max(self.ttl, self.STALE_SECONDS))).isoformat()
+        )
+
+    def get_stats(self) -> Dict:
+        """获取缓存统计信息"""
+        with self._lock:
+            return dict(self._stats, memory=self.memory.stats())
+
+
+# 全局绘图结果缓存实例
+_draw_result_cache: Optional[DrawResultCache] = None
+
+
+def get_draw_result_cache() -> DrawResultCache:
+    """获取绘图结果缓存实例（单例模式）"""
+    global _draw_result_cache
+    if _draw_result_cache is None:
+        config = get_config()
+        _draw_result_cache = DrawResultCache(
+            max_size=config.draw_cache_size,
+            ttl=config.draw_cache_ttl,
+            max_rows=config.draw_cache_max_rows
+        )
+    return _draw_result_cache
@@ -0,0 +1,220 @@
+"""
+生成记录写缓冲
+"""
+import atexit
+import copy
+import os
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from ..models.draw_result import TERMINAL_STATUSES
+from ..models.generation import Generation
+from ..config import get_config
+
+# 记录到生成参数中的请求字段（webHook 含签名，不记录）
+PARAM_FIELDS = ("aspectRatio", "imageSize", "shutProgress")
+
+
+class GenerationBuffer:
+    """生成记录写缓冲
+
+    提交和结果查询路径只把记录放入内存，由后台线程按时间间隔或积压数量
+    在一个事务内批量写入 generations 表，不在请求路径上等待数据库写锁。
+    进程退出时写入剩余的记录。多个 worker 时任务的提交记录可能还在另一个
+    worker 的缓冲中，找不到提交记录的结果保留到之后的写入中重试。
+    """
+
+    # 找不到提交记录的结果最多保留的时间（秒），超过后丢弃
+    UNMATCHED_RETENTION = 300
+
+    def __init__(self, flush_interval: float = 2.0, flush_threshold: int = 200):
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._pid = os.getpid()
+        self._created: List[Generation] = []
+        # (用户ID, 绘图ID) -> (状态, 结果地址, 失败原因, 完成时间)
+        self._finished: Dict[Tuple[int, str], Tuple[str, List[str], str, str]] = {}
+        self._stats = {"submitted": 0, "finished": 0, "flushes": 0, "errors": 0, "dropped": 0}
+
+    def _ensure_worker(self) -> None:
+        """启动（或 fork 后重新启动）后台写入线程"""
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._created = []
+                self._finished = {}
+                self._thread = None
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="generation-buffer", daemon=True
+                )
+                self._thread.start()
+
+    def _pending_count(self) -> int:
+        return len(self._created) + len(self._finished)
+
+    def record_submission(self,
+                          user_id: Optional[int],
+                          payload: Dict[str, Any],
+                          result: Dict[str, Any],
+                          submit_ms: int,
+                          api_key_id: Optional[str] = None) -> None:
+        """记录提交成功的绘图任务及提交所用的密钥ID（仅写内存）"""
+        data = result.get("data") if isinstance(result, dict) else None
+        draw_id = data.get("id") if isinstance(data, dict) else None
+        if not user_id or not draw_id:
+            return
+
+        params = {field: payload[field] for field in PARAM_FIELDS if field in payload}
+        # 内联的 data URL 体积大，只记录占位
+        params["urls"] = [
+            "data:" if url.startswith("data:") else url for url in payload.get("urls") or []
+        ]
+        generation = Generation(
+            user_id=user_id,
+            draw_id=str(draw_id),
+            model=str(payload.get("model") or ""),
+            prompt=str(payload.get("prompt") or ""),
+            params=params,
+            submit_ms=submit_ms,
+            api_key_id=api_key_id
+        )
+
+        self._ensure_worker()
+        with self._lock:
+            self._created.append(generation)
+            self._stats["submitted"] += 1
+            should_flush = self._pending_count() >= self.flush_threshold
+        if should_flush:
+            self._wake.set()
+
+    def record_result(self, user_id: Optional[int], draw_id: str, result: Dict[str, Any]) -> None:
+        """记录已结束任务的结果（仅写内存，未结束的状态忽略）"""
+        data = result.get("data") if isinstance(result, dict) else None
+        if not user_id or not isinstance(data, dict) or data.get("status") not in TERMINAL_STATUSES:
+            return
+
+        urls = [item.get("url") for item in data.get("results") or [] if item.get("url")]
+        reason = str(data.get("failure_reason") or data.get("error") or "")
+        finished = (data["status"], urls, reason, datetime.utcnow().isoformat())
+
+        self._ensure_worker()
+        with self._lock:
+            if (user_id, draw_id) in self._finished:
+                return
+            self._finished[(user_id, draw_id)] = finished
+            self._stats["finished"] += 1
+            should_flush = self._pending_count() >= self.flush_threshold
+        if should_flush:
+            self._wake.set()
+
+    def submitted_key_id(self, user_id: Optional[int], draw_id: str) -> Optional[str]:
+        """获取提交任务所用的密钥ID（先查本进程的缓冲，再查数据库；未记录时返回 None）"""
+        if not user_id:
+            return None
+        with self._lock:
+            for generation in reversed(self._created):
+                if generation.draw_id == draw_id and generation.user_id == user_id:
+                    return generation.api_key_id
+        return Generation.get_api_key_id(user_id, draw_id)
+
+    def pending_for(self, user_id: int) -> Tuple[List[Generation], Dict[str, Tuple[str, List[str], str, str]]]:
+        """获取用户尚未写入数据库的提交记录（副本）和结果（只含本进程的缓冲）"""
+        with self._lock:
+            created = [copy.copy(item) for item in self._created if item.user_id == user_id]
+            finished = {
+                draw_id: values for (owner, draw_id), values in self._finished.items()
+                if owner == user_id
+            }
+        return created, finished
+
+    def flush(self) -> int:
+        """把缓冲中的记录在一个事务内批量写入数据库，返回写入的条数"""
+        from .database import get_db_manager
+
+        with self._flush_lock:
+            with self._lock:
+                created, self._created = self._created, []
+                finished, self._finished = self._finished, {}
+            if not created and not finished:
+                return 0
+
+            updates = [values + key for key, values in finished.items()]
+            try:
+                with get_db_manager().transaction():
+                    # 先插入再更新：同一批次中提交后很快结束的任务也能写入结果
+                    Generation.insert_batch(created)
+                    unmatched = Generation.finish_batch(updates)
+            except Exception:
+                # 写入失败时把记录放回缓冲，等待下次重试
+                with self._lock:
+                    self._created = created + self._created
+                    for key, values in finished.items():
+                        self._finished.setdefault(key, values)
+                    self._stats["errors"] += 1
+                raise
+
+            cutoff = (datetime.utcnow() - timedelta(seconds=self.UNMATCHED_RETENTION)).isoformat()
+            with self._lock:
+                for status, urls, reason, finished_at, user_id, draw_id in unmatched:
+                    if finished_at < cutoff:
+                        self._stats["dropped"] += 1
+                        continue
+                    self._finished.setdefault((user_id, draw_id), (status, urls, reason, finished_at))
+                self._stats["flushes"] += 1
+        return len(created) + len(updates) - len(unmatched)
+
+    def _run(self) -> None:
+        """后台写入循环"""
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                import traceback
+                traceback.print_exc()
+
+    def shutdown(self) -> None:
+        """停止后台线程并写入剩余记录"""
+        self._stop.set()
+        self._wake.set()
+        self.flush()
+
+    def get_stats(self) -> Dict:
+        """获取缓冲统计信息"""
+        with self._lock:
+            return dict(
+                self._stats,
+                pending_created=len(self._created),
+                pending_finished=len(self._finished),
+            )
+
+
+# 全局生成记录缓冲实例
+_generation_buffer: Optional[GenerationBuffer] = None
+_generation_buffer_lock = threading.Lock()
+
+
+def get_generation_buffer() -> GenerationBuffer:
+    """获取生成记录缓冲实例（单例模式）"""
+    global _generation_buffer
+    if _generation_buffer is None:
+        with _generation_buffer_lock:
+            if _generation_buffer is None:
+                config = get_config()
+                buffer = GenerationBuffer(
+                    flush_interval=config.usage_flush_interval,
+                    flush_threshold=config.usage_flush_threshold
+                )
+                atexit.register(buffer.shutdown)
+                _generation_buffer = buffer
+    return _generation_buffer
@@ -0,0 +1,160 @@
+"""
+生成记录查询服务
+"""
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+from ..models.generation import Generation
+from ..utils.errors import ValidationError
+from .generation_buffer import get_generation_buffer
+
+
+class GenerationService:
+    """生成记录查询服务
+
+    使用游标分页（WHERE id < 游标 ORDER BY id DESC），每页都走
+    (user_id, id) 索引，翻页速度与记录总数无关。
+    """
+
+    DEFAULT_LIMIT = 20
+    MAX_LIMIT = 100
+    MAX_QUERY_LENGTH = 200
+
+    def __init__(self):
+        self._has_fts: Optional[bool] = None
+
+    def _parse_limit(self, value: Optional[str]) -> int:
+        if not value:
+            return self.DEFAULT_LIMIT
+        try:
+            limit = int(value)
+        except ValueError:
+            raise ValidationError("limit 必须是整数")
+        return max(1, min(limit, self.MAX_LIMIT))
+
+    @staticmethod
+    def _parse_cursor(value: Optional[str]) -> Optional[int]:
+        if not value:
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            raise ValidationError("before 游标无效")
+
+    @staticmethod
+    def serialize(generation: Generation) -> Dict[str, Any]:
+        """转换为接口返回格式"""
+        duration_ms = None
+        if generation.finished_at:
+            elapsed = (datetime.fromisoformat(generation.finished_at)
+                       - datetime.fromisoformat(generation.created_at))
+            duration_ms = int(elapsed.total_seconds() * 1000)
+        return {
+            "id": generation.id,
+            "drawId": generation.draw_id,
+            "model": generation.model,
+            "prompt": generation.prompt,
+            "params": generation.params,
+            "status": generation.status,
+            "results": generation.result_urls,
+            "failureReason": generation.failure_reason,
+            "submitMs": generation.submit_ms,
+            "durationMs": duration_ms,
+            "createdAt": generation.created_at,
+            "finishedAt": generation.finished_at,
+        }
+
+    def _page(self,
+              user_id: int,
+              fetch: Callable[[], List[Generation]],
+              limit: int,
+              first_page: bool,
+              matches: Callable[[Generation], bool]) -> Dict[str, Any]:
+        """查询一页记录并合并本进程缓冲中尚未写入的提交和结果（查询不触发写入）
+
+        尚未写入的提交记录没有 ID，只出现在第一页的最前面；游标仍按数据库中的记录计算。
+        """
+        # 先读缓冲再查数据库：期间写入的记录只会在两边重复出现，按绘图ID去重
+        created, finished = get_generation_buffer().pending_for(user_id)
+        items = fetch()
+        for item in items:
+            self._apply_finished(item, finished.get(item.draw_id))
+
+        pending: List[Generation] = []
+        if first_page:
+            stored = {item.draw_id for item in items}
+            for item in reversed(created):
+                if item.draw_id in stored:
+                    continue
+                self._apply_finished(item, finished.get(item.draw_id))
+                if matches(item):
+                    pending.append(item)
+
+        return {
+            "items": [self.serialize(item) for item in pending + items],
+            # 不足一页说明已经到底
+            "next": items[-1].id if len(items) == limit else None,
+        }
+
+    @staticmethod
+    def _apply_finished(generation: Generation, finished: Optional[tuple]) -> None:
+        """用缓冲中尚未写入的结果更新记录"""
+        if finished is None or generation.finished_at:
+            return
+        generation.status, generation.result_urls, generation.failure_reason, generation.finished_at = finished
+
+    def list_generations(self,
+                         user_id: int,
+                         limit: Optional[str] = None,
+                         before: Optional[str] = None,
+                         status: Optional[str] = None,
+                         model: Optional[str] = None) -> Dict[str, Any]:
+        """分页列出生成记录（before 为上一页返回的 next）"""
+        page_size = self._parse_limit(limit)
+        cursor = self._parse_cursor(before)
+        status = (status or "").strip() or None
+        model = (model or "").strip() or None
+        return self._page(
+            user_id,
+            lambda: Generation.list_page(user_id, page_size, cursor, status, model),
+            page_size,
+            cursor is None,
+            lambda item: (status is None or item.status == status)
+            and (model is None or item.model == model)
+        )
+
+    def search_generations(self,
+                           user_id: int,
+                           query: Optional[str],
+                           limit: Optional[str] = None,
+                           before: Optional[str] = None) -> Dict[str, Any]:
+        """按提示词搜索生成记录"""
+        query = (query or "").strip()
+        if not query:
+            raise ValidationError("q is required")
+        if len(query) > self.MAX_QUERY_LENGTH:
+            raise ValidationError(f"搜索关键词最多 {self.MAX_QUERY_LENGTH} 个字符")
+
+        page_size = self._parse_limit(limit)
+        cursor = self._parse_cursor(before)
+        if self._has_fts is None:
+            self._has_fts = Generation.has_fts()
+        return self._page(
+            user_id,
+            lambda: Generation.search_page(user_id, query, page_size, cursor, use_fts=self._has_fts),
+            page_size,
+            cursor is None,
+            lambda item: query.lower() in item.prompt.lower()
+        )
+
+
+# 全局生成记录查询服务实例
+_generation_service: Optional[GenerationService] = None
+
+
+def get_generation_service() -> GenerationService:
+    """获取生成记录查询服务实例（单例模式）"""
+    global _generation_service
+    if _generation_service is None:
+        _generation_service = GenerationService()
+    return _generation_service
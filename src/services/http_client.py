@@ -0,0 +1,160 @@
+"""
+上游HTTP客户端
+"""
+import os
+import threading
+from http.cookiejar import DefaultCookiePolicy
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from ..config import get_config
+
+
+class HttpClient:
+    """上游HTTP客户端
+
+    每个上游主机共享一个 requests.Session 及其连接池，请求之间保持
+    keep-alive，避免每次调用都重新建立 TCP 连接和 TLS 握手。
+    Session 由所有用户和线程共享，其 Cookie 存储拒绝保存任何 Cookie，上游
+    返回的 Set-Cookie 不会被带到其他用户的请求中；fork 后自动重建。
+    """
+
+    def __init__(self,
+                 pool_size: int = 32,
+                 connect_timeout: float = 5.0,
+                 read_timeout: float = 120.0):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        # scheme://host -> Session
+        self._sessions: Dict[str, requests.Session] = {}
+        self._stats: Dict[str, Dict[str, int]] = {}
+
+    @property
+    def timeout(self) -> Tuple[float, float]:
+        """默认超时（连接超时, 读取超时）"""
+        return (self.connect_timeout, self.read_timeout)
+
+    @staticmethod
+    def _host_key(url: str) -> str:
+        parsed = urlparse(url)
+        return f"{parsed.scheme}://{parsed.netloc}"
+
+    def _create_session(self) -> requests.Session:
+        """创建带连接池、不保存 Cookie 的 Session"""
+        session = requests.Session()
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.pool_size,
+            pool_block=False
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def get_session(self, url: str) -> requests.Session:
+        """获取目标主机的 Session"""
+        if self._pid != os.getpid():
+            # fork 出的子进程不能复用父进程的连接
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._sessions = {}
+                    self._stats = {}
+                    self._pid = os.getpid()
+
+        key = self._host_key(url)
+        session = self._sessions.get(key)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(key)
+                if session is None:
+                    session = self._create_session()
+                    self._sessions[key] = session
+                    self._stats[key] = {"requests": 0, "errors": 0}
+        return session
+
+    def request(self, method: str, url: str, **kwargs: Any) -> requests.Response:
+        """发送请求（未指定 timeout 时使用默认的连接/读取超时）"""
+        session = self.get_session(url)
+        stats = self._stats.get(self._host_key(url))
+        kwargs.setdefault("timeout", self.timeout)
+        try:
+            response = session.request(method, url, **kwargs)
+        except requests.RequestException:
+            self._count(stats, "errors")
+            raise
+        self._count(stats, "requests")
+        return response
+
+    def _count(self, stats: Optional[Dict[str, int]], name: str) -> None:
+        if stats is not None:
+            with self._lock:
+                stats[name] += 1
+
+    def post(self, url: str, **kwargs: Any) -> requests.Response:
+        """发送 POST 请求"""
+        return self.request("POST", url, **kwargs)
+
+    def get(self, url: str, **kwargs: Any) -> requests.Response:
+        """发送 GET 请求"""
+        return self.request("GET", url, **kwargs)
+
+    def get_stats(self) -> Dict:
+        """获取各主机的请求数和连接池统计"""
+        hosts = {}
+        with self._lock:
+            for key, session in self._sessions.items():
+                container = session.get_adapter(key).poolmanager.pools
+                pools = [
+                    pool for pool in (container.get(pool_key) for pool_key in container.keys())
+                    if pool is not None
+                ]
+                hosts[key] = dict(
+                    self._stats.get(key, {}),
+                    connections_created=sum(pool.num_connections for pool in pools),
+                    pool_requests=sum(pool.num_requests for pool in pools),
+                    # 连接池队列中用 None 占位，只统计真正空闲的连接
+                    idle_connections=sum(
+                        1 for pool in pools if pool.pool
+                        for conn in list(pool.pool.queue) if conn is not None
+                    ),
+                )
+        return {
+            "pool_size": self.pool_size,
+            "connect_timeout": self.connect_timeout,
+            "read_timeout": self.read_timeout,
+            "hosts": hosts,
+        }
+
+    def close(self) -> None:
+        """关闭所有 Session 及其连接"""
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = {}
+
+
+# 全局HTTP客户端实例
+_http_client: Optional[HttpClient] = None
+_http_client_lock = threading.Lock()
+
+
+def get_http_client() -> HttpClient:
+    """获取HTTP客户端实例（单例模式）"""
+    global _http_client
+    if _http_client is None:
+        with _http_client_lock:
+            if _http_client is None:
+                config = get_config()
+                _http_client = HttpClient(
+                    pool_size=config.upstream_pool_size,
+                    connect_timeout=config.upstream_connect_timeout,
+                    read_timeout=config.upstream_read_timeout
+                )
+    return _http_client
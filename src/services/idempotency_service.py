@@ -0,0 +1,129 @@
+"""
+幂等请求服务
+"""
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from ..models.idempotency_key import IdempotencyKey
+from ..utils.errors import ApiError, ValidationError
+from ..utils.singleflight import SingleFlight
+from ..config import get_config
+
+
+class IdempotencyService:
+    """幂等请求服务
+
+    客户端为一次提交附带 Idempotency-Key，重试时（网络超时、重复点击）
+    返回第一次提交的响应，而不是重新发起一次付费生成。记录保存在数据库中，
+    多个 worker 之间共享；同一进程内并发的相同请求直接合并。
+    """
+
+    MAX_KEY_LENGTH = 255
+    # 清理过期记录的最小间隔（秒）
+    PRUNE_INTERVAL = 3600
+
+    def __init__(self, ttl_hours: float = 24.0):
+        self.ttl = timedelta(hours=ttl_hours)
+        self.flights = SingleFlight()
+        self._lock = threading.Lock()
+        self._last_prune = 0.0
+        self._stats = {"executed": 0, "replayed": 0, "conflicts": 0}
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._stats[name] += 1
+
+    def run(self,
+            user_id: Optional[int],
+            key: str,
+            request_hash: str,
+            fn: Callable[[], Dict[str, Any]]) -> Tuple[Dict[str, Any], bool]:
+        """按幂等键执行请求，返回 (响应, 是否为重放的响应)"""
+        key = key.strip()
+        if not key or len(key) > self.MAX_KEY_LENGTH:
+            raise ValidationError(f"Idempotency-Key 长度必须在 1-{self.MAX_KEY_LENGTH} 之间")
+
+        uid = user_id or 0
+        self._prune_expired()
+        result, shared = self.flights.do(
+            (uid, key, request_hash),
+            lambda: self._run(uid, key, request_hash, fn)
+        )
+        if shared:
+            self._count("replayed")
+            return result[0], True
+        return result
+
+    def _run(self,
+             uid: int,
+             key: str,
+             request_hash: str,
+             fn: Callable[[], Dict[str, Any]]) -> Tuple[Dict[str, Any], bool]:
+        record = IdempotencyKey.get(uid, key)
+        if record is not None and self._expired(record):
+            IdempotencyKey.release(uid, key)
+            record = None
+
+        if record is None:
+            if IdempotencyKey.reserve(uid, key, request_hash):
+                return self._execute(uid, key, fn), False
+            # 其他进程刚刚占用了该键
+            record = IdempotencyKey.get(uid, key)
+
+        if record is None or record.request_hash != request_hash:
+            self._count("conflicts")
+            raise ApiError("Idempotency-Key 已用于不同的请求", status_code=422)
+        if record.response is None:
+            self._count("conflicts")
+            raise ApiError("相同 Idempotency-Key 的请求正在处理中，请稍后重试", status_code=409)
+
+        self._count("replayed")
+        return record.response, True
+
+    def _execute(self, uid: int, key: str, fn: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+        """执行请求；只保存上游成功受理的响应，失败时释放幂等键以便重试"""
+        try:
+            result = fn()
+        except BaseException:
+            IdempotencyKey.release(uid, key)
+            raise
+
+        if isinstance(result, dict) and result.get("code") == 0:
+            IdempotencyKey.complete(uid, key, result)
+        else:
+            IdempotencyKey.release(uid, key)
+        self._count("executed")
+        return result
+
+    def _expired(self, record: IdempotencyKey) -> bool:
+        return datetime.fromisoformat(record.created_at) < datetime.utcnow() - self.ttl
+
+    def _prune_expired(self) -> None:
+        """定期清理过期记录"""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_prune < self.PRUNE_INTERVAL:
+                return
+            self._last_prune = now
+        IdempotencyKey.delete_before((datetime.utcnow() - self.ttl).isoformat())
+
+    def get_stats(self) -> Dict:
+        """获取统计信息"""
+        with self._lock:
+            return dict(self._stats, flights=self.flights.get_stats())
+
+
+# 全局幂等请求服务实例
+_idempotency_service: Optional[IdempotencyService] = None
+
+
+def get_idempotency_service() -> IdempotencyService:
+    """获取幂等请求服务实例（单例模式）"""
+    global _idempotency_service
+    if _idempotency_service is None:
+        _idempotency_service = IdempotencyService(
+            ttl_hours=get_config().idempotency_ttl_hours
+        )
+    return _idempotency_service
@@ -0,0 +1,209 @@
+"""
+参考图预处理
+"""
+import atexit
+import io
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # 可选依赖，未安装时不做预处理
+    Image = None
+
+from ..utils.cache import TTLCache
+from ..utils.errors import ValidationError
+from ..config import get_config
+from .image_store import REF_PREFIX, get_image_store
+
+# 输出分辨率 -> 参考图最长边（像素）
+MAX_EDGES = {"1K": 1024, "2K": 2048, "4K": 4096}
+DEFAULT_MAX_EDGE = MAX_EDGES["1K"]
+
+
+def downscale_image(path: str, max_edge: int, quality: int) -> Optional[bytes]:
+    """缩小并重新编码图片（在子进程中执行），不需要处理或处理后没有变小时返回 None"""
+    with Image.open(path) as image:
+        if getattr(image, "is_animated", False) or max(image.size) <= max_edge:
+            return None
+        # JPEG 直接按接近目标的比例解码，减少解码的像素量
+        image.draft("RGB", (max_edge, max_edge))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+        buffer = io.BytesIO()
+        if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+            image.save(buffer, "PNG", optimize=True)
+        else:
+            image.convert("RGB").save(buffer, "JPEG", quality=quality, optimize=True)
+
+    data = buffer.getvalue()
+    return data if len(data) < os.path.getsize(path) else None
+
+
+def make_thumbnail(source: str, target: str, max_edge: int) -> None:
+    """生成 JPEG 缩略图并写入 target（在子进程中执行）"""
+    with Image.open(source) as image:
+        image.draft("RGB", (max_edge, max_edge))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        if image.mode in ("RGBA", "LA", "P"):
+            # 透明背景铺白色
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+
+        tmp_path = f"{target}.{os.getpid()}.tmp"
+        image.convert("RGB").save(tmp_path, "JPEG", quality=80, optimize=True)
+    os.replace(tmp_path, target)
+
+
+class ImagePreprocessor:
+    """参考图预处理
+
+    用户常直接上传手机原图，尺寸远超请求的输出分辨率（imageSize）。发送上游
+    之前在进程池中把参考图缩小到输出分辨率所需的大小并重新编码，减少上传
+    流量和上游处理时间。结果按原图内容摘要缓存，同一张图只处理一次；处理
+    失败或超时时使用原图。生成结果图的缩略图也使用同一个进程池。
+    """
+
+    def __init__(self, workers: int = 2, quality: int = 90, timeout: float = 20.0):
+        self.workers = workers
+        self.quality = quality
+        self.timeout = timeout
+        # (原图摘要, 最长边) -> (处理后的引用, 节省的字节数)
+        self.cache = TTLCache(max_size=4096, ttl=86400)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._stats = {
+            "processed": 0, "unchanged": 0, "cache_hits": 0, "failed": 0,
+            "bytes_in": 0, "bytes_out": 0, "bytes_saved": 0, "thumbnails": 0,
+        }
+
+    @property
+    def enabled(self) -> bool:
+        return Image is not None and self.workers > 0
+
+    def _count(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self._stats[name] += amount
+
+    def _submit(self, fn: Callable, *args: Any) -> Future:
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                # 使用 spawn：在多线程的服务进程中 fork 可能复制到被占用的锁
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+                self._pid = os.getpid()
+            executor = self._executor
+        return executor.submit(fn, *args)
+
+    @staticmethod
+    def max_edge(image_size: str) -> int:
+        """请求的输出分辨率对应的参考图最长边"""
+        return MAX_EDGES.get((image_size or "").strip().upper(), DEFAULT_MAX_EDGE)
+
+    def process_urls(self, urls: List[str], image_size: str = "") -> List[str]:
+        """处理参考图列表：data URL 先存入参考图存储，超出分辨率的图片替换为缩小后的引用"""
+        if not self.enabled or not urls:
+            return urls
+
+        image_store = get_image_store()
+        max_edge = self.max_edge(image_size)
+        result = list(urls)
+        pending = []
+        for index, value in enumerate(urls):
+            if value.startswith("data:"):
+                try:
+                    value = result[index] = image_store.save_data_url(value).ref
+                except ValidationError:
+                    continue
+            if not value.startswith(REF_PREFIX):
+                continue
+
+            image = image_store.get(value[len(REF_PREFIX):])
+            cached = self.cache.get((image.digest, max_edge))
+            if cached is not None:
+                result[index] = cached[0]
+                self._count("cache_hits")
+                self._count("bytes_saved", cached[1])
+                continue
+            pending.append((
+                index, image, self._submit(downscale_image, image.path, max_edge, self.quality)
+            ))
+
+        for index, image, future in pending:
+            try:
+                data = future.result(timeout=self.timeout)
+            except Exception:
+                # 处理失败（格式损坏、超时等）时使用原图
+                self._count("failed")
+                continue
+
+            if data is None:
+                entry = (image.ref, 0)
+                self._count("unchanged")
+            else:
+                resized = image_store.save(data)
+                entry = (resized.ref, image.size - resized.size)
+                self._count("processed")
+                self._count("bytes_in", image.size)
+                self._count("bytes_out", resized.size)
+            self.cache.set((image.digest, max_edge), entry)
+            result[index] = entry[0]
+            self._count("bytes_saved", entry[1])
+
+        return result
+
+    def thumbnail(self, source: str, target: str, max_edge: int) -> bool:
+        """在进程池中生成缩略图，未启用或生成失败时返回 False"""
+        if not self.enabled:
+            return False
+        try:
+            self._submit(make_thumbnail, source, target, max_edge).result(timeout=self.timeout)
+        except Exception:
+            self._count("failed")
+            return False
+        self._count("thumbnails")
+        return True
+
+    def shutdown(self) -> None:
+        """关闭进程池"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None and self._pid == os.getpid():
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def get_stats(self) -> Dict:
+        """获取处理统计信息"""
+        with self._lock:
+            return dict(self._stats, enabled=self.enabled, cached=len(self.cache))
+
+
+# 全局参考图预处理实例
+_image_preprocessor: Optional[ImagePreprocessor] = None
+_image_preprocessor_lock = threading.Lock()
+
+
+def get_image_preprocessor() -> ImagePreprocessor:
+    """获取参考图预处理实例（单例模式）"""
+    global _image_preprocessor
+    if _image_preprocessor is None:
+        with _image_preprocessor_lock:
+            if _image_preprocessor is None:
+                config = get_config()
+                preprocessor = ImagePreprocessor(
+                    workers=config.image_preprocess_workers,
+                    quality=config.image_preprocess_quality,
+                    timeout=config.image_preprocess_timeout
+                )
+                atexit.register(preprocessor.shutdown)
+                _image_preprocessor = preprocessor
+    return _image_preprocessor
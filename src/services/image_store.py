@@ -0,0 +1,430 @@
+"""
+参考图存储
+"""
+import asyncio
+import base64
+import binascii
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+from hashlib import sha256
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.formparser import parse_form_data
+
+from ..utils.errors import ApiError, NotFoundError, ValidationError
+from ..config import get_config
+
+# 引用格式：ref:<内容哈希>
+REF_PREFIX = "ref:"
+_DIGEST_RE = re.compile(r"^[0-9a-f]{32}$")
+
+# 文件头 -> (MIME 类型, 扩展名)
+_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "image/png", "png"),
+    (b"\xff\xd8\xff", "image/jpeg", "jpg"),
+    (b"GIF87a", "image/gif", "gif"),
+    (b"GIF89a", "image/gif", "gif"),
+)
+_EXTENSIONS = {"png": "image/png", "jpg": "image/jpeg", "gif": "image/gif", "webp": "image/webp"}
+
+
+def sniff_image_type(data: bytes) -> Optional[tuple]:
+    """根据文件头识别图片类型，返回 (MIME 类型, 扩展名)"""
+    for signature, content_type, extension in _SIGNATURES:
+        if data.startswith(signature):
+            return content_type, extension
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp", "webp"
+    return None
+
+
+class StoredImage:
+    """已存储的图片"""
+
+    def __init__(self, digest: str, content_type: str, extension: str, size: int, path: str):
+        self.digest = digest
+        self.content_type = content_type
+        self.extension = extension
+        self.size = size
+        self.path = path
+
+    @property
+    def ref(self) -> str:
+        return f"{REF_PREFIX}{self.digest}"
+
+    @property
+    def filename(self) -> str:
+        return f"{self.digest}.{self.extension}"
+
+    def to_dict(self) -> Dict:
+        return {
+            "ref": self.ref,
+            "contentType": self.content_type,
+            "size": self.size,
+            "url": f"/api/images/{self.filename}",
+        }
+
+
+def _too_large(max_bytes: int) -> ApiError:
+    max_mb = max_bytes // (1024 * 1024)
+    return ApiError(f"单张参考图大小超出限制（最大 {max_mb} MB）", status_code=413)
+
+
+class ImageUpload:
+    """正在写入临时文件的上传图片
+
+    边写入边计算摘要并检查大小，超出限制时立即拒绝，不再继续读取；
+    内存占用只取决于调用方每次写入的块大小，与图片大小无关。
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        os.makedirs(directory, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(dir=directory, suffix=".upload")
+        self._file = os.fdopen(fd, "w+b")
+        self._hash = sha256()
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.head = b""
+
+    def write(self, data: bytes) -> int:
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            raise _too_large(self.max_bytes)
+        if len(self.head) < 16:
+            self.head += data[:16 - len(self.head)]
+        self._hash.update(data)
+        return self._file.write(data)
+
+    def read(self, size: int = -1) -> bytes:
+        return self._file.read(size)
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        return self._file.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._file.tell()
+
+    @property
+    def digest(self) -> str:
+        return self._hash.hexdigest()[:32]
+
+    def close(self) -> None:
+        """关闭并删除临时文件（已保存的上传会被移走，不受影响）"""
+        self._file.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class JsonBody:
+    """引用了本地参考图的上游请求体
+
+    未配置 PUBLIC_BASE_URL 时参考图要以 base64 data URL 内联在 JSON 中。
+    这里只序列化其余字段，图片部分在发送时按块读取文件并编码，
+    Content-Length 预先计算，不在内存中拼接完整请求体。
+    """
+
+    # 3 的倍数，分块编码的结果可以直接拼接
+    CHUNK_SIZE = 48 * 1024
+
+    def __init__(self, segments: List[Union[bytes, StoredImage]]):
+        self.segments = segments
+
+    def __len__(self) -> int:
+        return sum(
+            len(segment) if isinstance(segment, bytes) else (segment.size + 2) // 3 * 4
+            for segment in self.segments
+        )
+
+    def __iter__(self) -> Iterator[bytes]:
+        for segment in self.segments:
+            if isinstance(segment, bytes):
+                yield segment
+                continue
+            with open(segment.path, "rb") as handle:
+                while True:
+                    chunk = handle.read(self.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield base64.b64encode(chunk)
+
+    async def aiter_chunks(self):
+        """异步读取（文件读取放到线程中执行）"""
+        for segment in self.segments:
+            if isinstance(segment, bytes):
+                yield segment
+                continue
+            handle = await asyncio.to_thread(open, segment.path, "rb")
+            try:
+                while True:
+                    chunk = await asyncio.to_thread(handle.read, self.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield base64.b64encode(chunk)
+            finally:
+                handle.close()
+
+
+class ImageStore:
+    """按内容寻址的参考图存储
+
+    上传的图片按 SHA-256 摘要（前 32 位十六进制）保存在本地磁盘，相同内容
+    只保存一份。客户端之后只需在 urls 中传 ref:<摘要>，发送上游请求时再
+    展开：配置了 PUBLIC_BASE_URL 时传给上游可公开访问的地址，否则读取文件
+    以 base64 data URL 内联。超过保留天数未被使用的图片由后台线程定期清理。
+    """
+
+    # 后台清理过期图片的间隔（秒）
+    PRUNE_INTERVAL = 3600
+    # multipart 表单中文本字段的总大小上限
+    MAX_FORM_MEMORY = 256 * 1024
+
+    def __init__(self,
+                 root_dir: str,
+                 max_bytes: int,
+                 retention_days: int = 7,
+                 public_base_url: str = ""):
+        self.root_dir = root_dir
+        self.max_bytes = max_bytes
+        self.retention_days = retention_days
+        self.public_base_url = public_base_url.rstrip("/")
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._pid = os.getpid()
+        self._stats = {"uploads": 0, "deduplicated": 0, "resolved": 0, "rejected": 0, "pruned": 0}
+
+    def _count(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self._stats[name] += amount
+
+    def _ensure_worker(self) -> None:
+        """启动（或 fork 后重新启动）后台清理线程"""
+        if self.retention_days <= 0:
+            return
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = None
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="image-store-prune", daemon=True
+                )
+                self._thread.start()
+
+    def _path(self, digest: str, extension: str) -> str:
+        return os.path.join(self.root_dir, digest[:2], f"{digest}.{extension}")
+
+    def create_upload(self) -> ImageUpload:
+        """创建上传临时文件（与存储目录在同一文件系统，保存时直接重命名）"""
+        return ImageUpload(self.root_dir, self.max_bytes)
+
+    def commit(self, upload: ImageUpload) -> StoredImage:
+        """保存写入完成的上传，内容相同的图片只保存一份"""
+        try:
+            if not upload.size:
+                raise ValidationError("图片内容为空")
+            detected = sniff_image_type(upload.head)
+            if detected is None:
+                raise ValidationError("仅支持 PNG、JPEG、GIF、WebP 图片")
+
+            content_type, extension = detected
+            digest = upload.digest
+            path = self._path(digest, extension)
+            self._count("uploads")
+
+            try:
+                # 已存在：更新修改时间，推迟清理
+                os.utime(path)
+                self._count("deduplicated")
+            except FileNotFoundError:
+                # 不存在，或刚被清理：保存本次上传
+                upload._file.flush()
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(upload.path, path)
+        finally:
+            upload.close()
+
+        self._ensure_worker()
+        return StoredImage(digest, content_type, extension, upload.size, path)
+
+    def save(self, data: bytes) -> StoredImage:
+        """保存图片，内容相同的图片只保存一份"""
+        if len(data) > self.max_bytes:
+            raise ValidationError(_too_large(self.max_bytes).message)
+        upload = self.create_upload()
+        try:
+            upload.write(data)
+        except BaseException:
+            upload.close()
+            raise
+        return self.commit(upload)
+
+    def save_data_url(self, data_url: str) -> StoredImage:
+        """保存 data URL 形式的图片"""
+        try:
+            header, encoded = data_url.split(",", 1)
+            data = base64.b64decode(encoded, validate=True)
+        except (ValueError, binascii.Error):
+            raise ValidationError("参考图数据格式无效")
+        return self.save(data)
+
+    def save_multipart(self, environ: Dict[str, Any], max_files: int) -> Tuple[Dict[str, List[str]], List[StoredImage]]:
+        """流式解析 multipart/form-data 请求，返回 (文本字段, 保存的图片)
+
+        文件部分按块直接写入临时文件，单张超出大小限制时立即中止解析；
+        分段自带 Content-Length 时在读取之前就拒绝。
+        """
+        uploads: List[ImageUpload] = []
+
+        def stream_factory(total_content_length, content_type, filename, content_length=None):
+            if len(uploads) >= max_files:
+                raise ValidationError(f"参考图数量最多 {max_files} 张")
+            if content_length and content_length > self.max_bytes:
+                raise _too_large(self.max_bytes)
+            upload = self.create_upload()
+            uploads.append(upload)
+            return upload
+
+        try:
+            try:
+                _, form, files = parse_form_data(
+                    environ,
+                    stream_factory=stream_factory,
+                    max_form_memory_size=self.MAX_FORM_MEMORY,
+                    max_form_parts=max_files + 32,
+                    silent=False
+                )
+            except RequestEntityTooLarge:
+                raise ApiError("请求体过大", status_code=413)
+            except ValueError:
+                raise ValidationError("multipart 请求格式无效")
+            images = [self.commit(file.stream) for _, file in files.items(multi=True)]
+        except ApiError as exc:
+            if exc.status_code == 413:
+                self._count("rejected")
+            raise
+        finally:
+            for upload in uploads:
+                upload.close()
+
+        fields = {name: form.getlist(name) for name in form.keys()}
+        return fields, images
+
+    def get(self, digest: str) -> StoredImage:
+        """根据摘要查找图片"""
+        if not _DIGEST_RE.match(digest):
+            raise NotFoundError("参考图不存在或已过期")
+        for extension, content_type in _EXTENSIONS.items():
+            path = self._path(digest, extension)
+            if os.path.exists(path):
+                return StoredImage(digest, content_type, extension, os.path.getsize(path), path)
+        raise NotFoundError("参考图不存在或已过期")
+
+    def get_by_filename(self, filename: str) -> StoredImage:
+        """根据文件名（摘要.扩展名）查找图片"""
+        digest, _, extension = filename.partition(".")
+        image = self.get(digest)
+        if extension and extension != image.extension:
+            raise NotFoundError("参考图不存在或已过期")
+        return image
+
+    def check_refs(self, urls: List[str]) -> None:
+        """确认 ref:<摘要> 引用的图片存在，并更新修改时间推迟清理"""
+        for value in urls:
+            if value.startswith(REF_PREFIX):
+                try:
+                    os.utime(self.get(value[len(REF_PREFIX):]).path)
+                except FileNotFoundError:
+                    # 查找之后刚被清理
+                    raise NotFoundError("参考图不存在或已过期")
+
+    def encode_json(self, payload: Dict[str, Any]) -> Union[bytes, JsonBody]:
+        """序列化上游请求体，展开 urls 中的 ref:<摘要> 引用"""
+        urls = payload.get("urls") or []
+        refs = [value for value in urls if isinstance(value, str) and value.startswith(REF_PREFIX)]
+        if not refs:
+            return json.dumps(payload).encode("utf-8")
+
+        images = {value: self.get(value[len(REF_PREFIX):]) for value in refs}
+        self._count("resolved", len(refs))
+        if self.public_base_url:
+            resolved = [
+                f"{self.public_base_url}/api/images/{images[value].filename}" if value in images else value
+                for value in urls
+            ]
+            return json.dumps(dict(payload, urls=resolved)).encode("utf-8")
+
+        # 先用随机占位符序列化，再把占位符替换为按块编码的图片
+        tokens: List[Tuple[str, StoredImage]] = []
+        placeholders = []
+        for value in urls:
+            if value in images:
+                token = f"@image-{uuid.uuid4().hex}"
+                tokens.append((token, images[value]))
+                placeholders.append(token)
+            else:
+                placeholders.append(value)
+
+        text = json.dumps(dict(payload, urls=placeholders))
+        segments: List[Union[bytes, StoredImage]] = []
+        for token, image in tokens:
+            before, text = text.split(token, 1)
+            segments.append(f"{before}data:{image.content_type};base64,".encode("utf-8"))
+            segments.append(image)
+        segments.append(text.encode("utf-8"))
+        return JsonBody(segments)
+
+    def _run(self) -> None:
+        """后台清理循环"""
+        while True:
+            try:
+                self._prune_expired()
+            except Exception:
+                traceback.print_exc()
+            time.sleep(self.PRUNE_INTERVAL)
+
+    def _prune_expired(self) -> None:
+        """删除超过保留天数未被使用的图片"""
+        cutoff = time.time() - self.retention_days * 86400
+        removed = 0
+        for directory, _, filenames in os.walk(self.root_dir):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.unlink(path)
+                        removed += 1
+                except FileNotFoundError:
+                    continue
+        self._count("pruned", removed)
+
+    def get_stats(self) -> Dict:
+        """获取存储统计信息"""
+        with self._lock:
+            return dict(self._stats)
+
+
+# 全局参考图存储实例
+_image_store: Optional[ImageStore] = None
+
+
+def get_image_store() -> ImageStore:
+    """获取参考图存储实例（单例模式）"""
+    global _image_store
+    if _image_store is None:
+        config = get_config()
+        _image_store = ImageStore(
+            root_dir=config.image_store_dir,
+            max_bytes=config.max_reference_image_bytes,
+            retention_days=config.image_store_retention_days,
+            public_base_url=config.public_base_url
+        )
+    return _image_store
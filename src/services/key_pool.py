@@ -0,0 +1,315 @@
+"""
+API密钥池
+"""
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from ..utils.errors import UpstreamError
+from ..config import get_config
+
+# 换一个密钥重试的上游状态码（限流、密钥无效或无权限）
+RETRY_STATUSES = (429, 401, 403)
+# 冷却时间上限（秒），上游的 Retry-After 也不超过该值
+MAX_COOLDOWN = 300.0
+# 连续多少次 5xx 后暂停使用该密钥
+MAX_CONSECUTIVE_ERRORS = 3
+# 错误率滑动平均的权重
+ERROR_RATE_ALPHA = 0.2
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """解析 Retry-After 响应头（只支持秒数形式）"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value.strip()))
+    except ValueError:
+        return None
+
+
+class KeyState:
+    """单个密钥在本进程中的使用状态"""
+
+    def __init__(self, value: str):
+        self.value = value
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self.consecutive_errors = 0
+        self.rate_limit_streak = 0
+        # 错误率的指数滑动平均，用于加权轮询
+        self.error_rate = 0.0
+        self.cooldown_until = 0.0
+        self.last_used = 0.0
+        # 平滑加权轮询的当前权重
+        self.current_weight = 0
+
+    @property
+    def weight(self) -> int:
+        return max(1, round(10 * (1 - self.error_rate)))
+
+    def to_dict(self, now: float) -> Dict[str, Any]:
+        cooldown = max(0.0, self.cooldown_until - now)
+        return {
+            "inFlight": self.in_flight,
+            "requests": self.requests,
+            "errors": self.errors,
+            "rateLimited": self.rate_limited,
+            "errorRate": round(self.error_rate, 3),
+            "coolingDown": cooldown > 0,
+            "cooldownSeconds": round(cooldown, 1),
+        }
+
+
+class KeyLease:
+    """一次上游请求占用的密钥"""
+
+    def __init__(self, key: Tuple[int, str], api_key: str, state: KeyState):
+        self.key = key
+        self.api_key = api_key
+        self.state = state
+        self.released = False
+
+    @property
+    def key_id(self) -> str:
+        return self.key[1]
+
+
+class KeyPool:
+    """API密钥池
+
+    启用后上游请求不再只用活动密钥，而是在用户登记的全部密钥之间分配：
+    least_in_flight 选择进行中请求最少的密钥，round_robin 按平滑加权轮询
+    分配（权重随错误率降低）。上游返回 429 的密钥按 Retry-After（没有时
+    指数退避）冷却，401/403 的密钥长时间冷却，连续 5xx 的密钥短暂冷却；
+    这些状态码会透明地换一个未尝试过的密钥重试。状态只保存在本进程内存中，
+    流式请求在收到响应头后即归还密钥。密钥被删除后其状态随之丢弃（其他
+    worker 在该用户下一次请求时丢弃）。
+    """
+
+    MODES = ("least_in_flight", "round_robin")
+
+    def __init__(self, mode: str = "", cooldown: float = 30.0, max_attempts: int = 3):
+        self.mode = mode if mode in self.MODES else ""
+        self.cooldown = cooldown
+        self.max_attempts = max(1, max_attempts)
+        self._lock = threading.Lock()
+        # 用户ID -> 密钥ID -> 状态，未登录请求的用户ID记为 0
+        self._states: Dict[int, Dict[str, KeyState]] = {}
+        self._stats = {"requests": 0, "retries": 0, "cooldowns": 0, "exhausted": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.mode)
+
+    @staticmethod
+    def identity(user_id: Optional[int]) -> Dict[str, str]:
+        """请求合并使用的伪请求头：同一用户的相同请求不论分到哪个密钥都合并"""
+        return {"Authorization": f"pool:{user_id or 0}"}
+
+    def health(self, user_id: Optional[int], key_id: str) -> Optional[Dict[str, Any]]:
+        """密钥的健康状态（本进程尚未使用过时返回 None）"""
+        with self._lock:
+            state = self._states.get(user_id or 0, {}).get(key_id)
+            return state.to_dict(time.monotonic()) if state else None
+
+    def forget(self, user_id: Optional[int], key_ids: Iterable[str]) -> None:
+        """丢弃已删除密钥的状态（进行中的请求仍可正常归还）"""
+        with self._lock:
+            states = self._states.get(user_id or 0)
+            if states is None:
+                return
+            for key_id in key_ids:
+                states.pop(key_id, None)
+            if not states:
+                del self._states[user_id or 0]
+
+    def acquire(self,
+                user_id: Optional[int],
+                keys: Iterable[Tuple[str, str]],
+                exclude: Set[str]) -> Optional[KeyLease]:
+        """选择一个未排除的密钥；全部在冷却时选择最早结束冷却的，没有候选密钥时返回 None"""
+        now = time.monotonic()
+        keys = list(keys)
+        with self._lock:
+            states = self._states.setdefault(user_id or 0, {})
+            # 已不在密钥列表中的密钥（在其他 worker 中被删除）不再统计
+            for key_id in states.keys() - {key_id for key_id, _ in keys}:
+                del states[key_id]
+
+            candidates: List[Tuple[Tuple[int, str], str, KeyState]] = []
+            for key_id, value in keys:
+                if key_id in exclude:
+                    continue
+                state = states.get(key_id)
+                if state is None or state.value != value:
+                    # 新密钥或密钥值已更换，重新统计
+                    state = states[key_id] = KeyState(value)
+                candidates.append(((user_id or 0, key_id), value, state))
+            if not candidates:
+                return None
+
+            available = [item for item in candidates if item[2].cooldown_until <= now]
+            if not available:
+                chosen = min(candidates, key=lambda item: item[2].cooldown_until)
+            elif self.mode == "round_robin":
+                total = 0
+                for item in available:
+                    item[2].current_weight += item[2].weight
+                    total += item[2].weight
+                chosen = max(available, key=lambda item: item[2].current_weight)
+                chosen[2].current_weight -= total
+            else:
+                chosen = min(available, key=lambda item: (item[2].in_flight, item[2].last_used))
+
+            key, value, state = chosen
+            state.in_flight += 1
+            state.requests += 1
+            state.last_used = now
+            self._stats["requests"] += 1
+            return KeyLease(key, value, state)
+
+    def release(self,
+                lease: KeyLease,
+                status: Optional[int],
+                retry_after: Optional[float] = None) -> None:
+        """归还密钥并按上游状态码更新健康状态（status 为 None 表示网络错误或已取消，不计入）"""
+        with self._lock:
+            if lease.released:
+                return
+            lease.released = True
+            state = lease.state
+            state.in_flight -= 1
+            if status is None:
+                return
+
+            now = time.monotonic()
+            if status == 429:
+                state.rate_limited += 1
+                state.rate_limit_streak += 1
+                if retry_after is None:
+                    retry_after = self.cooldown * 2 ** min(state.rate_limit_streak - 1, 3)
+                self._cool(state, now + min(retry_after, MAX_COOLDOWN))
+                return
+
+            failed = status in (401, 403) or status >= 500
+            state.error_rate += ERROR_RATE_ALPHA * ((1.0 if failed else 0.0) - state.error_rate)
+            if not failed:
+                # 其余 4xx 是请求本身的问题，不影响密钥的健康状态；冷却中被选中且成功时提前结束冷却
+                state.consecutive_errors = 0
+                state.rate_limit_streak = 0
+                state.cooldown_until = 0.0
+                return
+
+            state.errors += 1
+            if status in (401, 403):
+                self._cool(state, now + min(self.cooldown * 10, MAX_COOLDOWN))
+                return
+            state.consecutive_errors += 1
+            if state.consecutive_errors >= MAX_CONSECUTIVE_ERRORS:
+                state.consecutive_errors = 0
+                self._cool(state, now + self.cooldown)
+
+    def _cool(self, state: KeyState, until: float) -> None:
+        if until > state.cooldown_until:
+            state.cooldown_until = until
+            self._stats["cooldowns"] += 1
+
+    def _should_retry(self, exc: UpstreamError, tried: int, keys: int) -> bool:
+        """是否换一个密钥重试（密钥用完或达到最大尝试次数时放弃）"""
+        retry = exc.upstream_status in RETRY_STATUSES
+        with self._lock:
+            if retry and tried < min(self.max_attempts, keys):
+                self._stats["retries"] += 1
+                return True
+            if retry:
+                self._stats["exhausted"] += 1
+        return False
+
+    @staticmethod
+    def _pinned(keys: List[Tuple[str, str]], key_id: Optional[str]) -> Set[str]:
+        """固定使用 key_id 时需要排除的其他密钥（key_id 不在 keys 中时不固定）"""
+        if key_id is None or all(item_id != key_id for item_id, _ in keys):
+            return set()
+        return {item_id for item_id, _ in keys if item_id != key_id}
+
+    def run(self,
+            user_id: Optional[int],
+            keys: List[Tuple[str, str]],
+            send: Callable[[str], Any],
+            key_id: Optional[str] = None) -> Any:
+        """用池中的密钥调用 send(api_key)，限流或密钥失效时换一个密钥重试（keys 不能为空）
+
+        指定 key_id 时只使用该密钥，不选择也不换密钥重试（绘图任务只能用提交它的密钥查询）。
+        """
+        tried = self._pinned(keys, key_id)
+        while True:
+            lease = self.acquire(user_id, keys, tried)
+            tried.add(lease.key_id)
+            try:
+                result = send(lease.api_key)
+            except UpstreamError as exc:
+                self.release(lease, exc.upstream_status, exc.retry_after)
+                if self._should_retry(exc, len(tried), len(keys)):
+                    continue
+                raise
+            except BaseException:
+                self.release(lease, None)
+                raise
+            self.release(lease, 200)
+            return result
+
+    async def arun(self,
+                   user_id: Optional[int],
+                   keys: List[Tuple[str, str]],
+                   send: Callable[[str], Awaitable[Any]],
+                   key_id: Optional[str] = None) -> Any:
+        """run 的异步版本"""
+        tried = self._pinned(keys, key_id)
+        while True:
+            lease = self.acquire(user_id, keys, tried)
+            tried.add(lease.key_id)
+            try:
+                result = await send(lease.api_key)
+            except UpstreamError as exc:
+                self.release(lease, exc.upstream_status, exc.retry_after)
+                if self._should_retry(exc, len(tried), len(keys)):
+                    continue
+                raise
+            except BaseException:
+                self.release(lease, None)
+                raise
+            self.release(lease, 200)
+            return result
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取密钥池统计信息"""
+        now = time.monotonic()
+        with self._lock:
+            states = [state for user_states in self._states.values() for state in user_states.values()]
+            return dict(
+                self._stats,
+                mode=self.mode or None,
+                keys=len(states),
+                in_flight=sum(state.in_flight for state in states),
+                cooling=sum(1 for state in states if state.cooldown_until > now),
+            )
+
+
+# 全局密钥池实例
+_key_pool: Optional[KeyPool] = None
+
+
+def get_key_pool() -> KeyPool:
+    """获取密钥池实例（单例模式）"""
+    global _key_pool
+    if _key_pool is None:
+        config = get_config()
+        _key_pool = KeyPool(
+            mode=config.key_pool_mode,
+            cooldown=config.key_pool_cooldown,
+            max_attempts=config.key_pool_max_attempts
+        )
+    return _key_pool
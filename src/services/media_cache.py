@@ -0,0 +1,241 @@
+"""
+生成结果图片缓存
+"""
+import os
+import tempfile
+import threading
+import time
+from hashlib import sha256
+from typing import Dict, Optional
+
+import requests
+
+from ..utils.errors import ApiError, NotFoundError
+from ..utils.singleflight import SingleFlight
+from ..config import get_config
+from .http_client import get_http_client
+from .image_preprocessor import get_image_preprocessor
+from .image_store import sniff_image_type
+
+_EXTENSIONS = {"png": "image/png", "jpg": "image/jpeg", "webp": "image/webp", "gif": "image/gif"}
+
+
+class CachedMedia:
+    """已缓存的图片文件"""
+
+    def __init__(self, path: str, content_type: str, etag: str):
+        self.path = path
+        self.content_type = content_type
+        self.etag = etag
+
+
+class MediaCache:
+    """生成结果图片的本地磁盘缓存
+
+    上游返回的图片地址有效期只有 2 小时，每次预览都要经过上游 CDN。结果
+    成功后第一次访问时把图片下载到本地（并发访问只下载一次），之后直接
+    从磁盘发送；缩略图在进程池中生成。缓存键包含用户ID，文件存在即说明
+    归属正确，不需要再查询结果。总大小超出上限时按最近访问时间淘汰。
+    """
+
+    # 单张图片的下载上限
+    MAX_DOWNLOAD_BYTES = 50 * 1024 * 1024
+    # 命中时更新修改时间（淘汰依据）的最小间隔（秒）
+    TOUCH_INTERVAL = 3600
+
+    def __init__(self, root_dir: str, max_bytes: int, thumbnail_size: int = 384):
+        self.root_dir = root_dir
+        self.max_bytes = max_bytes
+        self.thumbnail_size = thumbnail_size
+        self.flights = SingleFlight()
+        self._lock = threading.Lock()
+        self._evict_lock = threading.Lock()
+        # 缓存目录总大小（首次写入时扫描得到）
+        self._total_bytes: Optional[int] = None
+        self._stats = {
+            "hits": 0, "downloads": 0, "download_bytes": 0,
+            "thumbnails": 0, "evicted": 0, "download_errors": 0,
+        }
+
+    def _count(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self._stats[name] += amount
+
+    @staticmethod
+    def cache_key(user_id: Optional[int], draw_id: str, index: int) -> str:
+        return sha256(f"{user_id or 0}:{draw_id}:{index}".encode("utf-8")).hexdigest()[:32]
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.root_dir, name[:2], name)
+
+    def _find(self, key: str, suffix: str = "") -> Optional[CachedMedia]:
+        for extension, content_type in _EXTENSIONS.items():
+            path = self._path(f"{key}{suffix}.{extension}")
+            try:
+                if time.time() - os.stat(path).st_mtime > self.TOUCH_INTERVAL:
+                    os.utime(path)
+            except FileNotFoundError:
+                # 不存在，或刚被淘汰
+                continue
+            return CachedMedia(path, content_type, f"{key}{suffix}")
+        return None
+
+    def get(self, user_id: Optional[int], draw_id: str, index: int) -> Optional[CachedMedia]:
+        """查找已缓存的原图"""
+        media = self._find(self.cache_key(user_id, draw_id, index))
+        if media is not None:
+            self._count("hits")
+        return media
+
+    def fetch(self, user_id: Optional[int], draw_id: str, index: int, url: str) -> CachedMedia:
+        """下载并缓存原图（相同图片的并发请求只下载一次）"""
+        key = self.cache_key(user_id, draw_id, index)
+        media, _ = self.flights.do(key, lambda: self._find(key) or self._download(key, url))
+        return media
+
+    def _download(self, key: str, url: str) -> CachedMedia:
+        """流式下载到临时文件，识别格式后移动到缓存目录"""
+        os.makedirs(self.root_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.root_dir, suffix=".download")
+        size = 0
+        head = b""
+        try:
+            with os.fdopen(fd, "wb") as handle:
+                with get_http_client().get(url, stream=True) as response:
+                    response.raise_for_status()
+                    for chunk in response.iter_content(64 * 1024):
+                        size += len(chunk)
+                        if size > self.MAX_DOWNLOAD_BYTES:
+                            raise ApiError("结果图片过大", status_code=502)
+                        if len(head) < 16:
+                            head += chunk[:16 - len(head)]
+                        handle.write(chunk)
+
+            detected = sniff_image_type(head)
+            if detected is None:
+                raise ApiError("结果图片格式无法识别", status_code=502)
+            content_type, extension = detected
+            path = self._path(f"{key}.{extension}")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+        except requests.HTTPError as exc:
+            self._count("download_errors")
+            if exc.response is not None and exc.response.status_code in (403, 404, 410):
+                raise NotFoundError("结果图片已过期")
+            raise ApiError(f"下载结果图片失败: {exc}", status_code=502)
+        except requests.RequestException as exc:
+            self._count("download_errors")
+            raise ApiError(f"下载结果图片失败: {exc}", status_code=502)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+        self._count("downloads")
+        self._count("download_bytes", size)
+        self._added(size)
+        return CachedMedia(path, content_type, key)
+
+    def thumbnail(self, media: CachedMedia) -> CachedMedia:
+        """获取缩略图，无法生成时返回原图"""
+        suffix = f"-t{self.thumbnail_size}"
+        cached = self._find(media.etag, suffix)
+        if cached is not None:
+            return cached
+
+        def generate() -> CachedMedia:
+            cached = self._find(media.etag, suffix)
+            if cached is not None:
+                return cached
+            target = self._path(f"{media.etag}{suffix}.jpg")
+            if not get_image_preprocessor().thumbnail(media.path, target, self.thumbnail_size):
+                return media
+            self._count("thumbnails")
+            self._added(os.path.getsize(target))
+            return CachedMedia(target, "image/jpeg", f"{media.etag}{suffix}")
+
+        result, _ = self.flights.do(media.etag + suffix, generate)
+        return result
+
+    def _added(self, size: int) -> None:
+        """记录新增文件大小，超出上限时淘汰"""
+        with self._lock:
+            if self._total_bytes is not None:
+                self._total_bytes += size
+                total = self._total_bytes
+            else:
+                total = None
+        if total is None:
+            total = self._scan_total()
+        if total > self.max_bytes:
+            self._evict()
+
+    def _scan_total(self) -> int:
+        total = sum(
+            os.path.getsize(os.path.join(directory, filename))
+            for directory, _, filenames in os.walk(self.root_dir)
+            for filename in filenames
+        )
+        with self._lock:
+            self._total_bytes = total
+        return total
+
+    def _evict(self) -> None:
+        """按修改时间删除最旧的文件，直到总大小降到上限的 90%"""
+        if not self._evict_lock.acquire(blocking=False):
+            return
+        try:
+            files = []
+            for directory, _, filenames in os.walk(self.root_dir):
+                for filename in filenames:
+                    path = os.path.join(directory, filename)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, path))
+
+            total = sum(size for _, size, _ in files)
+            target = self.max_bytes * 0.9
+            removed = 0
+            for _, size, path in sorted(files):
+                if total <= target:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                removed += 1
+
+            with self._lock:
+                self._total_bytes = total
+                self._stats["evicted"] += removed
+        finally:
+            self._evict_lock.release()
+
+    def get_stats(self) -> Dict:
+        """获取缓存统计信息"""
+        with self._lock:
+            return dict(
+                self._stats,
+                total_bytes=self._total_bytes,
+                max_bytes=self.max_bytes,
+                flights=self.flights.get_stats()
+            )
+
+
+# 全局结果图片缓存实例
+_media_cache: Optional[MediaCache] = None
+
+
+def get_media_cache() -> MediaCache:
+    """获取结果图片缓存实例（单例模式）"""
+    global _media_cache
+    if _media_cache is None:
+        config = get_config()
+        _media_cache = MediaCache(
+            root_dir=config.media_cache_dir,
+            max_bytes=config.media_cache_max_mb * 1024 * 1024,
+            thumbnail_size=config.media_thumbnail_size
+        )
+    return _media_cache
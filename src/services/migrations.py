@@ -0,0 +1,255 @@
+"""
+数据库结构迁移
+"""
+import sqlite3
+from datetime import datetime
+from typing import Callable, List, Optional, Sequence
+
+
+class Migration:
+    """单个版本的结构迁移"""
+
+    def __init__(self,
+                 version: int,
+                 description: str,
+                 statements: Sequence[str] = (),
+                 apply: Optional[Callable[[sqlite3.Connection], None]] = None):
+        self.version = version
+        self.description = description
+        self.statements = statements
+        self.apply = apply
+
+    def run(self, conn: sqlite3.Connection) -> None:
+        """执行迁移"""
+        if self.apply is not None:
+            self.apply(conn)
+        for statement in self.statements:
+            conn.execute(statement)
+
+
+def _add_api_key_fingerprint(conn: sqlite3.Connection) -> None:
+    """为旧表补充指纹列（新建的表已包含该列）"""
+    columns = {row["name"] for row in conn.execute("PRAGMA table_info(api_keys)")}
+    if "fingerprint" not in columns:
+        conn.execute("ALTER TABLE api_keys ADD COLUMN fingerprint TEXT")
+
+
+def _backfill_api_key_fingerprints(conn: sqlite3.Connection) -> None:
+    """为指纹列上线前保存的密钥补充指纹
+
+    同一用户下的重复密钥违反唯一索引，保留空指纹；无法解密的密钥跳过。
+    """
+    from ..utils.encryption import get_encryption_service
+    encryption = get_encryption_service()
+
+    rows = conn.execute("SELECT id, value FROM api_keys WHERE fingerprint IS NULL").fetchall()
+    for row in rows:
+        value = encryption.decrypt(row["value"])
+        if not value:
+            continue
+        try:
+            conn.execute(
+                "UPDATE api_keys SET fingerprint = ? WHERE id = ?",
+                (encryption.fingerprint(value), row["id"])
+            )
+        except sqlite3.IntegrityError:
+            continue
+
+
+def _create_generations_fts(conn: sqlite3.Connection) -> None:
+    """创建提示词全文索引（SQLite 未编译 FTS5 时跳过，搜索回退到 LIKE）"""
+    try:
+        conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS generations_fts USING fts5("
+            "prompt, content='generations', content_rowid='id', tokenize='trigram')"
+        )
+    except sqlite3.OperationalError:
+        return
+
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS generations_fts_insert AFTER INSERT ON generations BEGIN
+            INSERT INTO generations_fts(rowid, prompt) VALUES (new.id, new.prompt);
+        END
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS generations_fts_delete AFTER DELETE ON generations BEGIN
+            INSERT INTO generations_fts(generations_fts, rowid, prompt)
+            VALUES ('delete', old.id, old.prompt);
+        END
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS generations_fts_update AFTER UPDATE OF prompt ON generations BEGIN
+            INSERT INTO generations_fts(generations_fts, rowid, prompt)
+            VALUES ('delete', old.id, old.prompt);
+            INSERT INTO generations_fts(rowid, prompt) VALUES (new.id, new.prompt);
+        END
+        """
+    )
+    conn.execute("INSERT INTO generations_fts(generations_fts) VALUES ('rebuild')")
+
+
+def _add_draw_result_callback_nonce(conn: sqlite3.Connection) -> None:
+    """为旧表补充回调随机数列（新建的表已包含该列）"""
+    columns = {row["name"] for row in conn.execute("PRAGMA table_info(draw_results)")}
+    if "callback_nonce" not in columns:
+        conn.execute("ALTER TABLE draw_results ADD COLUMN callback_nonce TEXT")
+
+
+def _add_generation_api_key_id(conn: sqlite3.Connection) -> None:
+    """为旧表补充提交所用密钥ID列（新建的表已包含该列）"""
+    columns = {row["name"] for row in conn.execute("PRAGMA table_info(generations)")}
+    if "api_key_id" not in columns:
+        conn.execute("ALTER TABLE generations ADD COLUMN api_key_id TEXT")
+
+
+# 按版本号顺序排列，已发布的迁移不要修改，只能追加新版本
+MIGRATIONS: List[Migration] = [
+    Migration(
+        1, "api_keys 增加密钥指纹列及唯一索引",
+        apply=_add_api_key_fingerprint,
+        statements=[
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_api_keys_user_fingerprint "
+            "ON api_keys(user_id, fingerprint)",
+        ]
+    ),
+    Migration(
+        2, "api_keys 按用户查询的复合索引",
+        statements=[
+            "CREATE INDEX IF NOT EXISTS idx_api_keys_user_created "
+            "ON api_keys(user_id, created_at)",
+            "CREATE INDEX IF NOT EXISTS idx_api_keys_user_active "
+            "ON api_keys(user_id, is_active)",
+        ]
+    ),
+    Migration(
+        3, "每个用户最多一个活动密钥",
+        statements=[
+            # 清理历史数据中的多个活动密钥，只保留最后写入的一个
+            """
+            UPDATE api_keys SET is_active = 0
+            WHERE is_active = 1 AND rowid NOT IN (
+                SELECT MAX(rowid) FROM api_keys WHERE is_active = 1 GROUP BY user_id
+            )
+            """,
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_api_keys_one_active "
+            "ON api_keys(user_id) WHERE is_active = 1",
+        ]
+    ),
+    Migration(
+        4, "usage_events 按用户和时间查询及清理的索引",
+        statements=[
+            "CREATE INDEX IF NOT EXISTS idx_usage_events_user_created "
+            "ON usage_events(user_id, created_at)",
+            "CREATE INDEX IF NOT EXISTS idx_usage_events_created "
+            "ON usage_events(created_at)",
+        ]
+    ),
+    Migration(
+        5, "draw_results 按更新时间清理的索引",
+        statements=[
+            "CREATE INDEX IF NOT EXISTS idx_draw_results_updated "
+            "ON draw_results(updated_at)",
+        ]
+    ),
+    Migration(
+        6, "idempotency_keys 按创建时间清理的索引",
+        statements=[
+            "CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created "
+            "ON idempotency_keys(created_at)",
+        ]
+    ),
+    Migration(
+        7, "generations 游标分页索引、绘图ID唯一索引及提示词全文索引",
+        apply=_create_generations_fts,
+        statements=[
+            "CREATE INDEX IF NOT EXISTS idx_generations_user_id "
+            "ON generations(user_id, id)",
+            "CREATE INDEX IF NOT EXISTS idx_generations_user_status_id "
+            "ON generations(user_id, status, id)",
+            "CREATE INDEX IF NOT EXISTS idx_generations_user_model_id "
+            "ON generations(user_id, model, id)",
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_generations_draw_id "
+            "ON generations(draw_id)",
+        ]
+    ),
+    Migration(
+        8, "chat_cache 按访问时间淘汰和按创建时间过期的索引",
+        statements=[
+            "CREATE INDEX IF NOT EXISTS idx_chat_cache_accessed "
+            "ON chat_cache(accessed_at)",
+            "CREATE INDEX IF NOT EXISTS idx_chat_cache_created "
+            "ON chat_cache(created_at)",
+        ]
+    ),
+    Migration(
+        9, "会话按用户分页、会话消息按 token 累计值截取上下文的索引",
+        statements=[
+            "CREATE INDEX IF NOT EXISTS idx_conversations_user_id "
+            "ON conversations(user_id, id)",
+            "CREATE INDEX IF NOT EXISTS idx_conversation_messages_offset "
+            "ON conversation_messages(conversation_id, token_offset)",
+            "CREATE INDEX IF NOT EXISTS idx_conversation_messages_id "
+            "ON conversation_messages(conversation_id, id)",
+        ]
+    ),
+    Migration(
+        10, "draw_results 增加回调随机数列（回调只能更新对应地址登记的任务）",
+        apply=_add_draw_result_callback_nonce
+    ),
+    Migration(
+        11, "为旧数据中的 API 密钥补充指纹（原先在每次启动时执行）",
+        apply=_backfill_api_key_fingerprints
+    ),
+    Migration(
+        12, "generations 增加提交所用密钥ID列（绘图结果只能用提交任务的密钥查询）",
+        apply=_add_generation_api_key_id
+    ),
+]
+
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    """获取当前数据库的结构版本号"""
+    row = conn.execute("SELECT MAX(version) AS version FROM schema_migrations").fetchone()
+    return row["version"] or 0
+
+
+def apply_migrations(db, migrations: Optional[List[Migration]] = None) -> List[int]:
+    """应用尚未执行的迁移，返回本次执行的版本号列表
+
+    整个过程在一个 BEGIN IMMEDIATE 事务中完成，多个 worker 同时启动时
+    只有拿到写锁的进程会执行迁移，其余进程等待后看到的已是最新版本。
+    """
+    migrations = sorted(migrations or MIGRATIONS, key=lambda item: item.version)
+    applied_now = []
+
+    with db.transaction() as conn:
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TEXT NOT NULL
+            )
+            """
+        )
+        applied = {
+            row["version"] for row in conn.execute("SELECT version FROM schema_migrations")
+        }
+
+        for migration in migrations:
+            if migration.version in applied:
+                continue
+            migration.run(conn)
+            conn.execute(
+                "INSERT INTO schema_migrations (version, description, applied_at) "
+                "VALUES (?, ?, ?)",
+                (migration.version, migration.description, datetime.utcnow().isoformat())
+            )
+            applied_now.append(migration.version)
+
+    return applied_now
@@ -0,0 +1,155 @@
+"""
+上游流式响应转发
+"""
+import socket
+import threading
+from typing import Dict, Iterator, Optional
+
+from ..config import get_config
+
+
+def is_event_stream(content_type: Optional[str]) -> bool:
+    """上游是否返回标准的 SSE 响应"""
+    return (content_type or "").split(";", 1)[0].strip().lower() == "text/event-stream"
+
+
+def format_stream_line(line: bytes) -> bytes:
+    """把上游的一行输出转换为 SSE 事件（上游不是 SSE 格式时使用）"""
+    text = line.decode("utf-8", errors="ignore")
+    payload = text if text.startswith("data:") else f"data: {text}"
+    return (payload + "\n\n").encode("utf-8")
+
+
+class StreamRelay:
+    """上游流式响应的直通转发
+
+    上游返回 text/event-stream 时不再按行拆分、解码再重新编码，而是把收到的
+    字节原样转发（SSE 的事件分隔保持不变），每次读取到数据就立即交给客户端，
+    单次最多 chunk_size 字节。客户端断开时服务器关闭生成器，随即关闭上游
+    连接，上游停止生成，不再为没人接收的内容付费。
+    """
+
+    def __init__(self, chunk_size: int = 65536):
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        self._stats = {"opened": 0, "completed": 0, "cancelled": 0, "bytes": 0, "line_mode": 0}
+
+    def _count(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self._stats[name] += amount
+
+    def _read_chunks(self, response) -> Iterator[bytes]:
+        """读取原始字节：有数据就返回，不等待凑满 chunk_size"""
+        raw = response.raw
+        read1 = getattr(raw, "read1", None)
+        if read1 is None:
+            # 旧版 urllib3 没有 read1，分块传输时 stream() 同样按收到的块返回
+            yield from raw.stream(self.chunk_size, decode_content=True)
+            return
+        while True:
+            chunk = read1(self.chunk_size, decode_content=True)
+            if not chunk:
+                return
+            yield chunk
+
+    def _read_lines(self, response) -> Iterator[bytes]:
+        for line in response.iter_lines():
+            if line:
+                yield format_stream_line(line)
+
+    def relay(self, response) -> "RelayedStream":
+        """转发 requests 的流式响应，结束或客户端断开时关闭上游连接"""
+        self._count("opened")
+        if is_event_stream(response.headers.get("Content-Type")):
+            chunks = self._read_chunks(response)
+        else:
+            self._count("line_mode")
+            chunks = self._read_lines(response)
+        return RelayedStream(self, response, chunks)
+
+    async def relay_async(self, response):
+        """转发 httpx 的流式响应（ASGI 模式），由调用方在断开时关闭上游连接"""
+        self._count("opened")
+        completed = False
+        try:
+            if is_event_stream(response.headers.get("content-type")):
+                async for chunk in response.aiter_bytes():
+                    self._count("bytes", len(chunk))
+                    yield chunk
+            else:
+                self._count("line_mode")
+                async for line in response.aiter_lines():
+                    if line:
+                        chunk = format_stream_line(line.encode("utf-8"))
+                        self._count("bytes", len(chunk))
+                        yield chunk
+            completed = True
+        finally:
+            self._count("completed" if completed else "cancelled")
+
+    def get_stats(self) -> Dict:
+        """获取转发统计信息"""
+        with self._lock:
+            return dict(self._stats, chunk_size=self.chunk_size)
+
+
+class RelayedStream:
+    """转发中的响应体
+
+    WSGI 服务器在响应结束或客户端断开时调用 close()。这里不用生成器的
+    finally 关闭上游：生成器还没开始迭代时就被关闭，finally 不会执行。
+    """
+
+    def __init__(self, relay: StreamRelay, response, chunks: Iterator[bytes]):
+        self._relay = relay
+        self._response = response
+        self._chunks = chunks
+        self._completed = False
+        self._closed = False
+
+    def __iter__(self) -> "RelayedStream":
+        return self
+
+    def __next__(self) -> bytes:
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            self._completed = True
+            self.close()
+            raise
+        self._relay._count("bytes", len(chunk))
+        return chunk
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self._response.close()
+        self._relay._count("completed" if self._completed else "cancelled")
+
+    def abort(self) -> None:
+        """从其他线程中断阻塞中的读取（只关闭套接字读写，close() 仍由读取方调用）
+
+        阻塞在 recv 上的线程不会因为另一个线程关闭响应而返回，
+        shutdown 可以让读取立即结束。
+        """
+        connection = getattr(self._response.raw, "connection", None)
+        sock = getattr(connection, "sock", None)
+        if sock is None:
+            return
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+# 全局流式响应转发实例
+_stream_relay: Optional[StreamRelay] = None
+
+
+def get_stream_relay() -> StreamRelay:
+    """获取流式响应转发实例（单例模式）"""
+    global _stream_relay
+    if _stream_relay is None:
+        _stream_relay = StreamRelay(chunk_size=get_config().stream_chunk_size)
+    return _stream_relay
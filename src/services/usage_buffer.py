@@ -0,0 +1,246 @@
+"""
+使用统计写缓冲
+"""
+import atexit
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from ..models.usage_event import UsageEvent
+from ..models.usage_rollup import GRANULARITIES, UsageRollup, bucket_start
+from ..models.usage_stats import UsageStats
+from ..config import get_config
+
+
+class UsageBuffer:
+    """使用次数写缓冲
+
+    请求路径只在内存中累加每个用户的调用次数、上游调用事件及其分钟/小时/天
+    汇总，由后台线程按时间间隔或积压数量在一个事务内批量写入数据库
+    （total_calls = total_calls + ?），进程退出时会把剩余的数据全部写入。
+    """
+
+    # 清理过期事件的最小间隔（秒）
+    PRUNE_INTERVAL = 3600
+
+    def __init__(self,
+                 flush_interval: float = 2.0,
+                 flush_threshold: int = 200,
+                 event_retention_days: int = 7):
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.event_retention_days = event_retention_days
+        self._last_prune = 0.0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._pid = os.getpid()
+        # 用户ID -> [累计次数, 最近使用时间]
+        self._pending: Dict[int, list] = {}
+        self._pending_calls = 0
+        self._events: List[UsageEvent] = []
+        # (粒度, 用户ID, 时间桶, 接口, 模型) -> [次数, 错误数, 限流数, 总延迟, 最大延迟]
+        self._rollups: Dict[Tuple, list] = {}
+        self._stats = {
+            "recorded": 0, "flushed_calls": 0, "events": 0,
+            "flushed_events": 0, "flushes": 0, "errors": 0,
+        }
+
+    def _ensure_worker(self) -> None:
+        """启动（或 fork 后重新启动）后台写入线程"""
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                # fork 出的子进程不继承父进程尚未写入的计数
+                self._pid = os.getpid()
+                self._pending = {}
+                self._pending_calls = 0
+                self._events = []
+                self._rollups = {}
+                self._thread = None
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="usage-buffer", daemon=True
+                )
+                self._thread.start()
+
+    def record(self, user_id: int, calls: int = 1) -> None:
+        """记录用户的调用次数（仅写内存）"""
+        self._ensure_worker()
+        now = datetime.utcnow().isoformat()
+        with self._lock:
+            entry = self._pending.setdefault(user_id, [0, now])
+            entry[0] += calls
+            entry[1] = now
+            self._pending_calls += calls
+            self._stats["recorded"] += calls
+            should_flush = self._pending_calls + len(self._events) >= self.flush_threshold
+        if should_flush:
+            self._wake.set()
+
+    def record_event(self,
+                     user_id: int,
+                     endpoint: str,
+                     model: str,
+                     status: int,
+                     latency_ms: int) -> None:
+        """记录一次上游调用事件，并累加到各粒度的汇总中（仅写内存）"""
+        self._ensure_worker()
+        now = datetime.utcnow()
+        event = UsageEvent(
+            user_id=user_id,
+            endpoint=endpoint,
+            model=model or "",
+            status=status,
+            latency_ms=latency_ms,
+            created_at=now.isoformat()
+        )
+        is_error = 1 if status == 0 or status >= 400 else 0
+        is_rate_limited = 1 if status == 429 else 0
+
+        with self._lock:
+            self._events.append(event)
+            for granularity in GRANULARITIES:
+                key = (granularity, user_id, bucket_start(now, granularity),
+                       event.endpoint, event.model)
+                self._merge_rollup(key, [1, is_error, is_rate_limited, latency_ms, latency_ms])
+            self._stats["events"] += 1
+            should_flush = self._pending_calls + len(self._events) >= self.flush_threshold
+        if should_flush:
+            self._wake.set()
+
+    def _merge_rollup(self, key: Tuple, values: list) -> None:
+        """合并汇总值（调用方需持有锁）"""
+        aggregate = self._rollups.get(key)
+        if aggregate is None:
+            self._rollups[key] = list(values)
+            return
+        for index in range(4):
+            aggregate[index] += values[index]
+        aggregate[4] = max(aggregate[4], values[4])
+
+    def pending_for(self, user_id: int) -> Tuple[int, Optional[str]]:
+        """获取用户尚未写入数据库的调用次数和最近使用时间"""
+        with self._lock:
+            entry = self._pending.get(user_id)
+            return (entry[0], entry[1]) if entry else (0, None)
+
+    def pending_rollups(self, user_id: int, granularity: str) -> List[UsageRollup]:
+        """获取用户尚未写入数据库的汇总值（只含本进程的缓冲）"""
+        with self._lock:
+            items = [
+                (key, list(values)) for key, values in self._rollups.items()
+                if key[0] == granularity and key[1] == user_id
+            ]
+        return [UsageRollup(*key, *values) for key, values in items]
+
+    def flush(self) -> int:
+        """把缓冲中的数据在一个事务内批量写入数据库，返回写入的调用次数"""
+        from .database import get_db_manager
+
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                events, self._events = self._events, []
+                rollups, self._rollups = self._rollups, {}
+                self._pending_calls = 0
+            if not pending and not events:
+                return 0
+
+            batch: List[Tuple[int, int, str]] = [
+                (user_id, entry[0], entry[1]) for user_id, entry in pending.items()
+            ]
+            try:
+                with get_db_manager().transaction():
+                    UsageStats.add_usage_batch(batch)
+                    UsageEvent.insert_batch(events)
+                    UsageRollup.merge_batch([key + tuple(values) for key, values in rollups.items()])
+            except Exception:
+                # 写入失败时把数据放回缓冲，等待下次重试
+                with self._lock:
+                    for user_id, calls, last_used_at in batch:
+                        entry = self._pending.setdefault(user_id, [0, last_used_at])
+                        entry[0] += calls
+                        entry[1] = max(entry[1], last_used_at)
+                        self._pending_calls += calls
+                    self._events = events + self._events
+                    for key, values in rollups.items():
+                        self._merge_rollup(key, values)
+                    self._stats["errors"] += 1
+                raise
+
+            flushed = sum(item[1] for item in batch)
+            with self._lock:
+                self._stats["flushed_calls"] += flushed
+                self._stats["flushed_events"] += len(events)
+                self._stats["flushes"] += 1
+
+        self._prune_expired()
+        return flushed
+
+    def _prune_expired(self) -> None:
+        """定期清理过期的原始事件和分钟级汇总"""
+        if self.event_retention_days <= 0:
+            return
+        now = time.monotonic()
+        if now - self._last_prune < self.PRUNE_INTERVAL:
+            return
+        self._last_prune = now
+
+        cutoff = datetime.utcnow() - timedelta(days=self.event_retention_days)
+        UsageEvent.delete_before(cutoff.isoformat())
+        UsageRollup.delete_before("minute", bucket_start(cutoff, "minute"))
+
+    def _run(self) -> None:
+        """后台写入循环"""
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                import traceback
+                traceback.print_exc()
+
+    def shutdown(self) -> None:
+        """停止后台线程并写入剩余计数"""
+        self._stop.set()
+        self._wake.set()
+        self.flush()
+
+    def get_stats(self) -> Dict:
+        """获取缓冲统计信息"""
+        with self._lock:
+            return dict(
+                self._stats,
+                pending_users=len(self._pending),
+                pending_calls=self._pending_calls,
+                pending_events=len(self._events),
+            )
+
+
+# 全局使用统计缓冲实例
+_usage_buffer: Optional[UsageBuffer] = None
+_usage_buffer_lock = threading.Lock()
+
+
+def get_usage_buffer() -> UsageBuffer:
+    """获取使用统计缓冲实例（单例模式）"""
+    global _usage_buffer
+    if _usage_buffer is None:
+        with _usage_buffer_lock:
+            if _usage_buffer is None:
+                config = get_config()
+                buffer = UsageBuffer(
+                    flush_interval=config.usage_flush_interval,
+                    flush_threshold=config.usage_flush_threshold,
+                    event_retention_days=config.usage_event_retention_days
+                )
+                atexit.register(buffer.shutdown)
+                _usage_buffer = buffer
+    return _usage_buffer
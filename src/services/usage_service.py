@@ -0,0 +1,137 @@
+"""
+使用统计查询服务
+"""
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+from ..models.usage_rollup import GRANULARITIES, GROUP_FIELDS, UsageRollup, bucket_start
+from ..utils.errors import ValidationError
+from .usage_buffer import get_usage_buffer
+
+
+class UsageService:
+    """使用统计查询服务"""
+
+    # 未指定开始时间时的默认查询范围
+    DEFAULT_RANGES = {
+        "minute": timedelta(hours=1),
+        "hour": timedelta(days=1),
+        "day": timedelta(days=30),
+    }
+
+    # 单次查询最多返回的时间桶数量
+    MAX_BUCKETS = 2000
+
+    @staticmethod
+    def _parse_time(value: Optional[str], name: str) -> Optional[datetime]:
+        """解析 ISO 格式时间"""
+        if not value:
+            return None
+        try:
+            parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            raise ValidationError(f"{name} 时间格式无效，请使用 ISO 8601 格式")
+        if parsed.tzinfo is not None:
+            parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+        return parsed
+
+    @staticmethod
+    def _merge_pending(rollups: List[UsageRollup],
+                       pending: List[UsageRollup],
+                       start: str,
+                       end: str,
+                       fields: Tuple[str, ...]) -> List[UsageRollup]:
+        """合并数据库中的汇总与本进程尚未写入的缓冲值（查询不触发写入）"""
+        merged = {
+            (rollup.bucket_start,) + tuple(getattr(rollup, field) for field in fields): rollup
+            for rollup in rollups
+        }
+        for item in pending:
+            if not start <= item.bucket_start < end:
+                continue
+            key = (item.bucket_start,) + tuple(getattr(item, field) for field in fields)
+            rollup = merged.get(key)
+            if rollup is None:
+                merged[key] = rollup = UsageRollup(
+                    granularity=item.granularity,
+                    user_id=item.user_id,
+                    bucket_start=item.bucket_start,
+                    endpoint=item.endpoint if "endpoint" in fields else "",
+                    model=item.model if "model" in fields else ""
+                )
+            rollup.calls += item.calls
+            rollup.errors += item.errors
+            rollup.rate_limited += item.rate_limited
+            rollup.latency_total_ms += item.latency_total_ms
+            rollup.latency_max_ms = max(rollup.latency_max_ms, item.latency_max_ms)
+        return [merged[key] for key in sorted(merged)]
+
+    def query_usage(self,
+                    user_id: int,
+                    granularity: str = "hour",
+                    start: Optional[str] = None,
+                    end: Optional[str] = None,
+                    group_by: Optional[str] = None) -> Dict:
+        """按时间范围查询使用统计汇总"""
+        if granularity not in GRANULARITIES:
+            raise ValidationError("granularity 仅支持 minute、hour、day")
+
+        fields = tuple(
+            field.strip() for field in (group_by or "").split(",") if field.strip()
+        )
+        for field in fields:
+            if field not in GROUP_FIELDS:
+                raise ValidationError("group_by 仅支持 endpoint、model")
+
+        end_time = self._parse_time(end, "end") or datetime.utcnow()
+        start_time = self._parse_time(start, "start") or (
+            end_time - self.DEFAULT_RANGES[granularity]
+        )
+        if start_time >= end_time:
+            raise ValidationError("start 必须早于 end")
+
+        step = {"minute": 60, "hour": 3600, "day": 86400}[granularity]
+        if (end_time - start_time).total_seconds() / step > self.MAX_BUCKETS:
+            raise ValidationError("查询范围过大，请缩小时间范围或使用更粗的粒度")
+
+        rollups = self._merge_pending(
+            UsageRollup.query_range(
+                user_id,
+                granularity,
+                bucket_start(start_time, granularity),
+                end_time.isoformat(),
+                fields
+            ),
+            get_usage_buffer().pending_rollups(user_id, granularity),
+            bucket_start(start_time, granularity),
+            end_time.isoformat(),
+            fields
+        )
+        buckets = []
+        for rollup in rollups:
+            item = rollup.to_dict()
+            item.pop("granularity")
+            for field in GROUP_FIELDS:
+                if field not in fields:
+                    item.pop(field)
+            buckets.append(item)
+
+        return {
+            "granularity": granularity,
+            "start": bucket_start(start_time, granularity),
+            "end": end_time.isoformat(),
+            "groupBy": list(fields),
+            "buckets": buckets,
+        }
+
+
+# 全局使用统计查询服务实例
+_usage_service: Optional[UsageService] = None
+
+
+def get_usage_service() -> UsageService:
+    """获取使用统计查询服务实例（单例模式）"""
+    global _usage_service
+    if _usage_service is None:
+        _usage_service = UsageService()
+    return _usage_service
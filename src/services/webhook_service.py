@@ -0,0 +1,92 @@
+"""
+上游回调服务
+"""
+import hmac
+import secrets
+from hashlib import sha256
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import urlencode
+
+from ..models.draw_result import DrawResult, parse_progress
+from ..utils.errors import AuthenticationError, ValidationError
+from ..config import get_config
+from .draw_poller import get_draw_poller
+from .generation_buffer import get_generation_buffer
+
+
+class WebhookService:
+    """上游回调服务
+
+    上游回调请求不带任何凭证，因此提交任务时生成带签名的回调地址：
+    地址中包含用户ID和随机数，签名为 HMAC-SHA256(WEBHOOK_SECRET, 用户ID:随机数)。
+    绘图ID由上游在提交后才分配，无法写入签名，因此提交成功后把随机数与
+    绘图ID一起登记；收到回调时校验签名，并且只更新用同一随机数登记的任务，
+    一个回调地址不能写入其他任务的结果。结果写入 draw_results 表并唤醒等待
+    该任务的客户端。
+    """
+
+    def __init__(self):
+        self.config = get_config()
+        self._secret = self.config.webhook_secret.encode("utf-8")
+
+    @property
+    def enabled(self) -> bool:
+        return self.config.draw_webhook_enabled
+
+    def _sign(self, uid: str, nonce: str) -> str:
+        message = f"{uid}:{nonce}".encode("utf-8")
+        return hmac.new(self._secret, message, sha256).hexdigest()
+
+    def callback_url(self, user_id: Optional[int]) -> Tuple[str, str]:
+        """生成一次提交使用的回调地址，返回 (回调地址, 随机数)"""
+        uid = str(user_id or "")
+        nonce = secrets.token_urlsafe(12)
+        query = urlencode({"uid": uid, "n": nonce, "sig": self._sign(uid, nonce)})
+        return f"{self.config.draw_webhook_url}?{query}", nonce
+
+    def verify(self, uid: str, nonce: str, signature: str) -> Optional[int]:
+        """校验回调地址的签名，返回对应的用户ID"""
+        if not nonce or not signature:
+            raise AuthenticationError("回调签名缺失")
+        if not hmac.compare_digest(self._sign(uid, nonce), signature):
+            raise AuthenticationError("回调签名无效")
+        return int(uid) if uid.isdigit() else None
+
+    def register(self, user_id: Optional[int], result: Dict[str, Any], nonce: str) -> None:
+        """登记以回调模式提交的任务（nonce 为该任务回调地址中的随机数）"""
+        data = result.get("data") if isinstance(result, dict) else None
+        draw_id = data.get("id") if isinstance(data, dict) else None
+        if draw_id:
+            DrawResult.register(str(draw_id), user_id, nonce)
+
+    def handle_draw_callback(self, user_id: Optional[int], nonce: str, payload: Any) -> bool:
+        """处理绘图结果回调，返回结果是否有更新
+
+        回调先于登记到达或不属于该回调地址时不写入，未登记的任务由轮询兜底。
+        """
+        if not isinstance(payload, dict):
+            raise ValidationError("回调内容无效")
+        draw_id = str(payload.get("id") or "").strip()
+        if not draw_id:
+            raise ValidationError("回调缺少任务ID")
+        if parse_progress(payload.get("progress")) is None:
+            raise ValidationError("回调进度无效")
+
+        updated = DrawResult.update_from_callback(draw_id, user_id, nonce, payload)
+        if updated:
+            result = DrawResult(draw_id=draw_id, user_id=user_id, payload=payload).to_result()
+            get_draw_poller().publish(user_id, draw_id, result)
+            get_generation_buffer().record_result(user_id, draw_id, result)
+        return updated
+
+
+# 全局上游回调服务实例
+_webhook_service: Optional[WebhookService] = None
+
+
+def get_webhook_service() -> WebhookService:
+    """获取上游回调服务实例（单例模式）"""
+    global _webhook_service
+    if _webhook_service is None:
+        _webhook_service = WebhookService()
+    return _webhook_service
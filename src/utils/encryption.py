@@ -2,6 +2,7 @@
 加密工具
 """
 import base64
+import hmac
 from hashlib import sha256
 from typing import Optional
 
@@ -14,6 +15,7 @@ class EncryptionService:
     def __init__(self, secret_key: str):
         self.secret_key = secret_key
         self._cipher = None
+        self._fingerprint_key = None
 
     @property
     def cipher(self) -> Fernet:
@@ -40,6 +42,15 @@ class EncryptionService:
         except (InvalidToken, ValueError):
             return ""
 
+    def fingerprint(self, value: str) -> str:
+        """计算值的指纹（基于应用密钥的 HMAC，可用于等值查找而无需解密）"""
+        if not value:
+            return ""
+        if self._fingerprint_key is None:
+            secret = str(self.secret_key or "change-me")
+            self._fingerprint_key = sha256(f"fingerprint:{secret}".encode("utf-8")).digest()
+        return hmac.new(self._fingerprint_key, value.encode("utf-8"), sha256).hexdigest()
+
     @staticmethod
     def mask_key(value: str) -> str:
         """掩码显示API密钥"""
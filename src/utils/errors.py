@@ -21,6 +21,20 @@ class ApiError(Exception):
         return result
 
 
+class UpstreamError(ApiError):
+    """上游返回错误状态（保留上游状态码，密钥池据此判断是否换密钥重试）"""
+
+    def __init__(self,
+                 message: str = "API request failed",
+                 upstream_status: int = 502,
+                 status_code: int = 502,
+                 details: Optional[str] = None,
+                 retry_after: Optional[float] = None):
+        super().__init__(message, status_code=status_code, details=details)
+        self.upstream_status = upstream_status
+        self.retry_after = retry_after
+
+
 class AuthenticationError(ApiError):
     """认证错误"""
 
@@ -27,7 +27,7 @@ class ValidationService:
         return cleaned
 
     def validate_reference_images(self, urls: List[str]) -> None:
-        """验证参考图片"""
+        """验证参考图片（URL、data URL 或 ref:<摘要> 形式的已上传图片引用）"""
         if len(urls) > self.max_reference_images:
             raise ValidationError(f"参考图数量最多 {self.max_reference_images} 张")
 